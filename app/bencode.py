@@ -0,0 +1,225 @@
+"""
+Bencode, decoded straight off the original bytes.
+
+`decode` builds plain Python values: bytes for strings, int, list and dict.
+With `lazy=True`, dicts come back as `LazyDict`s instead. A LazyDict only
+notes where each value sits and decodes it on first access. It can also
+hand back a value's exact original bytes, which is how the info hash is
+taken: one SHA-1 over the `info` span as it appears in the file. Re-encoding
+a decoded dict would get this wrong for any torrent that isn't encoded
+canonically. Lazy decoding also returns long strings, like `pieces`, as
+memoryview slices rather than copies. Values inside lists are decoded
+eagerly, since a list like `files` is always read in full.
+"""
+
+from collections.abc import Mapping
+from typing import Any, Callable, Iterator
+
+# Strings at least this long are returned as memoryviews when decoding lazily.
+LAZY_STRING_SIZE = 1024
+
+
+class BencodeError(ValueError):
+    pass
+
+
+class _Decoder:
+    __slots__ = ("data", "view")
+
+    def __init__(self, data: bytes | bytearray | memoryview) -> None:
+        # bytes, for its fast index(); the view hands out zero-copy slices.
+        self.data = data if isinstance(data, bytes) else bytes(data)
+        self.view = memoryview(self.data)
+
+    def decode(self, i: int, lazy: bool = False) -> tuple[Any, int]:
+        """Decodes the value starting at `i`, returning it and where it ends."""
+        data = self.data
+        c = data[i]
+        if c == 0x69:  # i<digits>e
+            end = data.index(b"e", i)
+            return int(data[i + 1 : end]), end + 1
+        if c == 0x6C:  # l<items>e
+            i += 1
+            items = []
+            while data[i] != 0x65:
+                item, i = self.decode(i)  # Eagerly; see the module docstring.
+                items.append(item)
+            return items, i + 1
+        if c == 0x64:  # d<key><value>...e
+            if lazy:
+                lazy_dict = LazyDict(self, i)
+                return lazy_dict, lazy_dict.end
+            i += 1
+            result = {}
+            while data[i] != 0x65:
+                key, i = self.key(i)
+                result[key], i = self.decode(i)
+            return result, i + 1
+        if 0x30 <= c <= 0x39:
+            return self.string(i, lazy)
+        raise BencodeError(f"Unexpected {chr(c)!r} at offset {i}.")
+
+    def string(self, i: int, lazy: bool = False) -> tuple[bytes | memoryview, int]:
+        colon = self.data.index(b":", i)
+        start = colon + 1
+        end = start + int(self.data[i:colon])
+        if end > len(self.data):
+            raise BencodeError(f"String at offset {i} runs past the end of the data.")
+        if lazy and end - start >= LAZY_STRING_SIZE:
+            return self.view[start:end], end
+        return self.data[start:end], end
+
+    def key(self, i: int) -> tuple[bytes, int]:
+        if not 0x30 <= self.data[i] <= 0x39:
+            raise BencodeError(f"Dict key at offset {i} is not a string.")
+        colon = self.data.index(b":", i)
+        end = colon + 1 + int(self.data[i:colon])
+        return self.data[colon + 1 : end], end
+
+    def skip(self, i: int) -> int:
+        """Where the value starting at `i` ends, without building it."""
+        data = self.data
+        c = data[i]
+        if c == 0x69:
+            return data.index(b"e", i) + 1
+        if c == 0x6C or c == 0x64:
+            i += 1
+            while data[i] != 0x65:
+                i = self.skip(i)
+            return i + 1
+        if 0x30 <= c <= 0x39:
+            colon = data.index(b":", i)
+            end = colon + 1 + int(data[i:colon])
+            if end > len(data):
+                raise BencodeError(
+                    f"String at offset {i} runs past the end of the data."
+                )
+            return end
+        raise BencodeError(f"Unexpected {chr(c)!r} at offset {i}.")
+
+
+class LazyDict(Mapping):
+    """
+    A bencoded dict that decodes each value the first time it is read.
+
+    When the dict's own end is already known, its keys are only read as far
+    as the one asked for. A wanted value that isn't a dict is decoded during
+    that read, which also finds where it ends, so a large value such as
+    `files` is walked once instead of being skipped first and decoded later.
+    """
+
+    __slots__ = ("decoder", "spans", "values", "cursor", "end")
+
+    def __init__(self, decoder: _Decoder, start: int, end: int | None = None) -> None:
+        self.decoder = decoder
+        self.spans: dict[bytes, tuple[int, int]] = {}
+        self.values: dict[bytes, Any] = {}
+        self.cursor = start + 1  # Where the first key not yet in `spans` starts.
+        if end is None:
+            self._scan()
+            end = self.cursor + 1
+        self.end = end
+
+    def _scan(self, wanted: bytes | None = None) -> None:
+        """Records keys and value spans up to `wanted`, or to the end of the dict."""
+        decoder = self.decoder
+        data = decoder.data
+        i = self.cursor
+        while data[i] != 0x65:
+            key, i = decoder.key(i)
+            if key == wanted and data[i] != 0x64:
+                self.values[key], end = decoder.decode(i, lazy=True)
+            else:
+                end = decoder.skip(i)
+            self.spans[key] = (i, end)
+            i = self.cursor = end
+            if key == wanted:
+                return
+
+    def __getitem__(self, key: bytes) -> Any:
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+        if key not in self.spans:
+            self._scan(key)
+            if key in self.values:
+                return self.values[key]
+        start, end = self.spans[key]
+        if self.decoder.data[start] == 0x64:
+            value = LazyDict(self.decoder, start, end)
+        else:
+            value, _ = self.decoder.decode(start, lazy=True)
+        self.values[key] = value
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        if key not in self.spans:
+            self._scan(key)  # type: ignore[arg-type]
+        return key in self.spans
+
+    def __iter__(self) -> Iterator[bytes]:
+        self._scan()
+        return iter(self.spans)
+
+    def __len__(self) -> int:
+        self._scan()
+        return len(self.spans)
+
+    def raw(self, key: bytes) -> memoryview:
+        """The value's bytes exactly as they appear in the input."""
+        if key not in self.spans:
+            self._scan(key)
+        start, end = self.spans[key]
+        return self.decoder.view[start:end]
+
+
+def decode_prefix(
+    data: bytes | bytearray | memoryview, start: int = 0, lazy: bool = False
+) -> tuple[Any, int]:
+    """Decodes one value starting at `start`; returns it and the offset after it."""
+    try:
+        return _Decoder(data).decode(start, lazy)
+    except (IndexError, ValueError, RecursionError) as e:
+        if isinstance(e, BencodeError):
+            raise
+        raise BencodeError(f"Malformed bencode: {e}") from e
+
+
+def decode(data: bytes | bytearray | memoryview, lazy: bool = False) -> Any:
+    """Decodes a complete bencoded value; trailing bytes are an error."""
+    value, end = decode_prefix(data, 0, lazy)
+    if end != len(data):
+        raise BencodeError(f"{len(data) - end} trailing bytes after the value.")
+    return value
+
+
+def encode(value: Any) -> bytes:
+    """Encodes ints, strings, lists and dicts, sorting dict keys as bencode requires."""
+    parts: list[bytes] = []
+    _encode(value, parts.append)
+    return b"".join(parts)
+
+
+def _encode(value: Any, write: Callable[[bytes], None]) -> None:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        write(b"%d:" % len(value))
+        write(bytes(value))
+    elif isinstance(value, str):
+        _encode(value.encode(), write)
+    elif isinstance(value, int):
+        write(b"i%de" % value)
+    elif isinstance(value, (list, tuple)):
+        write(b"l")
+        for item in value:
+            _encode(item, write)
+        write(b"e")
+    elif isinstance(value, Mapping):
+        write(b"d")
+        items = ((k.encode() if isinstance(k, str) else k, v) for k, v in value.items())
+        for key, item in sorted(items):
+            _encode(key, write)
+            _encode(item, write)
+        write(b"e")
+    else:
+        raise TypeError(f"Cannot bencode {type(value).__name__}.")
@@ -0,0 +1,79 @@
+"""
+Keeps verified magnet metadata on disk so repeat runs skip the peer round-trip.
+
+Entries are `.torrent` files named after their info hash, holding the info
+dict exactly as the swarm sent it. Lookups re-check the hash, so a damaged
+entry is just a miss. Hits bump the file's mtime, and the least recently
+used entries are evicted once the directory grows past its size limit.
+"""
+
+import os
+import tempfile
+from hashlib import sha1
+
+from app import bencode
+from app.settings import METADATA_CACHE_DIR, METADATA_CACHE_SIZE
+
+
+class MetadataCache:
+    def __init__(
+        self, directory: str = METADATA_CACHE_DIR, max_bytes: int = METADATA_CACHE_SIZE
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, info_hash: bytes) -> str:
+        return os.path.join(self.directory, f"{info_hash.hex()}.torrent")
+
+    def get(self, info_hash: bytes) -> dict | None:
+        """The cached `.torrent` dict for this info hash, or None."""
+        path = self.path(info_hash)
+        try:
+            with open(path, "rb") as f:
+                torrent = bencode.decode(f.read(), lazy=True)
+            if sha1(torrent.raw(b"info")).digest() != info_hash:
+                return None
+        except (OSError, bencode.BencodeError, KeyError, AttributeError):
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # Read-only cache; entries just age out sooner.
+        return torrent
+
+    def put(self, info_hash: bytes, metadata: bytes, tracker_url: str = "") -> None:
+        """Stores verified raw info dict bytes, then trims the cache to size."""
+        torrent = b"d"
+        if tracker_url:
+            torrent += b"8:announce" + bencode.encode(tracker_url)
+        torrent += b"4:info" + metadata + b"e"
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(torrent)
+            os.replace(temporary_path, self.path(info_hash))
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".torrent"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Another run evicted it first.
+            total -= size
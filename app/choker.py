@@ -0,0 +1,69 @@
+"""
+Decides which peers we upload to (BEP 3's choking algorithm).
+
+Every CHOKE_INTERVAL the interested peers that gave us the most data over the
+last interval get the regular unchoke slots, so peers that reciprocate get
+our upload bandwidth back. One more slot goes to an optimistic unchoke,
+rotated every OPTIMISTIC_UNCHOKE_INTERVAL, which is how new peers get a
+chance to prove themselves.
+"""
+
+import asyncio
+import random
+
+from app.session import PeerPool, PeerSession
+from app.settings import CHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_INTERVAL, UNCHOKE_SLOTS
+
+
+class Choker:
+    def __init__(self, pool: PeerPool, slots: int = UNCHOKE_SLOTS) -> None:
+        self.pool = pool
+        self.slots = slots
+        self.optimistic: str | None = None
+        self.rounds = 0
+        # Bytes downloaded per session at the last round, to turn into rates.
+        self.last_seen: dict[str, int] = {}
+        pool.on_interested = self.on_interested
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(CHOKE_INTERVAL)
+            self.rechoke()
+
+    def rates(self, sessions: dict[str, PeerSession]) -> dict[str, float]:
+        """Bytes per second each peer gave us over the last round."""
+        rates = {
+            key: (session.downloaded - self.last_seen.get(key, 0)) / CHOKE_INTERVAL
+            for key, session in sessions.items()
+        }
+        self.last_seen = {key: session.downloaded for key, session in sessions.items()}
+        return rates
+
+    def rechoke(self) -> None:
+        sessions = {key: s for key, s in self.pool.sessions.items() if s.connected}
+        rates = self.rates(sessions)
+        interested = [
+            key for key, session in sessions.items() if session.peer_interested
+        ]
+        interested.sort(key=rates.__getitem__, reverse=True)
+        regular = set(interested[: self.slots - 1])
+
+        # Every round when the optimistic interval is the shorter one.
+        every = max(1, round(OPTIMISTIC_UNCHOKE_INTERVAL / CHOKE_INTERVAL))
+        rotate = self.rounds % every == 0
+        if rotate or self.optimistic not in sessions or self.optimistic in regular:
+            candidates = [key for key in interested if key not in regular]
+            self.optimistic = random.choice(candidates) if candidates else None
+        self.rounds += 1
+
+        unchoked = regular | {self.optimistic}
+        for key, session in sessions.items():
+            session.set_choking(key not in unchoked)
+
+    def on_interested(self, session: PeerSession) -> None:
+        """Unchokes a newly interested peer straight away while slots are free."""
+        unchoked = sum(
+            not s.am_choking for s in self.pool.sessions.values() if s.connected
+        )
+        if unchoked < self.slots:
+            session.set_choking(False)
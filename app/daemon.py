@@ -0,0 +1,265 @@
+"""
+Runs many torrents in one long-lived process, driven over a unix socket.
+
+Example calls:
+python app/main.py daemon
+python app/main.py control add sample.torrent /tmp/sample.txt
+python app/main.py control list
+python app/main.py control stats <info_hash>
+
+All torrents share one `Resources`: the listening port, the DHT node, the
+connection budget, the disk writer threads and the rate limits. Each torrent
+runs as a regular `Download`. Pausing cancels that download, which leaves
+its resume file behind, and resuming starts a fresh one that picks up from
+it.
+
+The control protocol is one JSON object per line each way. A request names
+a `command` plus its arguments. A reply carries the result, or an `error`.
+"""
+
+import asyncio
+import json
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any
+
+from app.dht import DHTNode
+from app.downloader import Download, Resources
+from app.metadata import resolve_magnet
+from app.models import Torrent
+from app.server import PeerServer
+from app.session import ConnectionBudget
+from app.settings import CONTROL_SOCKET, DHT_ENABLED, DISK_WORKERS, MAX_CONNECTIONS
+from app.stats import MetricsServer, StatsReporter
+
+
+@dataclass
+class ManagedTorrent:
+    torrent: Torrent
+    output_file_path: str
+    state: str = "queued"  # "downloading", "paused", "completed" or "failed".
+    download: Download | None = None
+    task: asyncio.Task | None = None
+    error: str | None = None
+
+    def status(self) -> dict[str, Any]:
+        status = {
+            "name": self.torrent.name,
+            "info_hash": self.torrent.info_hash,
+            "output": self.output_file_path,
+            "state": self.state,
+        }
+        if self.download is not None:
+            status.update(self.download.status())
+        if self.error:
+            status["error"] = self.error
+        return status
+
+
+class Daemon:
+    def __init__(self, socket_path: str = CONTROL_SOCKET) -> None:
+        self.socket_path = socket_path
+        self.resources = Resources(
+            server=PeerServer(),
+            connections=ConnectionBudget(MAX_CONNECTIONS),
+            disk=ThreadPoolExecutor(DISK_WORKERS, thread_name_prefix="disk"),
+            dht=DHTNode() if DHT_ENABLED else None,
+        )
+        self.torrents: dict[str, ManagedTorrent] = {}
+
+    def snapshots(self) -> list[dict[str, Any]]:
+        """Stats for every downloading torrent, for the reporter and /metrics."""
+        return [
+            managed.download.stats()
+            for managed in self.torrents.values()
+            if managed.state == "downloading" and managed.download is not None
+        ]
+
+    async def serve_forever(self) -> None:
+        if os.path.exists(self.socket_path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_path)
+            except ConnectionRefusedError:
+                # Left over from a daemon that didn't exit cleanly.
+                os.unlink(self.socket_path)
+            else:
+                writer.close()
+                raise SystemExit(f"A daemon is already running on {self.socket_path}.")
+        try:
+            await self.resources.server.start()
+        except OSError as e:
+            print(f"Not accepting incoming peers: {e!r}")
+        try:
+            if self.resources.dht is not None:
+                await self.resources.dht.start()
+        except OSError as e:
+            print(f"Not joining the DHT: {e!r}")
+            self.resources.dht = None
+        control = await asyncio.start_unix_server(
+            self.handle_control, path=self.socket_path
+        )
+        os.chmod(self.socket_path, 0o600)
+        print(f"🛰️ Daemon listening on {self.socket_path}.")
+        metrics = MetricsServer(self.snapshots)
+        await metrics.start()
+        reporting = asyncio.create_task(StatsReporter(self.snapshots).run())
+        stopping = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        try:
+            await stopping.wait()
+        finally:
+            control.close()
+            reporting.cancel()
+            await metrics.close()
+            await asyncio.gather(
+                *(self.stop(managed) for managed in self.torrents.values()),
+                return_exceptions=True,
+            )
+            await self.resources.server.close()
+            if self.resources.dht is not None:
+                await self.resources.dht.close()
+            self.resources.disk.shutdown(wait=True)
+            os.unlink(self.socket_path)
+
+    def add(self, source: str, output_file_path: str) -> ManagedTorrent:
+        """Adds a `.torrent` path or magnet link and starts downloading it."""
+        if source.startswith("magnet:"):
+            torrent = Torrent.from_magnet_link(source)
+        else:
+            torrent = Torrent.from_file(source)
+        if torrent.info_hash in self.torrents:
+            raise ValueError(f"Already have {torrent.info_hash}.")
+        managed = ManagedTorrent(torrent, output_file_path)
+        self.torrents[torrent.info_hash] = managed
+        self.start(managed)
+        return managed
+
+    def start(self, managed: ManagedTorrent) -> None:
+        managed.state = "queued"
+        managed.error = None
+        managed.task = asyncio.create_task(self.run_torrent(managed))
+
+    async def run_torrent(self, managed: ManagedTorrent) -> None:
+        try:
+            await resolve_magnet(managed.torrent, self.resources.dht)
+            managed.download = Download(
+                managed.torrent, managed.output_file_path, self.resources
+            )
+            managed.state = "downloading"
+            await managed.download.run()
+            managed.state = "completed"
+            print(f"✅ Finished {managed.torrent.name}.")
+        except Exception as e:
+            managed.state = "failed"
+            managed.error = repr(e)
+            print(
+                f"❌ {managed.torrent.name or managed.torrent.info_hash} failed: {e!r}"
+            )
+
+    async def stop(self, managed: ManagedTorrent) -> None:
+        if managed.task is not None and not managed.task.done():
+            managed.task.cancel()
+            await asyncio.gather(managed.task, return_exceptions=True)
+
+    def get(self, info_hash: str) -> ManagedTorrent:
+        managed = self.torrents.get(info_hash)
+        if managed is None:
+            raise KeyError(f"No torrent {info_hash}.")
+        return managed
+
+    async def pause(self, info_hash: str) -> None:
+        managed = self.get(info_hash)
+        if managed.state in ("queued", "downloading"):
+            await self.stop(managed)
+            managed.state = "paused"
+
+    def resume(self, info_hash: str) -> None:
+        managed = self.get(info_hash)
+        if managed.state in ("paused", "failed"):
+            self.start(managed)
+
+    async def remove(self, info_hash: str) -> None:
+        """Stops a torrent and forgets it; downloaded data stays on disk."""
+        await self.stop(self.get(info_hash))
+        del self.torrents[info_hash]
+
+    def set_limits(self, limits: dict[str, Any]) -> None:
+        """
+        Changes the rate limits a `limits` request names, for every torrent.
+
+        `download` and `upload` are the global limits, `peer_download` and
+        `peer_upload` those of each connection. null lifts a limit; limits
+        left out stay as they are.
+        """
+        resources = self.resources
+        if "download" in limits:
+            resources.download_limit.set_rate(limits["download"])
+        if "upload" in limits:
+            resources.upload_limit.set_rate(limits["upload"])
+        peer_limits = {}
+        if "peer_download" in limits:
+            resources.peer_download_rate = peer_limits["peer_download"] = limits[
+                "peer_download"
+            ]
+        if "peer_upload" in limits:
+            resources.peer_upload_rate = peer_limits["peer_upload"] = limits[
+                "peer_upload"
+            ]
+        for managed in self.torrents.values():
+            if managed.download is not None and managed.download.pool is not None:
+                managed.download.pool.set_rate_limits(**peer_limits)
+
+    async def handle_command(self, request: dict[str, Any]) -> Any:
+        match request.get("command"):
+            case "add":
+                return self.add(request["torrent"], request["output"]).status()
+            case "list":
+                return [managed.status() for managed in self.torrents.values()]
+            case "status":
+                return self.get(request["info_hash"]).status()
+            case "stats":
+                download = self.get(request["info_hash"]).download
+                return download.stats() if download is not None else None
+            case "pause":
+                await self.pause(request["info_hash"])
+            case "resume":
+                self.resume(request["info_hash"])
+            case "remove":
+                await self.remove(request["info_hash"])
+            case "limits":
+                self.set_limits(request)
+            case command:
+                raise ValueError(f"Unknown command {command!r}.")
+        return None
+
+    async def handle_control(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = {"result": await self.handle_command(json.loads(line))}
+                except Exception as e:
+                    reply = {"error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The client went away.
+        finally:
+            writer.close()
+
+
+async def control(request: dict[str, Any], socket_path: str = CONTROL_SOCKET) -> Any:
+    """Sends one request to a running daemon and returns its result."""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        reply = json.loads(await reader.readline())
+    finally:
+        writer.close()
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
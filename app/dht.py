@@ -0,0 +1,555 @@
+"""
+Finds peers through the mainline DHT (BEP 5), so a magnet link needs no tracker.
+
+Nodes talk KRPC: bencoded queries and replies over UDP, matched up by
+transaction ID. `DHTNode.get_peers` runs an iterative Kademlia lookup. It
+asks the nodes closest to the info hash, DHT_ALPHA at a time, and each reply
+brings either peers or nodes that are closer still. The node also answers
+queries itself, so a handful of them on loopback, bootstrapped off each
+other, make a working DHT of their own.
+
+The node's ID and the nodes it knows are saved in DHT_STATE_FILE, so the next
+run can skip the bootstrap routers. IPv4 only (no BEP 32).
+"""
+
+import asyncio
+import contextlib
+import heapq
+import os
+import socket
+import struct
+import time
+from dataclasses import dataclass
+from hashlib import sha1
+from typing import Any, AsyncIterator, Iterable, Iterator
+
+from app import bencode
+from app.models import Peer
+from app.settings import (
+    DHT_ALPHA,
+    DHT_BOOTSTRAP_NODES,
+    DHT_BUCKET_SIZE,
+    DHT_ENABLED,
+    DHT_LOOKUP_TIMEOUT,
+    DHT_MAX_FAILURES,
+    DHT_PORT,
+    DHT_QUERY_TIMEOUT,
+    DHT_STATE_FILE,
+)
+
+# Seconds before a write token's secret is replaced; the previous one stays valid too.
+TOKEN_LIFETIME = 5 * 60
+# Seconds we keep handing out a peer that announced itself to us.
+PEER_LIFETIME = 30 * 60
+# Peers returned per get_peers reply, to keep it within one UDP datagram.
+MAX_VALUES = 50
+# Info hashes we keep announced peers for, and peers kept per info hash; the
+# least recently announced go first, so strangers can't grow our memory.
+MAX_ANNOUNCED_TORRENTS = 2000
+MAX_ANNOUNCED_PEERS = 200
+# Contacts from PORT messages pinged at once; more are ignored meanwhile.
+MAX_PINGS = 16
+
+
+class KRPCError(Exception):
+    """An error reply (`y` = `e`), or one we send back."""
+
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.message = message
+
+
+@dataclass(frozen=True, slots=True)
+class Node:
+    id: bytes
+    ip: str
+    port: int
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.ip, self.port
+
+    def to_bytes(self) -> bytes:
+        """Compact node info: the 20-byte ID, 4 address bytes and the port."""
+        return self.id + socket.inet_aton(self.ip) + struct.pack(">H", self.port)
+
+    @classmethod
+    def from_bytes(cls, nodes: bytes) -> list["Node"]:
+        """Parses concatenated compact node infos, skipping any without a port."""
+        nodes = nodes[: len(nodes) - len(nodes) % 26]
+        return [
+            cls(node_id, socket.inet_ntoa(ip), port)
+            for node_id, ip, port in struct.iter_unpack(">20s4sH", nodes)
+            if port
+        ]
+
+
+class RoutingTable:
+    """
+    Known nodes in 160 buckets, by how many leading bits their ID shares with ours.
+
+    Each bucket holds up to DHT_BUCKET_SIZE nodes, least recently heard from
+    first. A full bucket only takes a newcomer in place of a node that has
+    stopped answering. Nodes that have been up a long time are the likeliest
+    to stay up.
+    """
+
+    def __init__(self, node_id: bytes) -> None:
+        self.id = node_id
+        self.key = int.from_bytes(node_id, "big")
+        self.buckets: list[dict[bytes, Node]] = [{} for _ in range(160)]
+        self.failures: dict[bytes, int] = {}
+
+    def __len__(self) -> int:
+        return sum(map(len, self.buckets))
+
+    def __iter__(self) -> Iterator[Node]:
+        for bucket in self.buckets:
+            yield from bucket.values()
+
+    def bucket(self, node_id: bytes) -> dict[bytes, Node]:
+        distance = self.key ^ int.from_bytes(node_id, "big")
+        return self.buckets[160 - distance.bit_length()]
+
+    def add(self, node: Node) -> None:
+        """Records that we heard from `node`."""
+        if node.id == self.id:
+            return
+        bucket = self.bucket(node.id)
+        if node.id in bucket:
+            del bucket[node.id]  # Re-inserted at the end, as the freshest.
+        elif len(bucket) >= DHT_BUCKET_SIZE:
+            stale = next(
+                (
+                    key
+                    for key in bucket
+                    if self.failures.get(key, 0) >= DHT_MAX_FAILURES
+                ),
+                None,
+            )
+            if stale is None:
+                return
+            del bucket[stale]
+            del self.failures[stale]
+        bucket[node.id] = node
+        self.failures.pop(node.id, None)
+
+    def fail(self, node_id: bytes) -> None:
+        """Records that a node we know didn't answer."""
+        if node_id != self.id and node_id in self.bucket(node_id):
+            self.failures[node_id] = self.failures.get(node_id, 0) + 1
+
+    def closest(self, target: bytes, count: int = DHT_BUCKET_SIZE) -> list[Node]:
+        key = int.from_bytes(target, "big")
+        return heapq.nsmallest(
+            count, self, key=lambda node: int.from_bytes(node.id, "big") ^ key
+        )
+
+
+class DHTNode(asyncio.DatagramProtocol):
+    def __init__(
+        self,
+        port: int = DHT_PORT,
+        bootstrap_nodes: list[tuple[str, int]] = DHT_BOOTSTRAP_NODES,
+        state_file: str | None = DHT_STATE_FILE,
+        host: str = "0.0.0.0",
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.bootstrap_nodes = bootstrap_nodes
+        self.state_file = state_file
+        self.id = os.urandom(20)
+        self.table = RoutingTable(self.id)
+        self.transport: asyncio.DatagramTransport | None = None
+        # Our queries awaiting a reply, by transaction ID, with who we asked.
+        self.pending: dict[bytes, tuple[asyncio.Future, tuple[str, int]]] = {}
+        # Peers that announced themselves to us, by info hash, with when they did.
+        self.announced: dict[bytes, dict[Peer, float]] = {}
+        self.secrets = [os.urandom(16), os.urandom(16)]
+        self.secret_rotated = time.monotonic()
+        self.bootstrapping: asyncio.Task | None = None
+        # Contacts being checked by `add_contact`.
+        self.pings: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self.load()
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, self.port)
+        )
+        self.port = self.transport.get_extra_info("sockname")[1]
+        print(
+            f"🕸️ DHT node listening on UDP port {self.port}"
+            f" with {len(self.table)} known nodes."
+        )
+        self.bootstrapping = asyncio.create_task(self.bootstrap())
+
+    async def close(self) -> None:
+        if self.bootstrapping is not None:
+            self.bootstrapping.cancel()
+            await asyncio.gather(self.bootstrapping, return_exceptions=True)
+        for ping in list(self.pings):
+            ping.cancel()
+        await asyncio.gather(*self.pings, return_exceptions=True)
+        if self.transport is not None:
+            self.save()
+            self.transport.close()
+            self.transport = None
+
+    async def bootstrap(self) -> None:
+        """Fills the routing table by looking up our own ID."""
+        seeds: list[Node] = []
+        if len(self.table) < DHT_BUCKET_SIZE:
+            loop = asyncio.get_running_loop()
+            addresses = []
+            for host, port in self.bootstrap_nodes:
+                try:
+                    infos = await loop.getaddrinfo(
+                        host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+                    )
+                except OSError:
+                    continue  # Offline, or the name is gone.
+                addresses.append(infos[0][4][:2])
+            replies = await asyncio.gather(
+                *(
+                    self.query(address, "find_node", {"target": self.id})
+                    for address in addresses
+                ),
+                return_exceptions=True,
+            )
+            for reply in replies:
+                if isinstance(reply, dict) and isinstance(reply.get(b"nodes"), bytes):
+                    seeds.extend(Node.from_bytes(reply[b"nodes"]))
+        await self.lookup(self.id, "find_node", seeds)
+
+    async def get_peers(
+        self, info_hash: bytes, announce_port: int | None = None
+    ) -> list[Peer]:
+        """
+        Looks up peers for a torrent.
+
+        With `announce_port`, also tells the closest nodes on the way that we
+        accept peers for it on that port.
+        """
+        if self.bootstrapping is not None and len(self.table) < DHT_BUCKET_SIZE:
+            # Shielded: a cancelled lookup shouldn't cancel the bootstrap too.
+            await asyncio.shield(self.bootstrapping)
+        peers, closest = await self.lookup(info_hash, "get_peers")
+        if announce_port is not None:
+            await asyncio.gather(
+                *(
+                    self.query(
+                        node.address,
+                        "announce_peer",
+                        {"info_hash": info_hash, "port": announce_port, "token": token},
+                    )
+                    for node, token in closest
+                    if isinstance(token, bytes)
+                ),
+                return_exceptions=True,
+            )
+        return peers
+
+    def add_contact(self, address: tuple[str, int]) -> None:
+        """
+        Pings a node we heard about, e.g. from a peer's PORT message (BEP 5).
+
+        `query` adds it to the routing table if it answers.
+        """
+        if self.transport is None or len(self.pings) >= MAX_PINGS:
+            return
+        ping = asyncio.create_task(self.query(address, "ping", {}))
+        self.pings.add(ping)
+        ping.add_done_callback(self.pinged)
+
+    def pinged(self, ping: asyncio.Task) -> None:
+        self.pings.discard(ping)
+        if not ping.cancelled():
+            ping.exception()  # No answer just means it stays out of the table.
+
+    async def lookup(
+        self, target: bytes, method: str, seeds: Iterable[Node] = ()
+    ) -> tuple[list[Peer], list[tuple[Node, Any]]]:
+        """
+        An iterative Kademlia lookup for `target`, by `find_node` or `get_peers`.
+
+        Every reply's `nodes` become candidates, and the DHT_ALPHA closest
+        ones not yet asked are queried next. The lookup ends when nobody
+        closer than the DHT_BUCKET_SIZE closest nodes that answered is
+        left to ask, or at DHT_LOOKUP_TIMEOUT. Returns the peers found, and
+        the closest nodes that answered with the tokens they gave us.
+        """
+        key = int.from_bytes(target, "big")
+
+        def distance(node: Node) -> int:
+            return int.from_bytes(node.id, "big") ^ key
+
+        arguments = {"info_hash" if method == "get_peers" else "target": target}
+        candidates = {
+            node.address: node for node in (*seeds, *self.table.closest(target))
+        }
+        queried: set[tuple[str, int]] = set()
+        answered: dict[Node, Any] = {}  # The token each node gave us, if any.
+        peers: list[Peer] = []
+        pending: dict[asyncio.Task, Node] = {}
+        deadline = time.monotonic() + DHT_LOOKUP_TIMEOUT
+        try:
+            while True:
+                nearest = heapq.nsmallest(DHT_BUCKET_SIZE, answered, key=distance)
+                bound = (
+                    distance(nearest[-1]) if len(nearest) == DHT_BUCKET_SIZE else None
+                )
+                for node in sorted(candidates.values(), key=distance):
+                    if len(pending) >= DHT_ALPHA or (
+                        bound is not None and distance(node) > bound
+                    ):
+                        break
+                    if node.address in queried or node.id == self.id:
+                        continue
+                    queried.add(node.address)
+                    pending[
+                        asyncio.create_task(self.query(node.address, method, arguments))
+                    ] = node
+
+                timeout = deadline - time.monotonic()
+                if not pending or timeout <= 0:
+                    break
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    node = pending.pop(task)
+                    try:
+                        reply = task.result()
+                    except (KRPCError, asyncio.TimeoutError, OSError):
+                        self.table.fail(node.id)
+                        del candidates[node.address]
+                        continue
+                    answered[node] = reply.get(b"token")
+                    if isinstance(reply.get(b"nodes"), bytes):
+                        for found in Node.from_bytes(reply[b"nodes"]):
+                            candidates.setdefault(found.address, found)
+                    if isinstance(reply.get(b"values"), list):
+                        values = b"".join(
+                            v for v in reply[b"values"] if isinstance(v, bytes)
+                        )
+                        peers.extend(Peer.from_bytes(values))
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        closest = heapq.nsmallest(
+            DHT_BUCKET_SIZE, answered.items(), key=lambda item: distance(item[0])
+        )
+        return Peer.unique(peers), closest
+
+    async def query(
+        self, address: tuple[str, int], method: str, arguments: dict[str, Any]
+    ) -> dict[bytes, Any]:
+        """Sends one query and returns the reply's `r` dict, or raises KRPCError."""
+        if self.transport is None:
+            raise OSError("The DHT node is not running.")
+        # Random, so an off-path attacker can't guess it and forge the reply.
+        transaction = os.urandom(4)
+        while transaction in self.pending:
+            transaction = os.urandom(4)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction] = future, address
+        message = {
+            "t": transaction,
+            "y": "q",
+            "q": method,
+            "a": {"id": self.id, **arguments},
+        }
+        self.transport.sendto(bencode.encode(message), address)
+        try:
+            reply = await asyncio.wait_for(future, DHT_QUERY_TIMEOUT)
+        finally:
+            self.pending.pop(transaction, None)
+        node_id = reply.get(b"id")
+        if isinstance(node_id, bytes) and len(node_id) == 20:
+            self.table.add(Node(node_id, *address))
+        return reply
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]) -> None:
+        try:
+            message = bencode.decode(data)
+            transaction, kind = message[b"t"], message[b"y"]
+            if not isinstance(transaction, bytes):
+                return
+        except (bencode.BencodeError, KeyError, TypeError):
+            return  # Not KRPC.
+
+        if kind == b"q":
+            try:
+                reply = {
+                    "y": "r",
+                    "r": self.handle_query(message[b"q"], message[b"a"], address),
+                }
+            except KRPCError as e:
+                reply = {"y": "e", "e": [e.code, e.message]}
+            except (KeyError, TypeError, ValueError, OSError, struct.error):
+                reply = {"y": "e", "e": [203, "Protocol Error"]}
+            self.transport.sendto(bencode.encode({"t": transaction, **reply}), address)
+            return
+
+        future, queried = self.pending.get(transaction, (None, None))
+        if future is None or future.done() or queried != address:
+            return  # Late, not ours, or not from the node we asked.
+        if kind == b"r" and isinstance(message.get(b"r"), dict):
+            future.set_result(message[b"r"])
+        elif (
+            kind == b"e"
+            and isinstance(message.get(b"e"), list)
+            and len(message[b"e"]) == 2
+        ):
+            code, text = message[b"e"]
+            future.set_exception(KRPCError(code, bytes(text).decode(errors="replace")))
+        else:
+            future.set_exception(KRPCError(203, "Malformed reply."))
+
+    def error_received(self, exc: Exception) -> None:
+        pass  # E.g. ICMP port unreachable; the query it belongs to times out.
+
+    def handle_query(
+        self, method: bytes, arguments: dict[bytes, Any], address: tuple[str, int]
+    ) -> dict[str, Any]:
+        node_id = arguments[b"id"]
+        if not isinstance(node_id, bytes) or len(node_id) != 20:
+            raise KRPCError(203, "Bad node ID.")
+        self.table.add(Node(node_id, *address))
+
+        reply: dict[str, Any] = {"id": self.id}
+        match method:
+            case b"ping":
+                pass
+            case b"find_node":
+                reply["nodes"] = self.compact_closest(arguments[b"target"])
+            case b"get_peers":
+                info_hash = arguments[b"info_hash"]
+                reply["token"] = self.token(address[0])
+                reply["nodes"] = self.compact_closest(info_hash)
+                peers = self.announced_peers(info_hash)
+                if peers:
+                    reply["values"] = [peer.to_bytes() for peer in peers[-MAX_VALUES:]]
+            case b"announce_peer":
+                if not self.valid_token(arguments[b"token"], address[0]):
+                    raise KRPCError(203, "Bad token.")
+                port = (
+                    address[1] if arguments.get(b"implied_port") else arguments[b"port"]
+                )
+                # Stored as is, it would break every later get_peers reply.
+                if not isinstance(port, int) or not 0 < port < 65536:
+                    raise KRPCError(203, "Bad port.")
+                self.store_peer(arguments[b"info_hash"], Peer(address[0], port))
+            case _:
+                raise KRPCError(204, "Method Unknown")
+        return reply
+
+    def announced_peers(self, info_hash: bytes) -> list[Peer]:
+        """Peers announced for `info_hash` within PEER_LIFETIME; drops older ones."""
+        peers = self.announced.get(info_hash)
+        if peers is None:
+            return []
+        expired = time.monotonic() - PEER_LIFETIME
+        # Oldest first, so the expired ones are all at the front.
+        while peers and next(iter(peers.values())) < expired:
+            del peers[next(iter(peers))]
+        if not peers:
+            del self.announced[info_hash]
+        return list(peers)
+
+    def store_peer(self, info_hash: bytes, peer: Peer) -> None:
+        """Remembers an announced peer, evicting the stalest past our limits."""
+        if not isinstance(info_hash, bytes) or len(info_hash) != 20:
+            raise KRPCError(203, "Bad info hash.")
+        peers = self.announced.pop(info_hash, None)  # Re-inserted as the newest.
+        if peers is None:
+            for known in list(self.announced):
+                self.announced_peers(known)
+            if len(self.announced) >= MAX_ANNOUNCED_TORRENTS:
+                del self.announced[next(iter(self.announced))]
+            peers = {}
+        self.announced[info_hash] = peers
+        peers.pop(peer, None)
+        peers[peer] = time.monotonic()
+        if len(peers) > MAX_ANNOUNCED_PEERS:
+            del peers[next(iter(peers))]
+
+    def compact_closest(self, target: bytes) -> bytes:
+        if not isinstance(target, bytes) or len(target) != 20:
+            raise KRPCError(203, "Bad target.")
+        return b"".join(node.to_bytes() for node in self.table.closest(target))
+
+    def token(self, ip: str) -> bytes:
+        """A write token for announce_peer, tied to the asker's IP."""
+        self.rotate_secrets()
+        return sha1(self.secrets[0] + ip.encode()).digest()[:8]
+
+    def valid_token(self, token: Any, ip: str) -> bool:
+        self.rotate_secrets()
+        return any(
+            token == sha1(secret + ip.encode()).digest()[:8] for secret in self.secrets
+        )
+
+    def rotate_secrets(self) -> None:
+        if time.monotonic() - self.secret_rotated >= TOKEN_LIFETIME:
+            self.secrets = [os.urandom(16), self.secrets[0]]
+            self.secret_rotated = time.monotonic()
+
+    def load(self) -> None:
+        """Restores our ID and known nodes from DHT_STATE_FILE, if there is one."""
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, "rb") as file:
+                state = bencode.decode(file.read())
+        except (OSError, bencode.BencodeError):
+            return
+        if not isinstance(state, dict):
+            return
+        node_id = state.get(b"id")
+        if isinstance(node_id, bytes) and len(node_id) == 20:
+            self.id = node_id
+            self.table = RoutingTable(node_id)
+        if isinstance(state.get(b"nodes"), bytes):
+            for node in Node.from_bytes(state[b"nodes"]):
+                self.table.add(node)
+
+    def save(self) -> None:
+        """Writes our ID and known nodes to DHT_STATE_FILE; it's only a cache."""
+        if not self.state_file:
+            return
+        state = {
+            "id": self.id,
+            "nodes": b"".join(node.to_bytes() for node in self.table),
+        }
+        partial = self.state_file + ".part"
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            with open(partial, "wb") as file:
+                file.write(bencode.encode(state))
+            os.replace(partial, self.state_file)
+        except OSError as e:
+            print(f"Couldn't save the DHT state: {e!r}")
+
+
+@contextlib.asynccontextmanager
+async def start_dht(port: int = DHT_PORT) -> AsyncIterator[DHTNode | None]:
+    """Runs a DHT node for the block; yields None if it's off or can't get its port."""
+    if not DHT_ENABLED:
+        yield None
+        return
+    node = DHTNode(port)
+    try:
+        await node.start()
+    except OSError as e:
+        print(f"Not joining the DHT: {e!r}")
+        yield None
+        return
+    try:
+        yield node
+    finally:
+        await node.close()
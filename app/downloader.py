@@ -0,0 +1,481 @@
+"""
+Downloads a whole torrent by feeding pieces to a pool of peer sessions.
+"""
+
+import asyncio
+import struct
+import time
+from collections import Counter
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Iterable
+
+from app.choker import Choker
+from app.dht import DHTNode
+from app.models import Peer, Torrent
+from app.network import BlockRequests, PieceBuffer, TokenBucket
+from app.resume import ResumeFile, recheck
+from app.scheduler import PieceScheduler
+from app.server import PeerServer
+from app.session import ConnectionBudget, PeerPool
+from app.settings import (
+    DISK_WORKERS,
+    DOWNLOAD_RATE_LIMIT,
+    ENDGAME_BLOCKS_PER_PEER,
+    MAX_HASH_FAILURES,
+    MAX_PEER_RETRIES,
+    PEER_DOWNLOAD_RATE_LIMIT,
+    PEER_UPLOAD_RATE_LIMIT,
+    UPLOAD_RATE_LIMIT,
+)
+from app.stats import PIECE_BUCKETS, Histogram, MetricsServer, StatsReporter
+from app.storage import PieceCache, Storage, WriteBackCache
+from app.tracker import TrackerClient
+from app.verify import PieceVerifier
+
+
+@dataclass
+class Resources:
+    """
+    What downloads running side by side share.
+
+    A lone download gets its own. The daemon hands one set to all of its
+    torrents, so they take turns on one listening port, one DHT node, one
+    connection budget, one pool of disk writer threads and one pair of rate
+    limits.
+    """
+
+    server: PeerServer | None = None
+    connections: ConnectionBudget | None = None  # None is unlimited.
+    # None gives each download DISK_WORKERS threads of its own.
+    disk: Executor | None = None
+    download_limit: TokenBucket = field(
+        default_factory=lambda: TokenBucket(DOWNLOAD_RATE_LIMIT)
+    )
+    upload_limit: TokenBucket = field(
+        default_factory=lambda: TokenBucket(UPLOAD_RATE_LIMIT)
+    )
+    # What each new connection's own limits start at.
+    peer_download_rate: float | None = PEER_DOWNLOAD_RATE_LIMIT
+    peer_upload_rate: float | None = PEER_UPLOAD_RATE_LIMIT
+    dht: DHTNode | None = None  # None asks trackers only.
+
+
+class Download:
+    """One torrent being fetched into `output_file_path`."""
+
+    def __init__(
+        self,
+        torrent: Torrent,
+        output_file_path: str,
+        resources: Resources | None = None,
+    ) -> None:
+        self.torrent = torrent
+        self.output_file_path = output_file_path
+        self.resources = resources or Resources()
+        self.pool: PeerPool | None = None
+        self.tracker: TrackerClient | None = None
+        self.scheduler = PieceScheduler(len(torrent.pieces))
+        self.hash_failures: Counter[str] = Counter()
+        self.buffers: dict[int, PieceBuffer] = {}  # Pieces being downloaded.
+        self.write_cache: WriteBackCache | None = None
+        self.finishing: set[asyncio.Task] = set()
+        # Peers that connected to us; we can't redial them.
+        self.incoming: set[str] = set()
+        self.started = time.monotonic()
+        self.verify_time = Histogram()
+        self.disk_write_time = Histogram()
+        self.disk_sync_time = Histogram()
+        # From assigning a piece to storing it.
+        self.piece_time = Histogram(PIECE_BUCKETS)
+
+    async def run(self) -> None:
+        info_hash = bytes.fromhex(self.torrent.info_hash)
+        self.pool = PeerPool(
+            info_hash,
+            len(self.torrent.pieces),
+            download_limit=self.resources.download_limit,
+            upload_limit=self.resources.upload_limit,
+            connections=self.resources.connections,
+        )
+        self.pool.set_rate_limits(
+            peer_download=self.resources.peer_download_rate,
+            peer_upload=self.resources.peer_upload_rate,
+        )
+        self.pool.on_upload = self.count_upload
+        choker = Choker(self.pool)
+        self.verifier = PieceVerifier(self.torrent.pieces)
+        self.failed = asyncio.get_running_loop().create_future()
+        # Private torrents (BEP 27) must not leak onto the DHT.
+        dht = None if self.torrent.private else self.resources.dht
+        self.tracker = TrackerClient(self.torrent, dht, self.resources.server)
+        if dht is not None:
+            self.pool.on_dht_port = dht.add_contact
+        self.tracker.on_peers = self.add_peers
+        self.tracker.left = self.torrent.length
+        self.workers: dict[str, asyncio.Task] = {}
+        self.open()
+
+        finished = self.scheduler.finished
+        tasks = [asyncio.create_task(finished.wait())]
+        server = self.resources.server
+        try:
+            await self.restore()
+            if server:
+                server.register(info_hash, self.accept)
+            if not finished.is_set():
+                self.add_peers(await self.tracker.get_peers())
+                print(f"Found {len(self.torrent.peers)} peers.")
+                tasks.append(asyncio.create_task(self.tracker.run()))
+                tasks.append(asyncio.create_task(choker.run()))
+
+            while not finished.is_set() and not self.failed.done():
+                if all(worker.done() for worker in self.workers.values()):
+                    # Everyone dropped out; ask the tracker for a fresh batch.
+                    if not self.add_peers(await self.tracker.announce()):
+                        for worker in self.workers.values():
+                            worker.result()  # Re-raises whatever killed the workers.
+                        raise ConnectionError(
+                            f"Ran out of peers with {self.scheduler.pieces_left}"
+                            " pieces left."
+                        )
+                for task in tasks:
+                    if task.done():
+                        task.result()  # Re-raises whatever ended the tracker or choker.
+                # Finished tasks would end every wait at once, so leave them out.
+                pending = [
+                    task for task in (*tasks, *self.workers.values()) if not task.done()
+                ]
+                await asyncio.wait(
+                    [*pending, self.failed], return_when=asyncio.FIRST_COMPLETED
+                )
+            if self.failed.done():
+                self.failed.result()
+        finally:
+            if server:
+                server.unregister(info_hash)
+            tasks.extend(self.workers.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.pool.close()
+            # Let pieces already being hashed or written land before closing files.
+            await asyncio.gather(*self.finishing, return_exceptions=True)
+            self.verifier.close()
+            await self.close(finished.is_set())
+            await self.tracker.stop("completed" if finished.is_set() else "stopped")
+
+    def open(self) -> None:
+        """Sets up the output files, which we also upload verified pieces from."""
+        layout = self.torrent.file_layout(self.output_file_path)
+        self.storage = Storage(layout, self.torrent.piece_length)
+        self.disk = self.resources.disk or ThreadPoolExecutor(
+            DISK_WORKERS, thread_name_prefix="disk"
+        )
+        self.write_cache = WriteBackCache(
+            self.storage,
+            self.disk,
+            write_time=self.disk_write_time,
+            sync_time=self.disk_sync_time,
+        )
+        self.write_cache.on_drained = self.scheduler.wake
+        self.read_cache = PieceCache(
+            self.storage, self.torrent.get_piece_length, write_cache=self.write_cache
+        )
+        self.resume = ResumeFile(
+            self.output_file_path,
+            bytes.fromhex(self.torrent.info_hash),
+            len(self.torrent.pieces),
+        )
+        self.write_cache.on_durable = self.resume.mark_all
+        self.pool.have = self.scheduler.done
+        self.pool.read_piece = self.read_cache.get
+
+    async def restore(self) -> None:
+        """Creates the output files, taking over pieces an earlier run left in them."""
+        # On the disk threads: thousands of files, or big fallocates, would stall
+        # the event loop.
+        loop = asyncio.get_running_loop()
+        existing = await loop.run_in_executor(self.disk, self.storage.exists)
+        await loop.run_in_executor(self.disk, self.storage.preallocate)
+
+        if existing and self.resume.load():
+            done = list(self.resume.done)
+            print(f"♻️ Resuming with {len(done)} pieces from {self.resume.path}.")
+        elif existing:
+            print(f"🔍 Re-checking existing data in {self.output_file_path}...")
+            done = await recheck(
+                self.storage,
+                self.verifier,
+                (
+                    (piece_index, self.torrent.get_piece_length(piece_index))
+                    for piece_index in range(len(self.torrent.pieces))
+                ),
+            )
+            for piece_index in done:
+                self.resume.done.add(piece_index)
+            print(f"Found {len(done)} good pieces.")
+        else:
+            done = []
+
+        for piece_index in done:
+            self.scheduler.complete(piece_index)
+            self.tracker.left -= self.torrent.get_piece_length(piece_index)
+        self.resume.open()
+
+    async def store(self, piece: PieceBuffer) -> None:
+        """Queues a verified piece for writing and tells our peers we have it."""
+        await self.write_cache.put(piece.index, piece.data)
+        self.pool.broadcast_have(piece.index)
+
+    async def close(self, finished: bool) -> None:
+        try:
+            await self.write_cache.close()
+        except BaseException:
+            finished = False  # Keep the resume file; not every piece reached the disk.
+            raise
+        finally:
+            self.storage.close()
+            if self.disk is not self.resources.disk:
+                self.disk.shutdown(wait=False)
+            if finished:
+                self.resume.remove()
+            else:
+                self.resume.close()
+
+    def status(self) -> dict[str, Any]:
+        """A snapshot of progress, for the daemon's control API."""
+        status: dict[str, Any] = {
+            "name": self.torrent.name,
+            "info_hash": self.torrent.info_hash,
+            "pieces": len(self.torrent.pieces),
+            "pieces_done": self.scheduler.done.count(),
+        }
+        if self.tracker is not None:
+            status["downloaded"] = self.tracker.downloaded
+            status["uploaded"] = self.tracker.uploaded
+            status["left"] = self.tracker.left
+        if self.pool is not None:
+            status["peers"] = sum(s.connected for s in self.pool.sessions.values())
+        return status
+
+    def stats(self) -> dict[str, Any]:
+        """`status` plus rates, latency histograms and per-peer counters."""
+        sessions = (
+            [s for s in self.pool.sessions.values() if s.connected] if self.pool else []
+        )
+        peers = [session.stats() for session in sessions]
+        stats = self.status()
+        stats.update(
+            elapsed=round(time.monotonic() - self.started, 3),
+            peers=len(peers),
+            download_rate=round(sum(peer["download_rate"] for peer in peers), 1),
+            upload_rate=round(sum(peer["upload_rate"] for peer in peers), 1),
+            hash_failures=sum(self.hash_failures.values()),
+            verify_seconds=self.verify_time.to_dict(),
+            disk_write_seconds=self.disk_write_time.to_dict(),
+            disk_sync_seconds=self.disk_sync_time.to_dict(),
+            disk_cache_bytes=self.write_cache.size if self.write_cache else 0,
+            piece_seconds=self.piece_time.to_dict(),
+            peer_stats=peers,
+        )
+        return stats
+
+    def add_peers(self, peers: list[Peer]) -> int:
+        """Starts workers for peers we aren't already talking to."""
+        started = 0
+        for peer in peers:
+            worker = self.workers.get(str(peer))
+            if (worker and not worker.done()) or self.banned(peer):
+                continue
+            self.workers[str(peer)] = asyncio.create_task(self.worker(peer))
+            started += 1
+        return started
+
+    async def accept(
+        self, peer: Peer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Adopts a connection a peer opened to us and starts a worker on it."""
+        key = str(peer)
+        if self.banned(peer) or key in self.workers and not self.workers[key].done():
+            writer.close()
+            return
+        await self.pool.accept(peer, reader, writer)
+        self.incoming.add(key)
+        self.workers[key] = asyncio.create_task(self.worker(peer))
+
+    def count_upload(self, length: int) -> None:
+        self.tracker.uploaded += length
+
+    def banned(self, peer: Peer) -> bool:
+        return self.hash_failures[str(peer)] >= MAX_HASH_FAILURES
+
+    def next_piece(self, peer: Peer, requests: BlockRequests) -> PieceBuffer | None:
+        key = str(peer)
+        if self.banned(peer):
+            return None
+        if self.write_cache is not None and self.write_cache.full:
+            return None  # Nothing new until the disk catches up; `wake` follows.
+
+        piece_index = self.scheduler.next_piece(key)
+        if piece_index is not None:
+            if piece_index not in self.buffers:
+                piece_length = self.torrent.get_piece_length(piece_index)
+                self.buffers[piece_index] = PieceBuffer(piece_index, piece_length)
+            return self.buffers[piece_index]
+
+        if self.in_endgame():
+            return self.endgame_piece(key, requests)
+        return None
+
+    def in_endgame(self) -> bool:
+        """
+        True once every piece is being downloaded and few enough blocks are
+        missing that fetching some twice beats waiting on the slowest peer.
+        """
+        if not self.scheduler.all_assigned:
+            return False
+        missing = sum(len(piece.missing) for piece in self.endgame_candidates())
+        peers = sum(session.connected for session in self.pool.sessions.values())
+        return missing <= ENDGAME_BLOCKS_PER_PEER * max(peers, 1)
+
+    def endgame_piece(self, key: str, requests: BlockRequests) -> PieceBuffer | None:
+        """
+        Picks an in-progress piece to duplicate once nothing is left unassigned.
+
+        Prefers the piece the fewest connections are already fetching, so a
+        single slow peer cannot hold up the end of the download.
+        """
+        bitfield = self.scheduler.peer_pieces.get(key)
+        candidates = [
+            piece
+            for piece in self.endgame_candidates()
+            if bitfield is not None
+            and piece.index in bitfield
+            and key not in self.scheduler.bad_sources.get(piece.index, ())
+            and piece.unrequested(requests)
+        ]
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda piece: len(set().union(*piece.requested_by.values())),
+        )
+
+    def endgame_candidates(self) -> Iterable[PieceBuffer]:
+        return self.buffers.values()
+
+    async def worker(self, peer: Peer) -> None:
+        """Keeps one session busy with whatever the scheduler hands it."""
+        key = str(peer)
+        failures = 0
+        claimed: set[int] = set()  # Pieces this peer took on and hasn't finished.
+        while not self.banned(peer) and not self.scheduler.finished.is_set():
+            # Grabbed up front so work released while we drain is not missed.
+            changed = self.scheduler.changed
+            idle = True
+
+            def next_piece(requests: BlockRequests) -> PieceBuffer | None:
+                nonlocal idle
+                piece = self.next_piece(peer, requests)
+                if piece is not None:
+                    claimed.add(piece.index)
+                    idle = False
+                return piece
+
+            try:
+                session = await self.pool.get(peer)
+                if key not in self.scheduler.peer_pieces:
+                    session.on_have = lambda piece_index: self.scheduler.have(
+                        key, piece_index
+                    )
+                    self.scheduler.add_peer(key, session.bitfield)
+
+                async for piece in session.download_pieces(next_piece):
+                    failures = 0
+                    claimed.discard(piece.index)
+                    self.buffers.pop(piece.index, None)
+                    if self.in_endgame():
+                        self.scheduler.wake()  # Idle peers can help with the rest.
+                    task = asyncio.create_task(self.finish_piece(piece))
+                    self.finishing.add(task)
+                    task.add_done_callback(self.finishing.discard)
+
+                if idle:
+                    # Nothing this peer can give us right now, or it choked us.
+                    await session.wait_idle(changed)
+            except (OSError, EOFError, ValueError, struct.error) as e:
+                print(f"Lost connection to {peer}: {e!r}")
+                await self.pool.evict(peer)
+                self.scheduler.remove_peer(key)
+                for piece_index in claimed:
+                    piece = self.buffers.get(piece_index)
+                    # Blocks already received stay in the buffer for the next peer.
+                    if piece and not any(piece.requested_by.values()):
+                        self.scheduler.release(piece_index)
+                claimed.clear()
+                failures += 1
+                if failures > MAX_PEER_RETRIES or key in self.incoming:
+                    return
+
+        if self.banned(peer):
+            print(f"🚫 Dropping {peer} after {MAX_HASH_FAILURES} corrupt pieces.")
+        self.scheduler.remove_peer(key)
+        await self.pool.evict(peer)
+
+    async def finish_piece(self, piece: PieceBuffer) -> None:
+        """Hashes a downloaded piece off the loop and stores it if it is intact."""
+        try:
+            started = time.monotonic()
+            intact = await self.verifier.verify(piece.index, piece.data)
+            self.verify_time.observe(time.monotonic() - started)
+            if intact:
+                await self.store(piece)
+                self.piece_time.observe(time.monotonic() - piece.created)
+                self.scheduler.complete(piece.index)
+                self.tracker.downloaded += len(piece.data)
+                self.tracker.left -= len(piece.data)
+                return
+        except Exception as e:
+            if not self.failed.done():
+                self.failed.set_exception(e)
+            return
+
+        sources = ", ".join(sorted(piece.sources))
+        print(f"❌ Piece {piece.index} from {sources} failed the hash check.")
+        for source in piece.sources:
+            self.hash_failures[source] += 1
+        # Only rule a peer out for this piece when it alone could have corrupted it.
+        bad_source = next(iter(piece.sources)) if len(piece.sources) == 1 else None
+        self.scheduler.release(piece.index, bad_source=bad_source)
+
+
+async def run_with_server(download: Download) -> None:
+    """Runs a download while accepting incoming peers for it, reporting its progress."""
+    server = PeerServer()
+    try:
+        await server.start()
+    except OSError as e:
+        print(f"Not accepting incoming peers: {e!r}")
+    download.resources.server = server
+    reporter = StatsReporter(lambda: [download.stats()])
+    metrics = MetricsServer(lambda: [download.stats()])
+    await metrics.start()
+    reporting = asyncio.create_task(reporter.run())
+    try:
+        await download.run()
+    finally:
+        reporting.cancel()
+        await asyncio.gather(reporting, return_exceptions=True)
+        try:
+            reporter.report()  # The final tally.
+        except OSError as e:
+            print(f"Couldn't write the final stats: {e!r}")
+        await metrics.close()
+        await server.close()
+
+
+async def download_torrent(
+    torrent: Torrent, output_file_path: str, dht: DHTNode | None = None
+) -> None:
+    await run_with_server(Download(torrent, output_file_path, Resources(dht=dht)))
@@ -1,21 +1,24 @@
 import asyncio
-import itertools
 import json
 import os
 import sys
 
 import bencodepy  # type: ignore
 
+from app.daemon import Daemon, control
+from app.dht import start_dht
+from app.downloader import download_torrent
+from app.metadata import resolve_magnet
 from app.models import Peer, Torrent
 from app.network import (
-    download_piece,
     perform_extension_handshake,
     perform_handshake,
     perform_handshake_standalone,
-    read_data_message,
     read_message,
-    send_request_metadata_message,
 )
+from app.session import download_piece
+from app.stream import stream_torrent
+from app.tracker import TrackerClient
 
 bc = bencodepy.BencodeDecoder(encoding="utf-8")
 
@@ -41,8 +44,8 @@ async def main():
 
         case "handshake":
             torrent = Torrent.from_file(sys.argv[2])
-            ip, port = sys.argv[3].split(":")
-            peer = Peer(ip=ip, port=port)
+            ip, port = sys.argv[3].rsplit(":", 1)
+            peer = Peer(ip=ip.strip("[]"), port=int(port))
             await perform_handshake_standalone(peer, torrent.info_hash)
 
         case "download_piece":
@@ -51,43 +54,16 @@ async def main():
             print(f"Total number of pieces: {len(torrent.pieces)}")
             piece_index = int(sys.argv[5])
             await download_piece(torrent, piece_index, output_file_path)
-            os.rename(f"{output_file_path}.part{piece_index}", output_file_path)
+
+        case "download" if sys.argv[2] == "--stream":
+            torrent = Torrent.from_file(sys.argv[4])
+            await stream_torrent(torrent, sys.argv[3])
 
         case "download":
             output_file_path = sys.argv[3]
             torrent = Torrent.from_file(sys.argv[4])
-            torrent.get_peers()
-
             print(f"Total number of pieces: {len(torrent.pieces)}")
-            print(f"Found {len(torrent.peers)} peers.")
-
-            peers_cycle = itertools.cycle(torrent.peers)
-            tasks = []
-
-            for piece_index in range(len(torrent.pieces)):
-                peer = next(peers_cycle)
-                tasks.append(
-                    asyncio.create_task(
-                        download_piece(torrent, piece_index, output_file_path, peer)
-                    )
-                )
-
-                # Limit the number of concurrent tasks based on the number of peers.
-                if len(tasks) >= len(torrent.peers):
-                    done, pending = await asyncio.wait(
-                        tasks, return_when=asyncio.FIRST_COMPLETED
-                    )
-                    tasks = list(pending)  # Reassign pending tasks to tasks.
-
-            # Wait for any remaining tasks to complete.
-            await asyncio.gather(*tasks)
-
-            with open(output_file_path, "wb") as final_file:
-                for piece_index in range(len(torrent.pieces)):
-                    piece_file_name = f"{output_file_path}.part{piece_index}"
-                    with open(piece_file_name, "rb") as piece_file:
-                        final_file.write(piece_file.read())
-                    os.remove(piece_file_name)
+            await download_torrent(torrent, output_file_path)
 
         case "magnet_parse":
             magnet_link = sys.argv[2]
@@ -96,8 +72,9 @@ async def main():
         case "magnet_handshake":
             magnet_link = sys.argv[2]
             torrent = Torrent.from_magnet_link(magnet_link)
-            torrent.get_peers()
-            peer = torrent.peers[0]
+            async with start_dht() as dht:
+                peers = await TrackerClient(torrent, dht).get_peers()
+            peer = peers[0]
 
             reader, writer = await asyncio.open_connection(peer.ip, int(peer.port))
             await perform_handshake(
@@ -118,27 +95,10 @@ async def main():
         case "magnet_info":
             magnet_link = sys.argv[2]
             torrent = Torrent.from_magnet_link(magnet_link)
-            torrent.get_peers()
-            peer = torrent.peers[0]
-
-            reader, writer = await asyncio.open_connection(peer.ip, int(peer.port))
-            await perform_handshake(
-                info_hash=bytes.fromhex(torrent.info_hash),
-                writer=writer,
-                reader=reader,
-                signal_extensions=True,
-            )
-
-            await read_message(5, writer=writer, reader=reader)
-            await perform_extension_handshake(writer=writer, reader=reader)
-            await send_request_metadata_message(writer=writer)
-            info_dict = await read_data_message(writer=writer, reader=reader)
-
-            writer.close()
-            await writer.wait_closed()
+            async with start_dht() as dht:
+                await resolve_magnet(torrent, dht)
 
             print("--------------------------------------------------")
-            torrent.populate_info_from_dict(info_dict)
             torrent.print_info()
 
         case "magnet_download_piece":
@@ -146,87 +106,48 @@ async def main():
             magnet_link = sys.argv[4]
 
             torrent = Torrent.from_magnet_link(magnet_link)
-            torrent.get_peers()
-            peer = torrent.peers[0]
-
-            reader, writer = await asyncio.open_connection(peer.ip, int(peer.port))
-            await perform_handshake(
-                info_hash=bytes.fromhex(torrent.info_hash),
-                writer=writer,
-                reader=reader,
-                signal_extensions=True,
-            )
-
-            await read_message(5, writer=writer, reader=reader)
-            await perform_extension_handshake(writer=writer, reader=reader)
-            await send_request_metadata_message(writer=writer)
-            info_dict = await read_data_message(writer=writer, reader=reader)
-
-            writer.close()
-            await writer.wait_closed()
-
-            torrent.populate_info_from_dict(info_dict)
+            async with start_dht() as dht:
+                await resolve_magnet(torrent, dht)
             print(f"Total number of pieces: {len(torrent.pieces)}")
             piece_index = int(sys.argv[5])
             await download_piece(torrent, piece_index, output_file_path)
 
-            os.rename(f"{output_file_path}.part{piece_index}", output_file_path)
-
         case "magnet_download":
             output_file_path = sys.argv[3]
             magnet_link = sys.argv[4]
 
             torrent = Torrent.from_magnet_link(magnet_link)
-            torrent.get_peers()
-            peer = torrent.peers[0]
-
-            reader, writer = await asyncio.open_connection(peer.ip, int(peer.port))
-            await perform_handshake(
-                info_hash=bytes.fromhex(torrent.info_hash),
-                writer=writer,
-                reader=reader,
-                signal_extensions=True,
-            )
-
-            await read_message(5, writer=writer, reader=reader)
-            await perform_extension_handshake(writer=writer, reader=reader)
-            await send_request_metadata_message(writer=writer)
-            info_dict = await read_data_message(writer=writer, reader=reader)
-
-            writer.close()
-            await writer.wait_closed()
-
-            torrent.populate_info_from_dict(info_dict)
-            print(f"Total number of pieces: {len(torrent.pieces)}")
-            print(f"Found {len(torrent.peers)} peers.")
-
-            peers_cycle = itertools.cycle(torrent.peers)
-            tasks = []
-
-            for piece_index in range(len(torrent.pieces)):
-                peer = next(peers_cycle)
-                tasks.append(
-                    asyncio.create_task(
-                        download_piece(torrent, piece_index, output_file_path, peer)
+            async with start_dht() as dht:
+                await resolve_magnet(torrent, dht)
+                print(f"Total number of pieces: {len(torrent.pieces)}")
+                await download_torrent(torrent, output_file_path, dht)
+
+        case "daemon":
+            await Daemon(*sys.argv[2:3]).serve_forever()
+
+        case "control":
+            request: dict = {"command": sys.argv[2]}
+            match sys.argv[2:]:
+                case ["add", source, output_file_path]:
+                    if not source.startswith("magnet:"):
+                        source = os.path.abspath(source)
+                    request.update(
+                        torrent=source, output=os.path.abspath(output_file_path)
                     )
-                )
-
-                # Limit the number of concurrent tasks based on the number of peers.
-                if len(tasks) >= len(torrent.peers):
-                    done, pending = await asyncio.wait(
-                        tasks, return_when=asyncio.FIRST_COMPLETED
+                case ["status" | "stats" | "pause" | "resume" | "remove", info_hash]:
+                    request["info_hash"] = info_hash
+                case ["limits", *rates] if len(rates) in (2, 4):
+                    # Global, then optionally per-peer, bytes per second: 0 lifts
+                    # a limit and "-" leaves it as it is.
+                    names = ("download", "upload", "peer_download", "peer_upload")
+                    request.update(
+                        {
+                            name: float(rate) or None
+                            for name, rate in zip(names, rates)
+                            if rate != "-"
+                        }
                     )
-                    tasks = list(pending)  # Reassign pending tasks to tasks.
-
-            # Wait for any remaining tasks to complete.
-            await asyncio.gather(*tasks)
-
-            with open(output_file_path, "wb") as final_file:
-                for piece_index in range(len(torrent.pieces)):
-                    piece_file_name = f"{output_file_path}.part{piece_index}"
-                    with open(piece_file_name, "rb") as piece_file:
-                        final_file.write(piece_file.read())
-                    os.remove(piece_file_name)
+            print(json.dumps(await control(request), indent=2))
 
         case _:
             raise NotImplementedError(f"Unknown command {command}")
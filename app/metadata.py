@@ -0,0 +1,204 @@
+"""
+Fetches a magnet link's info dict from the swarm (BEP 9, ut_metadata).
+
+The info dict is split into 16 KiB pieces. Several peers are asked at once,
+each taking pieces off a shared queue, and the assembled dict only counts
+once its SHA-1 matches the magnet's info hash.
+"""
+
+import asyncio
+import itertools
+import math
+from collections import deque
+from hashlib import sha1
+
+from app import bencode
+from app.cache import MetadataCache
+from app.dht import DHTNode
+from app.models import Message, Peer, Torrent
+from app.network import MessageReader, perform_handshake
+from app.settings import (
+    CONNECT_TIMEOUT,
+    METADATA_PEERS,
+    METADATA_REQUESTS_PER_PEER,
+    METADATA_TIMEOUT,
+)
+from app.tracker import TrackerClient
+
+METADATA_PIECE_LENGTH = 16 * 1024
+# No real info dict comes close; stops a peer from making us allocate gigabytes.
+MAX_METADATA_SIZE = 64 * 1024 * 1024
+# The ID we ask peers to tag their ut_metadata messages to us with.
+UT_METADATA_ID = 69
+
+
+class MetadataFetch:
+    def __init__(self, info_hash: bytes) -> None:
+        self.info_hash = info_hash
+        self.size: int | None = None
+        self.pieces: list[bytes | None] = []
+        self.unassigned: deque[int] = deque()
+        self.result: asyncio.Future[bytes] = asyncio.get_running_loop().create_future()
+
+    async def run(self, peers: list[Peer]) -> bytes:
+        """Returns the raw, verified info dict, from METADATA_PEERS peers at a time."""
+        remaining = iter(peers)
+        tasks: dict[asyncio.Task, Peer] = {}
+        try:
+            while not self.result.done():
+                for peer in itertools.islice(remaining, METADATA_PEERS - len(tasks)):
+                    tasks[asyncio.create_task(self.fetch_from(peer))] = peer
+                if not tasks:
+                    raise ConnectionError(
+                        "Ran out of peers before the metadata was complete."
+                    )
+
+                await asyncio.wait(
+                    [self.result, *tasks], return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in [task for task in tasks if task.done()]:
+                    peer = tasks.pop(task)
+                    if task.exception() and not self.result.done():
+                        print(
+                            f"Could not get metadata from {peer}: {task.exception()!r}"
+                        )
+            return self.result.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def set_size(self, size: int) -> None:
+        if self.size is None:
+            if not 0 < size <= MAX_METADATA_SIZE:
+                raise ValueError(f"Peer claims the metadata is {size} bytes.")
+            self.size = size
+            number_of_pieces = math.ceil(size / METADATA_PIECE_LENGTH)
+            self.pieces = [None] * number_of_pieces
+            self.unassigned.extend(range(number_of_pieces))
+        elif size != self.size:
+            raise ValueError(
+                f"Peer says the metadata is {size} bytes, not {self.size}."
+            )
+
+    def next_piece(self, requested: set[int]) -> int | None:
+        """
+        A piece for one peer to ask for next.
+
+        Unassigned pieces come first; once they are all out, a peer may
+        duplicate a piece someone else is still fetching.
+        """
+        while self.unassigned:
+            piece_index = self.unassigned.popleft()
+            if self.pieces[piece_index] is None:
+                return piece_index
+        for piece_index, piece in enumerate(self.pieces):
+            if piece is None and piece_index not in requested:
+                return piece_index
+        return None
+
+    def add_piece(self, piece_index: int, data: bytes) -> None:
+        expected = min(
+            METADATA_PIECE_LENGTH, self.size - piece_index * METADATA_PIECE_LENGTH
+        )
+        if len(data) != expected:
+            raise ValueError(
+                f"Metadata piece {piece_index} is {len(data)} bytes, not {expected}."
+            )
+        self.pieces[piece_index] = data
+        if any(piece is None for piece in self.pieces):
+            return
+
+        metadata = b"".join(self.pieces)
+        if sha1(metadata).digest() != self.info_hash:
+            # No telling which peer lied; start over.
+            self.pieces = [None] * len(self.pieces)
+            self.unassigned.extend(range(len(self.pieces)))
+            raise ValueError("Metadata does not match the info hash.")
+        self.result.set_result(metadata)
+
+    async def fetch_from(self, peer: Peer) -> None:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(peer.ip, int(peer.port)), CONNECT_TIMEOUT
+        )
+        requested: set[int] = set()
+        try:
+            await perform_handshake(
+                self.info_hash, writer, reader, signal_extensions=True
+            )
+            handshake = {"m": {"ut_metadata": UT_METADATA_ID}}
+            writer.write(
+                Message(id=20, payload=b"\x00" + bencode.encode(handshake)).to_bytes()
+            )
+            await writer.drain()
+
+            messages = MessageReader(reader)
+            peer_ut_metadata = None
+            while not self.result.done():
+                if peer_ut_metadata is not None:
+                    while len(requested) < METADATA_REQUESTS_PER_PEER:
+                        piece_index = self.next_piece(requested)
+                        if piece_index is None:
+                            break
+                        request = {"msg_type": 0, "piece": piece_index}
+                        payload = bytes([peer_ut_metadata]) + bencode.encode(request)
+                        writer.write(Message(id=20, payload=payload).to_bytes())
+                        requested.add(piece_index)
+                    await writer.drain()
+
+                with await asyncio.wait_for(
+                    messages.read(), METADATA_TIMEOUT
+                ) as message:
+                    if len(message) < 2 or message[0] != 20:
+                        continue  # Keep-alives, BITFIELD, HAVE and so on.
+                    payload = bytes(message[2:])
+                    extension_id = message[1]
+
+                if extension_id == 0:
+                    response = bencode.decode(payload)
+                    peer_ut_metadata = response.get(b"m", {}).get(b"ut_metadata")
+                    if not peer_ut_metadata:
+                        raise ValueError(f"{peer} does not support ut_metadata.")
+                    self.set_size(response.get(b"metadata_size", 0))
+                elif extension_id == UT_METADATA_ID:
+                    header, end = bencode.decode_prefix(payload)
+                    piece_index = header.get(b"piece")
+                    if piece_index not in requested:
+                        continue
+                    requested.discard(piece_index)
+                    if header.get(b"msg_type") == 2:
+                        self.unassigned.appendleft(piece_index)
+                        raise ValueError(
+                            f"{peer} rejected metadata piece {piece_index}."
+                        )
+                    if header.get(b"msg_type") == 1:
+                        self.add_piece(piece_index, payload[end:])
+        finally:
+            for piece_index in requested:
+                if self.pieces[piece_index] is None:
+                    self.unassigned.appendleft(piece_index)
+            writer.close()
+
+
+async def fetch_metadata(info_hash: bytes, peers: list[Peer]) -> bytes:
+    return await MetadataFetch(info_hash).run(peers)
+
+
+async def resolve_magnet(torrent: Torrent, dht: DHTNode | None = None) -> None:
+    """
+    Fills in a magnet torrent's info dict from the peers its trackers, or the DHT, know.
+
+    Does nothing if `Torrent.from_magnet_link` already found it in the cache;
+    otherwise the fetched metadata is cached for next time.
+    """
+    if torrent.pieces is not None:
+        return
+    info_hash = bytes.fromhex(torrent.info_hash)
+    peers = await TrackerClient(torrent, dht).get_peers()
+    metadata = await fetch_metadata(info_hash, peers)
+    try:
+        MetadataCache().put(info_hash, metadata, torrent.tracker_url)
+    except OSError as e:
+        print(f"Couldn't cache the metadata: {e!r}")  # Verified already; carry on.
+    torrent.info = bencode.decode(metadata, lazy=True)
+    torrent.populate_info_from_dict(torrent.info)
@@ -1,13 +1,22 @@
+import os
+import socket
 import struct
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from hashlib import sha1
-from typing import Any
+from typing import Any, Iterable, Iterator, Mapping
 from urllib.parse import parse_qs, urlparse
 
-import bencodepy  # type: ignore
 import requests
 
-from app.settings import PEER_ID
+from app import bencode
+from app.cache import MetadataCache
+from app.settings import (
+    DEFAULT_ANNOUNCE_INTERVAL,
+    LISTEN_PORT,
+    PEER_ID,
+    TRACKER_TIMEOUT,
+)
 
 
 @dataclass
@@ -20,78 +29,195 @@ class Message:
         return struct.pack(">IB", length, self.id) + self.payload
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Peer:
     ip: str
     port: int
 
     def __str__(self) -> str:
+        if ":" in self.ip:
+            return f"[{self.ip}]:{self.port}"
         return f"{self.ip}:{self.port}"
 
+    def to_bytes(self) -> bytes:
+        """The compact IPv4 form `from_bytes` reads."""
+        return socket.inet_aton(self.ip) + struct.pack(">H", self.port)
+
     @classmethod
     def from_bytes(cls, peers: bytes) -> list["Peer"]:
-        decoded_peers = []
-        while peers:
-            ip = ".".join(str(x) for x in peers[:4])
-            port = int.from_bytes(peers[4:6], byteorder="big")
-            decoded_peers.append(cls(ip=ip, port=port))
-            peers = peers[6:]
+        """Parses a compact IPv4 peer list: 4 address bytes and a port each."""
+        peers = peers[: len(peers) - len(peers) % 6]
+        return cls.unique(
+            cls(socket.inet_ntoa(ip), port)
+            for ip, port in struct.iter_unpack(">4sH", peers)
+        )
+
+    @classmethod
+    def from_bytes6(cls, peers: bytes) -> list["Peer"]:
+        """Parses a compact IPv6 peer list (`peers6`): 16 address bytes, then a port."""
+        peers = peers[: len(peers) - len(peers) % 18]
+        return cls.unique(
+            cls(socket.inet_ntop(socket.AF_INET6, ip), port)
+            for ip, port in struct.iter_unpack(">16sH", peers)
+        )
+
+    @classmethod
+    def from_list(cls, peers: list[dict]) -> list["Peer"]:
+        """Parses the non-compact list of dicts that some trackers still send."""
+        return cls.unique(
+            cls(peer[b"ip"].decode(), peer[b"port"]) for peer in peers if b"ip" in peer
+        )
+
+    @staticmethod
+    def unique(peers: Iterable["Peer"]) -> list["Peer"]:
+        """Drops repeats, keeping the tracker's order."""
+        return list(dict.fromkeys(peers))
+
+
+class PieceHashes:
+    """
+    The info dict's `pieces` string, indexed as 20-byte SHA-1 digests.
+
+    Kept as the one buffer the torrent came with (a memoryview into the
+    `.torrent` file when decoded lazily) rather than a list of per-piece
+    objects, so a torrent with 100k pieces costs 2 MB, not 10.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes | memoryview) -> None:
+        if len(data) % 20:
+            raise ValueError(
+                f"Piece hashes are {len(data)} bytes, not a multiple of 20."
+            )
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.data) // 20
+
+    def __getitem__(self, piece_index: int) -> bytes:
+        if piece_index < 0:
+            piece_index += len(self)
+        if not 0 <= piece_index < len(self):
+            raise IndexError(f"{piece_index=} is out of range for {len(self)} pieces.")
+        return bytes(self.data[piece_index * 20 : piece_index * 20 + 20])
+
+    def __iter__(self) -> Iterator[bytes]:
+        for offset in range(0, len(self.data), 20):
+            yield bytes(self.data[offset : offset + 20])
+
+
+@dataclass
+class TorrentFile:
+    path: list[str]  # Components below the torrent's name directory.
+    length: int
+    offset: int  # Where the file starts in the torrent's concatenated data.
 
-        return decoded_peers
+    @classmethod
+    def from_list(cls, files: list[dict]) -> list["TorrentFile"]:
+        """Parses an info dict's `files` list, numbering each file's byte offset."""
+        index = []
+        offset = 0
+        for file in files:
+            path = [
+                bytes(component).decode("utf-8", errors="replace")
+                for component in file[b"path"]
+            ]
+            for component in path:
+                check_path_component(component)
+            index.append(cls(path=path, length=file[b"length"], offset=offset))
+            offset += file[b"length"]
+        return index
+
+
+def check_path_component(component: str) -> None:
+    """Rejects names that would escape the download directory."""
+    if component in ("", ".", "..") or "/" in component or "\\" in component:
+        raise ValueError(f"Unsafe path component {component!r} in torrent.")
 
 
 @dataclass
 class Torrent:
-    tracker_url: str
+    tracker_url: str  # The first of `trackers`, or "" for none.
     info_hash: str
-    info: dict | None = None
+    info: Mapping | None = None
     length: int | None = None
     piece_length: int | None = None
-    pieces: list[bytes] | None = None
-    decoded_value: dict | None = None
+    pieces: PieceHashes | None = None
+    name: str | None = None
+    files: list[TorrentFile] | None = None  # None for single-file torrents.
+    decoded_value: Mapping | None = None
     peers: list[Peer] | None = None
+    announce_interval: int = DEFAULT_ANNOUNCE_INTERVAL
+    peers_expire_at: float = 0.0
+    # Every announce URL, all used at once.
+    trackers: list[str] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        if not self.trackers and self.tracker_url:
+            self.trackers = [self.tracker_url]
+
+    @property
+    def private(self) -> bool:
+        """Private torrents (BEP 27) get peers from their trackers, never the DHT."""
+        return self.info is not None and self.info.get(b"private") == 1
 
     @classmethod
     def from_file(cls, file_path: str) -> "Torrent":
         with open(file_path, "rb") as file:
-            torrent_data = bencodepy.decode(file.read())
-
-        tracker_url = torrent_data.get(b"announce", b"").decode("utf-8")
-        info: dict = torrent_data.get(b"info", {})
-        piece_length = info.get(b"piece length", 0)
-        pieces = []
-        pieces_data = info[b"pieces"]
-        for i in range(0, len(pieces_data), 20):
-            pieces.append(pieces_data[i : i + 20].hex())
-        length = info[b"length"]
-
-        return cls(
-            tracker_url=tracker_url,
-            info=info,
-            info_hash=cls.calculate_sha1(info),
-            length=length,
-            piece_length=piece_length,
-            pieces=pieces,
+            torrent_data = bencode.decode(file.read(), lazy=True)
+        if (
+            not isinstance(torrent_data, bencode.LazyDict)
+            or b"info" not in torrent_data
+        ):
+            raise ValueError(f"{file_path} is not a .torrent file.")
+
+        # `announce-list` (BEP 12) comes in tiers; we announce to every URL in all
+        # of them.
+        urls = [torrent_data.get(b"announce", b"")]
+        for tier in torrent_data.get(b"announce-list", []):
+            urls.extend(tier)
+        trackers = list(
+            dict.fromkeys(bytes(url).decode("utf-8") for url in urls if url)
+        )
+        torrent = cls(
+            tracker_url=trackers[0] if trackers else "",
+            trackers=trackers,
+            info=torrent_data[b"info"],
+            # Hashed as it appears in the file; re-encoding could change the bytes.
+            info_hash=sha1(torrent_data.raw(b"info")).hexdigest(),
             decoded_value=torrent_data,
         )
+        torrent.populate_info_from_dict(torrent.info)
+        return torrent
 
     @classmethod
     def from_magnet_link(cls, magnet_link: str) -> "Torrent":
         parsed = urlparse(magnet_link)
         params = parse_qs(parsed.query)
 
-        tracker_url = params.get("tr", [""])[0]
+        trackers = list(dict.fromkeys(params.get("tr", [])))
         info_hash = params.get("xt", [""])[0][9:]
 
-        print("Tracker URL:", tracker_url)
+        print("Tracker URL:", trackers[0] if trackers else "")
         print("Info Hash:", info_hash)
 
-        return cls(tracker_url=tracker_url, info_hash=info_hash)
+        torrent = cls(
+            tracker_url=trackers[0] if trackers else "",
+            info_hash=info_hash,
+            trackers=trackers,
+        )
+        cached = MetadataCache().get(bytes.fromhex(info_hash))
+        if cached is not None:
+            torrent.info = cached[b"info"]
+            torrent.populate_info_from_dict(torrent.info)
+        return torrent
 
-    @staticmethod
-    def calculate_sha1(data: dict) -> str:
-        bencoded_info = bencodepy.encode(data)
-        return sha1(bencoded_info).hexdigest()
+    def get_piece_length(self, piece_index: int) -> int:
+        """Length of a piece; the last one is usually shorter."""
+        if piece_index == len(self.pieces) - 1:
+            return self.length - (self.piece_length * piece_index)
+        return self.piece_length
 
     def print_info(self) -> None:
         print("Tracker URL:", self.tracker_url)
@@ -103,35 +229,108 @@ class Torrent:
             print("No pieces.")
             return
         for piece in self.pieces:
-            print(piece)
+            print(piece.hex())
 
-    def get_peers(self) -> list[Peer]:
-        url_encoded_info_hash = bytes.fromhex(self.info_hash)
-        params = {
-            "info_hash": url_encoded_info_hash,
+    def announce_params(
+        self,
+        uploaded: int = 0,
+        downloaded: int = 0,
+        left: int | None = None,
+        event: str | None = None,
+    ) -> dict[str, Any]:
+        if left is None:
+            # Before the metadata is in we don't know; anything non-zero says "leecher".
+            left = self.length if self.length is not None else 1
+        params: dict[str, Any] = {
+            "info_hash": bytes.fromhex(self.info_hash),
             "peer_id": PEER_ID,
-            "port": 6881,
-            "uploaded": 0,
-            "downloaded": 0,
-            "left": 999,
+            "port": LISTEN_PORT,
+            "uploaded": uploaded,
+            "downloaded": downloaded,
+            "left": left,
             "compact": 1,
         }
-        try:
-            response = requests.get(self.tracker_url, params=params)
-        except requests.RequestException as e:
-            if isinstance(e, requests.HTTPError):
-                print(response.text)
-            print(f"Error: {e}")
-
-        decoded_response = bencodepy.decode(response.content)
-        self.peers = Peer.from_bytes(decoded_response[b"peers"])
-        return self.peers
-
-    def populate_info_from_dict(self, info_dict: dict[bytes, Any]) -> None:
-        self.length = info_dict[b"length"]
+        if event:
+            params["event"] = event
+        return params
+
+    @staticmethod
+    def parse_announce(content: bytes) -> tuple[list[Peer], int]:
+        """The peers in a tracker response, and how long until we should ask again."""
+        decoded_response = bencode.decode(content)
+        if not isinstance(decoded_response, dict):
+            raise ValueError("Tracker response is not a bencoded dict.")
+        if b"failure reason" in decoded_response:
+            reason = decoded_response[b"failure reason"].decode(errors="replace")
+            raise ConnectionError(f"Tracker refused the announce: {reason}")
+
+        interval = max(
+            decoded_response.get(b"min interval", 0),
+            decoded_response.get(b"interval", DEFAULT_ANNOUNCE_INTERVAL),
+        )
+        peers = decoded_response.get(b"peers", b"")
+        if isinstance(peers, list):
+            peers = Peer.from_list(peers)
+        else:
+            peers = Peer.from_bytes(peers)
+        peers += Peer.from_bytes6(decoded_response.get(b"peers6", b""))
+        return Peer.unique(peers), interval
+
+    def set_peers(self, peers: list[Peer], interval: int) -> list[Peer]:
+        """Caches peers for `interval` seconds."""
+        self.announce_interval = interval
+        self.peers_expire_at = time.monotonic() + interval
+        self.peers = peers
+        return peers
+
+    def update_from_announce(self, content: bytes) -> list[Peer]:
+        """Parses a tracker response and caches its peers for the announce interval."""
+        return self.set_peers(*self.parse_announce(content))
+
+    def get_peers(self) -> list[Peer]:
+        if self.peers is not None and time.monotonic() < self.peers_expire_at:
+            return self.peers
+
+        # Trackers in order until one answers.
+        for tracker_url in self.trackers:
+            try:
+                response = requests.get(
+                    tracker_url, params=self.announce_params(), timeout=TRACKER_TIMEOUT
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                if isinstance(e, requests.HTTPError):
+                    print(e.response.text)
+                print(f"Error: {e}")
+                if tracker_url == self.trackers[-1]:
+                    raise
+                continue
+            return self.update_from_announce(response.content)
+        raise ConnectionError("The torrent lists no trackers.")
+
+    def populate_info_from_dict(self, info_dict: Mapping[bytes, Any]) -> None:
         self.piece_length = info_dict[b"piece length"]
-        pieces_data = info_dict[b"pieces"]
-        pieces = []
-        for i in range(0, len(pieces_data), 20):
-            pieces.append(pieces_data[i : i + 20].hex())
-        self.pieces = pieces
+        self.pieces = PieceHashes(info_dict[b"pieces"])
+
+        self.name = bytes(info_dict.get(b"name", b"")).decode("utf-8", errors="replace")
+        if b"files" in info_dict:
+            check_path_component(self.name)
+            self.files = TorrentFile.from_list(info_dict[b"files"])
+            self.length = sum(file.length for file in self.files)
+        else:
+            self.files = None
+            self.length = info_dict[b"length"]
+
+    def file_layout(self, output_path: str) -> list[tuple[str, int]]:
+        """
+        `(path, length)` of every file on disk, in torrent order.
+
+        A single-file torrent is written to `output_path` itself; a multi-file
+        one to `output_path/<name>/...`.
+        """
+        if self.files is None:
+            return [(output_path, self.length)]
+        return [
+            (os.path.join(output_path, self.name, *file.path), file.length)
+            for file in self.files
+        ]
@@ -9,111 +9,276 @@ import asyncio
 import math
 import socket
 import struct
-from typing import Any
+import time
 
-import bencodepy
+from app import bencode
+from app.models import Message, Peer
+from app.settings import (
+    ENDGAME_REQUESTS_PER_BLOCK,
+    MAX_REQUEST_WINDOW,
+    MIN_REQUEST_WINDOW,
+    PEER_ID,
+    RATE_LIMIT_BURST,
+    READ_CHUNK_SIZE,
+    REQUEST_QUEUE_TIME,
+)
+from app.stats import RateMeter
 
-from app.models import Message, Peer, Torrent
-from app.settings import PEER_ID
+BLOCK_LENGTH = 16 * 1024
 
-bc = bencodepy.BencodeDecoder(encoding="utf-8")
 
+class MessageReader:
+    """
+    Frames peer wire messages out of one reusable receive buffer.
 
-# Entrypoint
-async def download_piece(
-    torrent: Torrent, piece_index: int, output_file_path: str, peer: Peer | None = None
-) -> None:
-    info_hash = torrent.info_hash
-    file_length = torrent.length
-    total_number_of_pieces = len(torrent.pieces)
+    The socket is read in large chunks straight into a single bytearray and
+    length prefixes are parsed in place, so a message costs one copy in and
+    whatever copy the caller makes out of it (a PIECE payload goes directly
+    into its piece buffer). Reads are safe to cancel: partial messages stay in
+    the buffer.
 
-    if piece_index >= total_number_of_pieces:
-        raise ValueError(
-            f"{piece_index=} is too big. Torrent has {total_number_of_pieces} pieces."
-        )
+    Returned views point into the buffer. Release them (`with` works) before
+    the next `read`; a view that is still alive forces a fresh buffer.
+    """
 
-    default_piece_length = torrent.piece_length
-    if piece_index == total_number_of_pieces - 1:
-        piece_length = file_length - (default_piece_length * piece_index)
-    else:
-        piece_length = default_piece_length
+    def __init__(self, reader: asyncio.StreamReader) -> None:
+        self.reader = reader
+        self.buffer = bytearray()
+        self.start = 0  # Where the next unparsed message begins.
+
+    async def read(self) -> memoryview:
+        """Returns the next message (ID byte onwards); empty for keep-alives."""
+        while True:
+            available = len(self.buffer) - self.start
+            if available >= 4:
+                (length,) = struct.unpack_from(">I", self.buffer, self.start)
+                if available >= 4 + length:
+                    begin = self.start + 4
+                    self.start = begin + length
+                    with memoryview(self.buffer) as view:
+                        return view[begin : self.start]
+
+            chunk = await self.reader.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError(
+                    "Connection closed before full message was received"
+                )
+            self._append(chunk)
 
-    number_of_blocks = math.ceil(piece_length / (16 * 1024))
+    def _append(self, chunk: bytes) -> None:
+        try:
+            del self.buffer[: self.start]
+            self.buffer += chunk
+        except BufferError:
+            # A caller is still holding a view; leave it the old buffer.
+            self.buffer = self.buffer[self.start :] + chunk
+        self.start = 0
 
-    if not peer:
-        peers = torrent.get_peers()
-        peer = peers[0]
 
-    reader, writer = await asyncio.open_connection(peer.ip, int(peer.port))
-    await perform_handshake(bytes.fromhex(info_hash), writer=writer, reader=reader)
+class RequestWindow:
+    """
+    How many block requests we keep in flight to one peer.
 
-    print("Waiting for bitfield message...")
-    await read_message(5, writer=writer, reader=reader)
+    Sized like libtorrent's request queue: enough blocks to cover the peer's
+    measured download rate over its base round trip plus REQUEST_QUEUE_TIME.
+    Until the first rate sample is in, it grows by one per block received,
+    doubling every round trip like TCP slow start.
+    """
 
-    # Interested message.
-    interested_message = b"\x00\x00\x00\x01\x02"
-    writer.write(interested_message)
-    await writer.drain()
+    def __init__(self) -> None:
+        self.size = MIN_REQUEST_WINDOW
+        self.meter = RateMeter()
+        self.min_rtt: float | None = None
+        self.rtt: float | None = None  # Smoothed like TCP's SRTT.
 
-    print("🫸🏻 Waiting for unchoke message...")
-    await read_message(1, writer=writer, reader=reader)
-    print("📥 Received unchoke message.")
+    @property
+    def rate(self) -> float:
+        """Bytes per second."""
+        return self.meter.rate
 
-    data = await download_blocks(
-        piece_index, piece_length, number_of_blocks, reader, writer
-    )
+    def on_block(self, block_length: int, rtt: float) -> None:
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
 
-    piece_file_name = f"{output_file_path}.part{piece_index}"
-    with open(piece_file_name, "wb") as f:
-        f.write(data)
+        if not self.meter.add(block_length):
+            if not self.rate:
+                self.size = min(self.size + 1, MAX_REQUEST_WINDOW)
+            return
 
+        wanted = self.rate * (self.min_rtt + REQUEST_QUEUE_TIME) / BLOCK_LENGTH
+        self.size = max(MIN_REQUEST_WINDOW, min(math.ceil(wanted), MAX_REQUEST_WINDOW))
 
-async def download_blocks(
-    piece_index: int,
-    piece_length: int,
-    number_of_blocks: int,
-    reader: asyncio.StreamReader,
-    writer: asyncio.StreamWriter,
-) -> bytes:
-    data = bytearray()
-    semaphore = asyncio.Semaphore(5)
-    response_queue: asyncio.Queue[tuple[int, bytes]] = asyncio.Queue()
-
-    async def send_requests():
-        """Sends block requests concurrently but limits outgoing requests."""
-        for block_index in range(number_of_blocks):
-            async with semaphore:
-                begin = 2**14 * block_index
-                block_length = min(piece_length - begin, 2**14)
-                print(
-                    f"Requesting block {block_index + 1} of {number_of_blocks} with "
-                    f" length {block_length}"
-                )
 
-                request_payload = struct.pack(
-                    ">IBIII", 13, 6, piece_index, begin, block_length
-                )
-                writer.write(request_payload)
-                await writer.drain()
+class TokenBucket:
+    """
+    Allows `rate` bytes per second on average; None means unlimited.
 
-    async def receive_responses():
-        """Reads incoming messages and stores them in the queue."""
-        for _ in range(number_of_blocks):
-            message = await read_message(7, writer=writer, reader=reader)
-            block_index = (
-                struct.unpack(">I", message[9:13])[0] // 2**14
-            )  # Extract block index
-            await response_queue.put((block_index, message[13:]))
+    Up to RATE_LIMIT_BURST seconds' worth of unused allowance is saved up.
+    Sending is allowed while the balance isn't negative and may overdraw it,
+    so a block bigger than the burst still goes out and is paid off after.
+    """
+
+    def __init__(self, rate: float | None = None) -> None:
+        self.rate: float | None = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float | None) -> None:
+        """Changes the limit, taking effect for the next bytes sent."""
+        self.refill()
+        if rate and not self.rate:
+            self.tokens = rate * RATE_LIMIT_BURST
+        elif rate:
+            self.tokens = min(self.tokens, rate * RATE_LIMIT_BURST)
+        self.rate = rate or None
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate,
+                self.rate * RATE_LIMIT_BURST,
+            )
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until we may send again; 0 means now."""
+        if not self.rate:
+            return 0
+        self.refill()
+        return max(0.0, -self.tokens / self.rate)
+
+    def consume(self, n: int) -> None:
+        if self.rate:
+            self.tokens -= n
+
+
+class RateLimit:
+    """Token buckets that must all allow a transfer, e.g. per peer and global."""
+
+    def __init__(self, *buckets: TokenBucket) -> None:
+        self.buckets = buckets
+
+    def delay(self) -> float:
+        return max((bucket.delay() for bucket in self.buckets), default=0)
+
+    def consume(self, n: int) -> None:
+        for bucket in self.buckets:
+            bucket.consume(n)
+
+    async def acquire(self, n: int) -> None:
+        """Waits until every bucket allows sending, then charges `n` bytes."""
+        while delay := self.delay():
+            await asyncio.sleep(delay)
+        self.consume(n)
+
+
+class PieceBuffer:
+    """
+    A piece being assembled block by block.
+
+    In endgame several connections work on the same piece, so the buffer
+    remembers who asked for each missing block and cancels the other copies
+    as soon as one arrives.
+    """
 
-    # Start sending and receiving concurrently
-    await asyncio.gather(send_requests(), receive_responses())
+    def __init__(self, piece_index: int, piece_length: int) -> None:
+        self.index = piece_index
+        self.data = bytearray(piece_length)
+        self.missing = {
+            begin: min(piece_length - begin, BLOCK_LENGTH)
+            for begin in range(0, piece_length, BLOCK_LENGTH)
+        }
+        self.requested_by: dict[int, set["BlockRequests"]] = {}
+        self.sources: set[str] = set()
+        self.created = time.monotonic()
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing
+
+    def unrequested(self, requests: "BlockRequests") -> list[tuple[int, int]]:
+        """
+        Missing `(begin, length)` blocks that `requests` may still ask for.
+
+        Skips blocks it already asked for and, in endgame, blocks that
+        ENDGAME_REQUESTS_PER_BLOCK connections are already fetching.
+        """
+        unrequested = []
+        for begin, length in self.missing.items():
+            requesters = self.requested_by.get(begin, ())
+            if (
+                requests not in requesters
+                and len(requesters) < ENDGAME_REQUESTS_PER_BLOCK
+            ):
+                unrequested.append((begin, length))
+        return unrequested
+
+    def add_block(
+        self, begin: int, block: bytes | memoryview, requests: "BlockRequests"
+    ) -> bool:
+        """Stores a block and cancels duplicate requests; False if it was a dupe."""
+        length = self.missing.get(begin)
+        if length is None:
+            return False
+        if len(block) != length:
+            raise ValueError(
+                f"Block {self.index}:{begin} is {len(block)} bytes, not {length}."
+            )
+
+        del self.missing[begin]
+        self.data[begin : begin + length] = block
+        self.sources.add(requests.name)
+        for other in self.requested_by.pop(begin, ()):
+            if other is not requests:
+                other.cancel(self.index, begin, length)
+        return True
+
+
+class BlockRequests:
+    """
+    The REQUESTs one connection has in flight.
 
-    # Process blocks in order
-    results = [await response_queue.get() for _ in range(number_of_blocks)]
-    for _, block_data in sorted(results):
-        data.extend(block_data)
+    Requesting a block charges its length to `limit` up front, which is what
+    keeps a download under its rate limit without ever leaving data unread
+    in the socket. Cancelled requests are refunded.
+    """
 
-    return data
+    def __init__(
+        self, writer: asyncio.StreamWriter, name: str, limit: RateLimit | None = None
+    ) -> None:
+        self.writer = writer
+        self.name = name
+        self.limit = limit or RateLimit()
+        self.in_flight: dict[tuple[int, int], tuple[float, PieceBuffer]] = {}
+
+    def __len__(self) -> int:
+        return len(self.in_flight)
+
+    def delay(self) -> float:
+        """Seconds until the rate limit allows another request."""
+        return self.limit.delay()
+
+    def request(self, piece: PieceBuffer, begin: int, length: int) -> None:
+        self.limit.consume(length)
+        self.writer.write(struct.pack(">IBIII", 13, 6, piece.index, begin, length))
+        self.in_flight[(piece.index, begin)] = (time.monotonic(), piece)
+        piece.requested_by.setdefault(begin, set()).add(self)
+
+    def cancel(self, piece_index: int, begin: int, length: int) -> None:
+        if self.in_flight.pop((piece_index, begin), None) is None:
+            return
+        self.limit.consume(-length)
+        if not self.writer.is_closing():
+            self.writer.write(struct.pack(">IBIII", 13, 8, piece_index, begin, length))
+
+    def abandon(self) -> None:
+        """Forgets every outstanding request, e.g. when the connection dies."""
+        for (_, begin), (_, piece) in self.in_flight.items():
+            piece.requested_by.get(begin, set()).discard(self)
+        self.in_flight.clear()
 
 
 def receive_message(s: socket.socket) -> bytes:
@@ -137,18 +302,20 @@ def calculate_last_piece_length(
     return file_length - (default_piece_length * (total_number_of_pieces - 1))
 
 
+def handshake_message(info_hash: bytes, signal_extensions: bool = False) -> bytes:
+    reserved = bytearray(8)
+    if signal_extensions:
+        reserved[5] |= 0x10
+    return b"\x13BitTorrent protocol" + reserved + info_hash + PEER_ID.encode()
+
+
 async def perform_handshake(
     info_hash: bytes,
     writer: asyncio.StreamWriter,
     reader: asyncio.StreamReader,
     signal_extensions: bool = False,
 ) -> None:
-    reserved = bytearray(8)
-    if signal_extensions:
-        reserved[5] |= 0x10
-
-    data = b"\x13BitTorrent protocol" + reserved + info_hash + PEER_ID.encode()
-    writer.write(data)
+    writer.write(handshake_message(info_hash, signal_extensions))
     await writer.drain()
 
     response = await reader.readexactly(68)
@@ -169,7 +336,7 @@ async def perform_extension_handshake(
     writer: asyncio.StreamWriter, reader: asyncio.StreamReader
 ) -> int:
     payload = {"m": {"ut_metadata": 69}}
-    encoded_payload = bencodepy.encode(payload)
+    encoded_payload = bencode.encode(payload)
     extension_id = b"\x00"
     message = Message(id=20, payload=extension_id + encoded_payload)
 
@@ -178,36 +345,30 @@ async def perform_extension_handshake(
 
     response = await read_message(20, writer, reader)
 
-    decoded_response = bencodepy.decode(response[6:])
+    decoded_response = bencode.decode(response[6:])
     metadata_extension_id = decoded_response[b"m"][b"ut_metadata"]
     print("Peer Metadata Extension ID:", metadata_extension_id)
     return metadata_extension_id
 
 
-async def send_request_metadata_message(writer: asyncio.StreamWriter) -> None:
-    payload_dict = {"msg_type": 0, "piece": 0}
-    message = Message(id=20, payload=b"\x01" + bencodepy.encode(payload_dict))
-    writer.write(message.to_bytes())
-    await writer.drain()
-
-
 async def receive_full_message(
     length: int, writer: asyncio.StreamWriter, reader: asyncio.StreamReader
 ) -> bytes:
-    data = b""
-    while len(data) < length:
-        chunk = await reader.read(length - len(data))
-        if not chunk:
-            raise ConnectionError("Connection closed before full message was received")
-        data += chunk
-    return data
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError(
+            "Connection closed before full message was received"
+        ) from e
 
 
 async def read_message(
-    expected_message_id: int, writer: asyncio.StreamWriter, reader: asyncio.StreamReader
+    expected_message_id: int | tuple[int, ...],
+    writer: asyncio.StreamWriter,
+    reader: asyncio.StreamReader,
 ) -> bytes:
     """
-    Waits for a message with the specified ID from the peer.
+    Waits for a message with the specified ID (or one of several IDs) from the peer.
     """
 
     length_bytes = await receive_full_message(4, writer, reader)
@@ -219,21 +380,11 @@ async def read_message(
     message = await receive_full_message(total_length, writer, reader)
 
     message_id = message[0]
-    if message_id == expected_message_id:
+    if message_id == expected_message_id or (
+        isinstance(expected_message_id, tuple) and message_id in expected_message_id
+    ):
         return length_bytes + message
     else:
         raise ValueError(
             f"Expected message with ID {expected_message_id}, but got {message_id}."
         )
-
-
-async def read_data_message(
-    writer: asyncio.StreamWriter, reader: asyncio.StreamReader
-) -> dict[bytes, Any]:
-    message = await read_message(20, writer, reader)
-    message_data = message[6:]
-
-    dictionary_last_index = message_data.find(b"ee")
-    decoded_info_dict = bencodepy.decode(message_data[dictionary_last_index + 2 :])
-
-    return decoded_info_dict
@@ -0,0 +1,103 @@
+"""
+Remembers which pieces are safely on disk, so an interrupted download resumes.
+
+The resume file sits next to the output as `<output>.resume`: a magic string,
+the 20-byte info hash and one bit per piece. Bits are flipped in place once
+their pieces are written and fsynced, so the file never claims more than
+the output holds, even after a power cut.
+"""
+
+import asyncio
+import os
+from typing import Iterable
+
+from app.scheduler import Bitfield
+from app.settings import RECHECK_CONCURRENCY
+from app.storage import Storage
+from app.verify import PieceVerifier
+
+RESUME_MAGIC = b"BTRESUM1"
+
+
+class ResumeFile:
+    def __init__(
+        self, output_file_path: str, info_hash: bytes, number_of_pieces: int
+    ) -> None:
+        self.path = output_file_path + ".resume"
+        self.info_hash = info_hash
+        self.done = Bitfield(number_of_pieces)
+        self.header_length = len(RESUME_MAGIC) + len(info_hash)
+        self.fd = -1
+
+    def load(self) -> bool:
+        """Reads the bitmap; False if there is none or it belongs to another torrent."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        header = RESUME_MAGIC + self.info_hash
+        if not data.startswith(header):
+            return False
+        try:
+            self.done = Bitfield(self.done.length, data[self.header_length :])
+        except ValueError:
+            return False  # Written for a different piece count.
+        return True
+
+    def open(self) -> None:
+        """(Re)writes the file from the bitmap and keeps it open for `mark_all`."""
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, RESUME_MAGIC + self.info_hash + self.done.to_bytes())
+
+    def mark_all(self, piece_indexes: Iterable[int]) -> None:
+        """Records a batch of pieces, rewriting the bitmap span they touch."""
+        piece_indexes = list(piece_indexes)
+        if not piece_indexes:
+            return
+        for piece_index in piece_indexes:
+            self.done.add(piece_index)
+        first, last = min(piece_indexes) >> 3, max(piece_indexes) >> 3
+        os.pwrite(self.fd, self.done.bits[first : last + 1], self.header_length + first)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def remove(self) -> None:
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def recheck(
+    storage: Storage,
+    verifier: PieceVerifier,
+    piece_lengths: Iterable[tuple[int, int]],
+) -> list[int]:
+    """
+    Hashes `(piece_index, piece_length)` pieces already in `storage`.
+
+    Reads and hashes run on executors, RECHECK_CONCURRENCY pieces at a time,
+    so a big file is checked across all cores without being read into
+    memory at once. Returns the pieces that match their hash.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(RECHECK_CONCURRENCY)
+
+    async def check(piece_index: int, piece_length: int) -> bool:
+        async with slots:
+            data = await loop.run_in_executor(
+                None, storage.read_piece, piece_index, piece_length
+            )
+            return len(data) == piece_length and await verifier.verify(
+                piece_index, data
+            )
+
+    piece_lengths = list(piece_lengths)
+    results = await asyncio.gather(*(check(*piece) for piece in piece_lengths))
+    return [piece_index for (piece_index, _), ok in zip(piece_lengths, results) if ok]
@@ -0,0 +1,217 @@
+"""
+Decides which piece each peer should download next.
+
+Pieces are handed out rarest-first: every piece we still need sits in a bucket
+keyed by how many connected peers have it, and a peer asking for work gets a
+random piece it has from the lowest non-empty bucket. Streaming narrows this
+to a window of pieces just past the playhead, handed out lowest index first.
+"""
+
+import asyncio
+import math
+import random
+
+
+class Bitfield:
+    """A set of piece indexes stored one bit per piece, high bit first."""
+
+    __slots__ = ("bits", "length")
+
+    def __init__(self, length: int, bits: bytes | bytearray | None = None) -> None:
+        self.length = length
+        self.bits = bytearray(math.ceil(length / 8))
+        if bits is not None:
+            if len(bits) != len(self.bits):
+                raise ValueError(
+                    f"Bitfield has {len(bits)} bytes, expected {len(self.bits)}."
+                )
+            self.bits[:] = bits
+            spare_bits = len(self.bits) * 8 - length
+            if spare_bits:
+                self.bits[-1] &= 0xFF << spare_bits & 0xFF
+
+    @classmethod
+    def full(cls, length: int) -> "Bitfield":
+        bits = bytearray(b"\xff" * math.ceil(length / 8))
+        return cls(length, bits)
+
+    def __contains__(self, piece_index: int) -> bool:
+        return bool(self.bits[piece_index >> 3] & (0x80 >> (piece_index & 7)))
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self.bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield byte_index * 8 + bit
+
+    def add(self, piece_index: int) -> None:
+        if not 0 <= piece_index < self.length:
+            raise ValueError(
+                f"{piece_index=} is out of range for {self.length} pieces."
+            )
+        self.bits[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+
+    def discard(self, piece_index: int) -> None:
+        self.bits[piece_index >> 3] &= ~(0x80 >> (piece_index & 7)) & 0xFF
+
+    def count(self) -> int:
+        return int.from_bytes(self.bits, "big").bit_count()
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.bits)
+
+
+class PieceScheduler:
+    def __init__(self, number_of_pieces: int) -> None:
+        self.number_of_pieces = number_of_pieces
+        self.availability = [0] * number_of_pieces
+        self.peer_pieces: dict[str, Bitfield] = {}
+        self.done = Bitfield(number_of_pieces)
+        self.pieces_left = number_of_pieces
+        self.in_progress: set[int] = set()
+        self.bad_sources: dict[int, set[str]] = {}  # Peers that sent a corrupt copy.
+        self.finished = asyncio.Event()
+
+        # Pieces nobody is downloading yet, bucketed by availability. Each
+        # bucket is a list so removal is O(1) by swapping with the last item.
+        self.buckets: list[list[int]] = [list(range(number_of_pieces))]
+        self.position = {
+            piece_index: piece_index for piece_index in range(number_of_pieces)
+        }
+        # Set and replaced on every change. Workers take it before asking for a
+        # piece and wait on that one, so a change in between isn't missed.
+        self.changed = asyncio.Event()
+        # When set, only these pieces are handed out, in order.
+        self.window: range | None = None
+
+        if not number_of_pieces:
+            self.finished.set()
+
+    def _unbucket(self, piece_index: int) -> None:
+        bucket = self.buckets[self.availability[piece_index]]
+        position = self.position.pop(piece_index)
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self.position[last] = position
+
+    def _bucket(self, piece_index: int) -> None:
+        availability = self.availability[piece_index]
+        while len(self.buckets) <= availability:
+            self.buckets.append([])
+        self.position[piece_index] = len(self.buckets[availability])
+        self.buckets[availability].append(piece_index)
+
+    def _adjust(self, piece_index: int, delta: int) -> None:
+        waiting = piece_index in self.position
+        if waiting:
+            self._unbucket(piece_index)
+        self.availability[piece_index] += delta
+        if waiting:
+            self._bucket(piece_index)
+
+    def _notify(self) -> None:
+        """Wakes up every peer waiting for work."""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def wake(self) -> None:
+        """Has idle peers ask for work again, e.g. once the disk has caught up."""
+        self._notify()
+
+    def set_window(self, start: int, end: int) -> None:
+        """Restricts picking to pieces `start:end`, lowest index first."""
+        self.window = range(start, min(end, self.number_of_pieces))
+        self._notify()
+
+    def add_peer(self, peer_key: str, bitfield: Bitfield) -> None:
+        self.remove_peer(peer_key)
+        # Our own copy, so later HAVEs are counted here exactly once.
+        bitfield = Bitfield(bitfield.length, bitfield.bits)
+        self.peer_pieces[peer_key] = bitfield
+        for piece_index in bitfield:
+            self._adjust(piece_index, +1)
+        self._notify()
+
+    def remove_peer(self, peer_key: str) -> None:
+        bitfield = self.peer_pieces.pop(peer_key, None)
+        if bitfield is None:
+            return
+        for piece_index in bitfield:
+            self._adjust(piece_index, -1)
+
+    def have(self, peer_key: str, piece_index: int) -> None:
+        """Records a HAVE message."""
+        bitfield = self.peer_pieces.get(peer_key)
+        if bitfield is None or piece_index in bitfield:
+            return
+        bitfield.add(piece_index)
+        self._adjust(piece_index, +1)
+        if piece_index in self.position:
+            self._notify()
+
+    def next_piece(self, peer_key: str) -> int | None:
+        """Picks the rarest piece this peer has (the first, in a window), or None."""
+        bitfield = self.peer_pieces.get(peer_key)
+        if bitfield is None:
+            return None
+
+        if self.window is not None:
+            for piece_index in self.window:
+                if piece_index not in self.position:
+                    continue  # Done, or already being downloaded.
+                if self._can_send(peer_key, bitfield, piece_index):
+                    return self._assign(piece_index)
+            return None
+
+        for bucket in self.buckets[1:]:
+            if not bucket:
+                continue
+            start = random.randrange(len(bucket))
+            for offset in range(len(bucket)):
+                piece_index = bucket[(start + offset) % len(bucket)]
+                if self._can_send(peer_key, bitfield, piece_index):
+                    return self._assign(piece_index)
+        return None
+
+    def _can_send(self, peer_key: str, bitfield: Bitfield, piece_index: int) -> bool:
+        return piece_index in bitfield and peer_key not in self.bad_sources.get(
+            piece_index, ()
+        )
+
+    def _assign(self, piece_index: int) -> int:
+        self._unbucket(piece_index)
+        self.in_progress.add(piece_index)
+        if self.all_assigned:
+            self._notify()  # Idle peers can join in for endgame.
+        return piece_index
+
+    @property
+    def all_assigned(self) -> bool:
+        """True once every missing piece (in the window, if any) is being downloaded."""
+        if self.window is not None:
+            return not any(piece_index in self.position for piece_index in self.window)
+        return not self.position
+
+    def complete(self, piece_index: int) -> None:
+        self.in_progress.discard(piece_index)
+        if piece_index in self.position:
+            self._unbucket(piece_index)  # Already on disk from an earlier run.
+        if piece_index in self.done:
+            return
+        self.done.add(piece_index)
+        self.pieces_left -= 1
+        if not self.pieces_left:
+            self.finished.set()
+
+    def release(self, piece_index: int, bad_source: str | None = None) -> None:
+        """Puts a piece back up for grabs, optionally blaming the peer that sent it."""
+        if bad_source:
+            self.bad_sources.setdefault(piece_index, set()).add(bad_source)
+        if piece_index not in self.in_progress:
+            return
+        self.in_progress.discard(piece_index)
+        self._bucket(piece_index)
+        self._notify()
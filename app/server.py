@@ -0,0 +1,60 @@
+"""
+Accepts connections from peers on the port we announce to trackers.
+
+The server only reads the incoming handshake; the info hash in it picks the
+running torrent, which then takes the connection over as a regular session.
+"""
+
+import asyncio
+from typing import Awaitable, Callable
+
+from app.models import Peer
+from app.settings import CONNECT_TIMEOUT, LISTEN_PORT, PEER_ID
+
+# Handed the connection and the remote peer once its handshake checks out.
+ConnectionHandler = Callable[
+    [Peer, asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]
+]
+
+
+class PeerServer:
+    def __init__(self, port: int = LISTEN_PORT) -> None:
+        self.port = port
+        self.torrents: dict[bytes, ConnectionHandler] = {}
+        self.server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, port=self.port)
+        print(f"👂 Listening for peers on port {self.port}.")
+
+    def register(self, info_hash: bytes, on_connection: ConnectionHandler) -> None:
+        self.torrents[info_hash] = on_connection
+
+    def unregister(self, info_hash: bytes) -> None:
+        self.torrents.pop(info_hash, None)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        ip, port = writer.get_extra_info("peername")[:2]
+        peer = Peer(ip=ip, port=port)
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(68), CONNECT_TIMEOUT)
+            if not handshake.startswith(b"\x13BitTorrent protocol"):
+                raise ValueError("Not a BitTorrent handshake.")
+            if handshake[48:] == PEER_ID.encode():
+                raise ValueError("That's us.")
+            on_connection = self.torrents.get(handshake[28:48])
+            if on_connection is None:
+                raise ValueError(f"Unknown info hash {handshake[28:48].hex()}.")
+            print(f"🤝 Incoming connection from {peer}.")
+            await on_connection(peer, reader, writer)
+        except (OSError, EOFError, ValueError) as e:
+            print(f"Turned away {peer}: {e!r}")
+            writer.close()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
@@ -0,0 +1,620 @@
+"""
+Long-lived peer sessions, so one connection can serve many pieces in a row.
+
+Each session reads every message the peer sends and dispatches it by ID, so
+keep-alives, HAVEs, choke/unchoke and extension messages can arrive at any
+point without tearing the connection down.
+"""
+
+import asyncio
+import struct
+import time
+from collections import deque
+from hashlib import sha1
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from app.models import Peer, Torrent
+from app.network import (
+    BLOCK_LENGTH,
+    BlockRequests,
+    MessageReader,
+    PieceBuffer,
+    RateLimit,
+    RequestWindow,
+    TokenBucket,
+    handshake_message,
+    perform_handshake,
+)
+from app.scheduler import Bitfield
+from app.settings import (
+    CONNECT_TIMEOUT,
+    DOWNLOAD_RATE_LIMIT,
+    KEEPALIVE_INTERVAL,
+    MAX_UPLOAD_REQUESTS,
+    PEER_DOWNLOAD_RATE_LIMIT,
+    PEER_UPLOAD_RATE_LIMIT,
+    UPLOAD_RATE_LIMIT,
+)
+from app.stats import RateMeter
+from app.tracker import TrackerClient
+
+# Larger REQUESTs than this are a protocol violation (BEP 3 recommends 16 KiB).
+MAX_BLOCK_LENGTH = 8 * BLOCK_LENGTH
+# Passed to `PeerPool.set_rate_limits` for a limit that should stay as it is.
+UNCHANGED: Any = object()
+
+
+# Entrypoint
+async def download_piece(
+    torrent: Torrent, piece_index: int, output_file_path: str, peer: Peer | None = None
+) -> None:
+    total_number_of_pieces = len(torrent.pieces)
+
+    if piece_index >= total_number_of_pieces:
+        raise ValueError(
+            f"{piece_index=} is too big. Torrent has {total_number_of_pieces} pieces."
+        )
+
+    if not peer:
+        peers = await TrackerClient(torrent).get_peers()
+        peer = peers[0]
+
+    session = PeerSession(
+        peer, bytes.fromhex(torrent.info_hash), total_number_of_pieces
+    )
+    piece = PieceBuffer(piece_index, torrent.get_piece_length(piece_index))
+    pieces = iter([piece])
+    try:
+        await session.connect()
+        while not piece.complete:
+            async for _ in session.download_pieces(lambda _: next(pieces, None)):
+                pass
+            if not piece.complete:
+                await session.wait_idle(asyncio.Event())  # Choked; wait it out.
+    finally:
+        await session.close()
+
+    if sha1(piece.data).digest() != torrent.pieces[piece_index]:
+        raise ValueError(f"Piece {piece_index} from {peer} failed the hash check.")
+    with open(output_file_path, "wb") as f:
+        f.write(piece.data)
+
+
+class PeerSession:
+    """
+    One connection to a single peer and the protocol state that goes with it.
+
+    `peer_choking`/`peer_interested` are what the peer told us,
+    `am_choking`/`am_interested` what we told it. A choke drops our
+    outstanding requests on the peer's side, so they are queued again and
+    re-sent once it unchokes us.
+    """
+
+    def __init__(
+        self,
+        peer: Peer,
+        info_hash: bytes,
+        number_of_pieces: int,
+        have: Bitfield | None = None,
+        read_piece: Callable[[int], Awaitable[bytes]] | None = None,
+    ) -> None:
+        self.peer = peer
+        self.info_hash = info_hash
+        self.bitfield = Bitfield(number_of_pieces)
+        self.on_have: Callable[[int], None] | None = None
+        # Our side: the pieces we can upload, and how to read them.
+        self.have = have
+        self.read_piece = read_piece
+        self.on_upload: Callable[[int], None] | None = None
+        self.on_interested: Callable[["PeerSession"], None] | None = None
+        self.on_close: Callable[[], None] | None = None
+        self.on_dht_port: Callable[[tuple[str, int]], None] | None = None
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.messages: MessageReader | None = None
+        self.window = RequestWindow()
+        # Unlimited unless the pool hands us its global and per-peer buckets.
+        self.download_limit = RateLimit()
+        self.upload_limit = RateLimit()
+
+        self.peer_choking = True
+        self.peer_interested = False
+        self.am_choking = True
+        self.am_interested = False
+
+        self.requests: BlockRequests | None = None
+        # Blocks picked for this peer but not asked for yet, e.g. after a choke.
+        self.unrequested: deque[tuple[PieceBuffer, int, int]] = deque()
+        self.completed: deque[PieceBuffer] = deque()
+        self.last_sent = time.monotonic()
+
+        # REQUESTs from the peer, served in order by `upload`.
+        self.upload_queue: deque[tuple[int, int, int]] = deque()
+        self.uploader: asyncio.Task | None = None
+        self.uploaded = 0
+        self.downloaded = 0
+        self.upload_meter = RateMeter()
+        # Time spent choked by the peer, not counting the current stretch.
+        self.choked_time = 0.0
+        self.choked_since: float | None = time.monotonic()
+
+        self.handlers: dict[int, Callable[[memoryview], None]] = {
+            0: self.handle_choke,
+            1: self.handle_unchoke,
+            2: self.handle_interested,
+            3: self.handle_not_interested,
+            4: self.handle_have,
+            5: self.handle_bitfield,
+            6: self.handle_request,
+            7: self.handle_piece,
+            8: self.handle_cancel,
+            9: self.handle_port,
+            20: self.handle_extended,
+        }
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self) -> None:
+        """Handshakes, declares interest and waits until the peer unchokes us."""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.peer.ip, int(self.peer.port)), CONNECT_TIMEOUT
+        )
+        await perform_handshake(self.info_hash, writer=self.writer, reader=self.reader)
+        await self.start()
+
+        print("🫸🏻 Waiting for unchoke message...")
+        while self.peer_choking:
+            await self.receive()
+        print(f"📥 Unchoked by {self.peer}.")
+
+    async def accept(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Takes over a connection the peer opened; its handshake is already read."""
+        self.reader, self.writer = reader, writer
+        writer.write(handshake_message(self.info_hash))
+        await self.start()
+
+    async def start(self) -> None:
+        """Sets up a handshaken connection: our bitfield, then interest."""
+        self.messages = MessageReader(self.reader)
+        self.requests = BlockRequests(self.writer, str(self.peer), self.download_limit)
+        if self.have is not None and self.have.count():
+            bits = self.have.to_bytes()
+            self.send(struct.pack(">IB", len(bits) + 1, 5) + bits)
+        self.set_interested(True)
+        await self.writer.drain()
+
+    def send(self, message: bytes) -> None:
+        self.writer.write(message)
+        self.last_sent = time.monotonic()
+
+    def set_interested(self, interested: bool) -> None:
+        if interested != self.am_interested:
+            self.am_interested = interested
+            self.send(
+                b"\x00\x00\x00\x01\x02" if interested else b"\x00\x00\x00\x01\x03"
+            )
+
+    def set_choking(self, choking: bool) -> None:
+        if choking != self.am_choking:
+            self.am_choking = choking
+            self.send(b"\x00\x00\x00\x01\x00" if choking else b"\x00\x00\x00\x01\x01")
+            if choking:
+                self.upload_queue.clear()  # Choking discards the peer's requests.
+
+    def send_have(self, piece_index: int) -> None:
+        if self.connected:
+            self.send(struct.pack(">IBI", 5, 4, piece_index))
+
+    async def receive(self) -> None:
+        """Reads one message and hands it to its handler."""
+        with await self.messages.read() as message:
+            if not message:
+                return  # Keep-alive.
+            handler = self.handlers.get(message[0])
+            if handler:
+                handler(message)
+            # Anything else is an extension we never advertised; ignore it.
+
+    async def download_pieces(
+        self, next_piece: Callable[[BlockRequests], PieceBuffer | None]
+    ) -> AsyncIterator[PieceBuffer]:
+        """
+        Pipelines requests for pieces from `next_piece`, yielding each one completed.
+
+        `next_piece` is polled for another piece whenever the window has room,
+        so requests for the next piece are already in flight while the current
+        one finishes. Only blocks still missing and not yet asked for over
+        this connection are requested, which is what lets endgame hand the
+        same piece to several peers. Returns once every outstanding request
+        is answered or cancelled and either `next_piece` runs dry or the peer
+        chokes us; blocks left over are resumed on the next call.
+        """
+        requests = self.requests
+        out_of_pieces = False
+
+        while True:
+            while not self.peer_choking and len(requests) < self.window.size:
+                if not self.unrequested:
+                    piece = None if out_of_pieces else next_piece(requests)
+                    if piece is None:
+                        out_of_pieces = True
+                        break
+                    self.unrequested.extend(
+                        (piece, begin, length)
+                        for begin, length in piece.unrequested(requests)
+                    )
+                    continue
+
+                piece, begin, length = self.unrequested[0]
+                if begin not in piece.missing:
+                    self.unrequested.popleft()
+                    continue  # Another connection delivered it meanwhile.
+                delay = requests.delay()
+                if delay and requests:
+                    break  # Over the rate limit; take in what's in flight meanwhile.
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                self.unrequested.popleft()
+                requests.request(piece, begin, length)
+                self.last_sent = time.monotonic()
+
+            if not requests:
+                return
+            await self.writer.drain()
+
+            await self.receive()
+            while self.completed:
+                yield self.completed.popleft()
+
+    async def wait_idle(self, wakeup: asyncio.Event) -> None:
+        """
+        Handles messages while we have nothing to request.
+
+        Returns once `wakeup` is set, or when a peer that was choking us
+        unchokes us. Sends a keep-alive whenever we have been quiet for
+        KEEPALIVE_INTERVAL.
+        """
+        choked = self.peer_choking
+        woken = asyncio.ensure_future(wakeup.wait())
+        receiving: asyncio.Future | None = None
+        try:
+            while not woken.done() and not (choked and not self.peer_choking):
+                if receiving is None:
+                    receiving = asyncio.ensure_future(self.receive())
+                timeout = self.last_sent + KEEPALIVE_INTERVAL - time.monotonic()
+                await asyncio.wait(
+                    [receiving, woken],
+                    timeout=max(timeout, 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if receiving.done():
+                    receiving, finished = None, receiving
+                    finished.result()
+                elif time.monotonic() >= self.last_sent + KEEPALIVE_INTERVAL:
+                    self.send(b"\x00\x00\x00\x00")
+                    await self.writer.drain()
+        finally:
+            woken.cancel()
+            if receiving is not None:
+                # MessageReader keeps partial data. Wait for the cancel to
+                # land so the next read doesn't race this one.
+                receiving.cancel()
+                await asyncio.wait([receiving])
+
+    def handle_choke(self, message: memoryview) -> None:
+        if not self.peer_choking:
+            self.choked_since = time.monotonic()
+        self.peer_choking = True
+        print(f"🫷🏻 Choked by {self.peer}.")
+        # The peer has dropped everything we asked for; ask again after the unchoke.
+        for (_, begin), (_, piece) in reversed(self.requests.in_flight.items()):
+            if begin in piece.missing:
+                self.unrequested.appendleft((piece, begin, piece.missing[begin]))
+        self.requests.abandon()
+
+    def handle_unchoke(self, message: memoryview) -> None:
+        if self.choked_since is not None:
+            self.choked_time += time.monotonic() - self.choked_since
+            self.choked_since = None
+        self.peer_choking = False
+
+    def handle_interested(self, message: memoryview) -> None:
+        self.peer_interested = True
+        if self.on_interested and self.read_piece is not None:
+            self.on_interested(self)
+
+    def handle_not_interested(self, message: memoryview) -> None:
+        self.peer_interested = False
+
+    def handle_have(self, message: memoryview) -> None:
+        (piece_index,) = struct.unpack_from(">I", message, 1)
+        self.add_piece(piece_index)
+
+    def handle_bitfield(self, message: memoryview) -> None:
+        with message[1:] as bits:
+            bitfield = Bitfield(self.bitfield.length, bits)
+        for piece_index in bitfield:
+            self.add_piece(piece_index)
+
+    def add_piece(self, piece_index: int) -> None:
+        self.bitfield.add(piece_index)
+        if self.on_have:
+            self.on_have(piece_index)
+
+    def handle_request(self, message: memoryview) -> None:
+        request = struct.unpack_from(">III", message, 1)
+        piece_index, _, length = request
+        if self.am_choking or len(self.upload_queue) >= MAX_UPLOAD_REQUESTS:
+            return
+        if (
+            self.have is None
+            or piece_index >= self.have.length
+            or piece_index not in self.have
+        ):
+            raise ValueError(
+                f"{self.peer} requested piece {piece_index}, which we don't have."
+            )
+        if length > MAX_BLOCK_LENGTH:
+            raise ValueError(f"{self.peer} requested a {length} byte block.")
+
+        self.upload_queue.append(request)
+        if self.uploader is None or self.uploader.done():
+            self.uploader = asyncio.create_task(self.upload())
+
+    async def upload(self) -> None:
+        """Sends the blocks the peer asked for, one at a time."""
+        try:
+            while self.upload_queue:
+                piece_index, begin, length = self.upload_queue.popleft()
+                piece = await self.read_piece(piece_index)
+                await self.upload_limit.acquire(length)
+                if self.am_choking:
+                    return  # Choked them while we waited; the queue is gone.
+                if begin + length > len(piece):
+                    raise ValueError(
+                        f"{self.peer} requested past the end of piece {piece_index}."
+                    )
+
+                self.send(struct.pack(">IBII", 9 + length, 7, piece_index, begin))
+                self.writer.write(memoryview(piece)[begin : begin + length])
+                self.uploaded += length
+                self.upload_meter.add(length)
+                if self.on_upload:
+                    self.on_upload(length)
+                await self.writer.drain()
+        except (OSError, ValueError) as e:
+            print(f"Stopped uploading to {self.peer}: {e!r}")
+            self.writer.close()  # The read side notices and the session is dropped.
+
+    def handle_piece(self, message: memoryview) -> None:
+        piece_index, begin = struct.unpack_from(">II", message, 1)
+        request = self.requests.in_flight.pop((piece_index, begin), None)
+        if request is None:
+            return  # Cancelled, or sent before the peer saw our CANCEL or choked us.
+
+        sent_at, piece = request
+        piece.requested_by.get(begin, set()).discard(self.requests)
+        with message[9:] as block:
+            self.downloaded += len(block)
+            self.window.on_block(len(block), time.monotonic() - sent_at)
+            if piece.add_block(begin, block, self.requests) and piece.complete:
+                self.completed.append(piece)
+
+    def handle_cancel(self, message: memoryview) -> None:
+        request = struct.unpack_from(">III", message, 1)
+        try:
+            self.upload_queue.remove(request)
+        except ValueError:
+            pass  # Already sent, or never queued.
+
+    def handle_port(self, message: memoryview) -> None:
+        """The peer runs a DHT node on this port (BEP 5); our node may want it."""
+        if self.on_dht_port and len(message) == 3:
+            (port,) = struct.unpack_from(">H", message, 1)
+            if port:
+                self.on_dht_port((self.peer.ip, port))
+
+    def handle_extended(self, message: memoryview) -> None:
+        pass  # Extension messages only matter for metadata exchange.
+
+    def stats(self) -> dict[str, Any]:
+        """This connection's counters, for `Download.stats`."""
+        choked = self.choked_time
+        if self.choked_since is not None:
+            choked += time.monotonic() - self.choked_since
+        return {
+            "peer": str(self.peer),
+            "downloaded": self.downloaded,
+            "uploaded": self.uploaded,
+            "download_rate": round(self.window.meter.current(), 1),
+            "upload_rate": round(self.upload_meter.current(), 1),
+            "rtt": round(self.window.rtt, 6) if self.window.rtt is not None else None,
+            "min_rtt": (
+                round(self.window.min_rtt, 6)
+                if self.window.min_rtt is not None
+                else None
+            ),
+            "requests": len(self.requests) if self.requests is not None else 0,
+            "request_window": self.window.size,
+            "unrequested": len(self.unrequested),
+            "upload_queue": len(self.upload_queue),
+            "peer_choking": self.peer_choking,
+            "am_choking": self.am_choking,
+            "choked_seconds": round(choked, 3),
+        }
+
+    async def close(self) -> None:
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close()
+        if self.requests is not None:
+            self.requests.abandon()
+        if self.uploader is not None:
+            self.uploader.cancel()
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass  # The peer already hung up.
+        self.writer = None
+
+
+class ConnectionBudget:
+    """Caps the peer connections open at once across every pool sharing it."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.open = 0
+        self.freed = asyncio.Event()
+
+    async def acquire(self) -> None:
+        while self.open >= self.limit:
+            await self.freed.wait()
+        self.open += 1
+
+    def try_acquire(self) -> bool:
+        """Takes a slot if one is free right now; for connections peers open to us."""
+        if self.open >= self.limit:
+            return False
+        self.open += 1
+        return True
+
+    def release(self) -> None:
+        self.open -= 1
+        # Wake everyone waiting; whoever runs first takes the slot.
+        self.freed.set()
+        self.freed = asyncio.Event()
+
+
+class PeerPool:
+    """Keeps one session per peer, connecting lazily and reconnecting on demand."""
+
+    def __init__(
+        self,
+        info_hash: bytes,
+        number_of_pieces: int,
+        have: Bitfield | None = None,
+        read_piece: Callable[[int], Awaitable[bytes]] | None = None,
+        download_limit: TokenBucket | None = None,
+        upload_limit: TokenBucket | None = None,
+        connections: ConnectionBudget | None = None,
+    ) -> None:
+        self.info_hash = info_hash
+        self.number_of_pieces = number_of_pieces
+        self.have = have
+        self.read_piece = read_piece
+        self.on_upload: Callable[[int], None] | None = None
+        self.on_interested: Callable[[PeerSession], None] | None = None
+        self.on_dht_port: Callable[[tuple[str, int]], None] | None = None
+        # Shared by every session (and possibly other pools); each session
+        # also gets its own per-peer bucket.
+        self.download_limit = download_limit or TokenBucket(DOWNLOAD_RATE_LIMIT)
+        self.upload_limit = upload_limit or TokenBucket(UPLOAD_RATE_LIMIT)
+        self.connections = connections
+        self.peer_download_rate = PEER_DOWNLOAD_RATE_LIMIT
+        self.peer_upload_rate = PEER_UPLOAD_RATE_LIMIT
+        self.sessions: dict[str, PeerSession] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def new_session(self, peer: Peer) -> PeerSession:
+        session = PeerSession(
+            peer, self.info_hash, self.number_of_pieces, self.have, self.read_piece
+        )
+        session.on_upload = self.on_upload
+        session.on_interested = self.on_interested
+        session.on_dht_port = self.on_dht_port
+        session.download_limit = RateLimit(
+            TokenBucket(self.peer_download_rate), self.download_limit
+        )
+        session.upload_limit = RateLimit(
+            TokenBucket(self.peer_upload_rate), self.upload_limit
+        )
+        return session
+
+    def set_rate_limits(
+        self,
+        download: float | None = UNCHANGED,
+        upload: float | None = UNCHANGED,
+        peer_download: float | None = UNCHANGED,
+        peer_upload: float | None = UNCHANGED,
+    ) -> None:
+        """
+        Changes limits in bytes per second, for live sessions too.
+
+        None lifts a limit; limits that aren't passed stay as they are.
+        """
+        if download is not UNCHANGED:
+            self.download_limit.set_rate(download)
+        if upload is not UNCHANGED:
+            self.upload_limit.set_rate(upload)
+        if peer_download is not UNCHANGED:
+            self.peer_download_rate = peer_download
+            for session in self.sessions.values():
+                session.download_limit.buckets[0].set_rate(peer_download)
+        if peer_upload is not UNCHANGED:
+            self.peer_upload_rate = peer_upload
+            for session in self.sessions.values():
+                session.upload_limit.buckets[0].set_rate(peer_upload)
+
+    async def get(self, peer: Peer) -> PeerSession:
+        """Returns the live session for `peer`, opening a new one if needed."""
+        key = str(peer)
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            session = self.sessions.pop(key, None)
+            if session and session.connected:
+                self.sessions[key] = session
+                return session
+            if session:
+                await session.close()
+
+            if self.connections:
+                await self.connections.acquire()
+            session = self.new_session(peer)
+            if self.connections:
+                session.on_close = self.connections.release
+            try:
+                await session.connect()
+            except BaseException:
+                await session.close()
+                raise
+            self.sessions[key] = session
+            return session
+
+    async def accept(
+        self, peer: Peer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> PeerSession:
+        """Adds a session for a connection the peer opened to us."""
+        if self.connections and not self.connections.try_acquire():
+            raise ConnectionRefusedError("Out of connection slots.")
+        session = self.new_session(peer)
+        if self.connections:
+            session.on_close = self.connections.release
+        try:
+            await session.accept(reader, writer)
+        except BaseException:
+            await session.close()
+            raise
+        self.sessions[str(peer)] = session
+        return session
+
+    def broadcast_have(self, piece_index: int) -> None:
+        for session in self.sessions.values():
+            session.send_have(piece_index)
+
+    async def evict(self, peer: Peer) -> None:
+        """Drops a broken session; the next `get` reconnects."""
+        session = self.sessions.pop(str(peer), None)
+        if session:
+            await session.close()
+
+    async def close(self) -> None:
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        await asyncio.gather(*(session.close() for session in sessions))
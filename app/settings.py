@@ -1 +1,139 @@
+import os
+
 PEER_ID: str = "-CC0001-123456789012"
+
+# Seconds to wait for a peer to accept a TCP connection.
+CONNECT_TIMEOUT: float = 10
+# How many times a peer may drop its connection before we give up on it.
+MAX_PEER_RETRIES: int = 3
+# Seconds of silence on our side before we send a peer a keep-alive.
+KEEPALIVE_INTERVAL: float = 120
+
+# Bounds for the number of block requests in flight to a single peer.
+MIN_REQUEST_WINDOW: int = 2
+MAX_REQUEST_WINDOW: int = 250
+# Seconds worth of a peer's download rate to keep queued on top of its RTT.
+REQUEST_QUEUE_TIME: float = 1.0
+# How often a peer's download rate is re-measured, in seconds.
+RATE_SAMPLE_INTERVAL: float = 0.5
+
+# Where piece hashes are checked: "thread" or "process" pool, and its size
+# (None lets concurrent.futures pick based on the CPU count).
+HASH_EXECUTOR: str = "thread"
+HASH_WORKERS: int | None = None
+# Peers that send this many corrupt pieces are dropped.
+MAX_HASH_FAILURES: int = 3
+# In endgame, how many connections may ask for the same block at once.
+ENDGAME_REQUESTS_PER_BLOCK: int = 2
+# Endgame waits until at most this many blocks per connected peer are missing,
+# so blocks already queued in busy pipelines aren't all fetched twice.
+ENDGAME_BLOCKS_PER_PEER: int = 16
+# Pieces read and hashed at once when re-checking an existing output file.
+RECHECK_CONCURRENCY: int = 8
+# Output files kept open at once; the least recently used is closed first.
+MAX_OPEN_FILES: int = 256
+# Reserve every output file's blocks up front with posix_fallocate instead of
+# leaving them sparse. Guards against running out of space midway, but where
+# the filesystem can't fallocate, glibc writes the whole file out in zeros.
+FALLOCATE: bool = False
+# Bytes of recently uploaded pieces kept in memory.
+READ_CACHE_SIZE: int = 64 * 1024 * 1024
+# Bytes of verified pieces held in memory until they are written; no new
+# pieces are handed out to peers while it is full.
+DISK_CACHE_SIZE: int = 64 * 1024 * 1024
+# Largest single write; adjacent pieces are joined into one write up to this.
+DISK_WRITE_SIZE: int = 8 * 1024 * 1024
+# Seconds a piece may sit in the cache waiting for neighbours to write with.
+DISK_FLUSH_DELAY: float = 0.5
+# Written data is fsynced (and only then recorded in the resume file) every
+# this many seconds, or once this many bytes are waiting, whichever is first.
+DISK_SYNC_INTERVAL: float = 5
+DISK_SYNC_SIZE: int = 256 * 1024 * 1024
+# REQUESTs a peer may have queued with us at once; extras are dropped.
+MAX_UPLOAD_REQUESTS: int = 250
+# Bytes per second allowed across all peers, and to or from any single peer;
+# None is unlimited. PeerPool.set_rate_limits changes them while running.
+DOWNLOAD_RATE_LIMIT: float | None = None
+UPLOAD_RATE_LIMIT: float | None = None
+PEER_DOWNLOAD_RATE_LIMIT: float | None = None
+PEER_UPLOAD_RATE_LIMIT: float | None = None
+# Seconds of unused allowance a rate limit saves up for bursts.
+RATE_LIMIT_BURST: float = 1.0
+# Bytes of pieces a streaming download holds in memory; pieces further past
+# the playhead aren't requested until it catches up.
+STREAM_BUFFER_SIZE: int = 32 * 1024 * 1024
+# Peers we upload to at once, one of them the optimistic unchoke.
+UNCHOKE_SLOTS: int = 4
+# Seconds between re-ranking peers, and between optimistic unchoke rotations.
+CHOKE_INTERVAL: float = 10
+OPTIMISTIC_UNCHOKE_INTERVAL: float = 30
+
+# Port we tell trackers (and later, peers) that we listen on.
+LISTEN_PORT: int = 6881
+# Seconds before giving up on a tracker request.
+TRACKER_TIMEOUT: float = 15
+# Re-announce interval to use when the tracker doesn't specify one.
+DEFAULT_ANNOUNCE_INTERVAL: int = 1800
+# The "completed"/"stopped" announce on exit gets a shorter leash.
+FINAL_ANNOUNCE_TIMEOUT: float = 2
+# Bytes pulled off a peer socket per read; several messages are framed per read.
+READ_CHUNK_SIZE: int = 256 * 1024
+
+# Peers asked for a magnet's metadata at once, and pieces requested from each.
+METADATA_PEERS: int = 4
+METADATA_REQUESTS_PER_PEER: int = 4
+# Seconds a peer may go quiet while we wait on its metadata.
+METADATA_TIMEOUT: float = 15
+# Where verified magnet metadata is kept, and how big that directory may grow.
+METADATA_CACHE_DIR: str = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "bittorrent",
+    "metadata",
+)
+METADATA_CACHE_SIZE: int = 64 * 1024 * 1024
+
+# The daemon's control socket.
+CONTROL_SOCKET: str = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or "/tmp", f"bittorrent-{os.getuid()}.sock"
+)
+# Peer connections the daemon keeps open across all of its torrents.
+MAX_CONNECTIONS: int = 200
+# Threads writing pieces to disk; the daemon's torrents share one pool of them.
+DISK_WORKERS: int = 4
+
+# Seconds between progress lines; None turns them off, along with STATS_FILE.
+STATS_INTERVAL: float | None = 1.0
+# A file to rewrite with the full stats as JSON after every progress line.
+STATS_FILE: str | None = os.environ.get("BITTORRENT_STATS_FILE")
+# Localhost port serving Prometheus metrics at /metrics and JSON at /stats.
+METRICS_PORT: int | None = (
+    int(os.environ["BITTORRENT_METRICS_PORT"])
+    if os.environ.get("BITTORRENT_METRICS_PORT")
+    else None
+)
+
+# Whether to join the DHT (BEP 5) at all; BITTORRENT_DHT=0 keeps to trackers.
+DHT_ENABLED: bool = os.environ.get("BITTORRENT_DHT", "1") != "0"
+# UDP port our DHT node listens on.
+DHT_PORT: int = 6881
+# Nodes a DHT node with an empty routing table asks first.
+DHT_BOOTSTRAP_NODES: list[tuple[str, int]] = [
+    ("router.bittorrent.com", 6881),
+    ("dht.transmissionbt.com", 6881),
+    ("router.utorrent.com", 6881),
+]
+# Where the DHT node keeps its ID and the nodes it knows between runs.
+DHT_STATE_FILE: str = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "bittorrent",
+    "dht.dat",
+)
+# Nodes per routing table bucket, and how many a lookup homes in on (Kademlia's k).
+DHT_BUCKET_SIZE: int = 8
+# Queries a lookup keeps in flight at once (Kademlia's alpha).
+DHT_ALPHA: int = 4
+# Seconds to wait for one node's reply, and for a whole lookup.
+DHT_QUERY_TIMEOUT: float = 2
+DHT_LOOKUP_TIMEOUT: float = 15
+# Failed queries in a row before a node may be replaced in its bucket.
+DHT_MAX_FAILURES: int = 2
@@ -0,0 +1,328 @@
+"""
+Cheap counters for the hot path, and the ways they are read back out.
+
+Sessions and downloads only bump counters, smooth rates and drop timings into
+fixed-bucket histograms as blocks and pieces go by. The expensive part
+(formatting) happens on a timer, or when somebody asks:
+- `StatsReporter` prints a progress line every STATS_INTERVAL. With
+  STATS_FILE set, it also rewrites that file with the full stats as JSON.
+- `MetricsServer` serves the same numbers on localhost. /metrics has them in
+  Prometheus' text format, /stats as JSON.
+
+Both read `Download.stats()` snapshots, plain dicts, through a callable.
+That way the daemon can hand them all of its torrents at once.
+"""
+
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import time
+from typing import Any, Callable, Iterable
+
+from app.settings import METRICS_PORT, RATE_SAMPLE_INTERVAL, STATS_FILE, STATS_INTERVAL
+
+# Histogram upper bounds in seconds: for disk and hashing, and for whole pieces.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+PIECE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Snapshots = Callable[[], Iterable[dict[str, Any]]]
+
+
+class RateMeter:
+    """Bytes per second, averaged over RATE_SAMPLE_INTERVAL, then smoothed."""
+
+    __slots__ = ("rate", "_sample_start", "_sample_bytes")
+
+    def __init__(self) -> None:
+        self.rate = 0.0
+        self._sample_start = time.monotonic()
+        self._sample_bytes = 0
+
+    def add(self, n: int) -> bool:
+        """Counts `n` bytes; True when that closed a sample and moved `rate`."""
+        now = time.monotonic()
+        self._sample_bytes += n
+        elapsed = now - self._sample_start
+        if elapsed < RATE_SAMPLE_INTERVAL:
+            return False
+        sample = self._sample_bytes / elapsed
+        self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+        self._sample_start = now
+        self._sample_bytes = 0
+        return True
+
+    def current(self) -> float:
+        """The rate as of now, so a peer that went quiet decays towards 0."""
+        self.add(0)
+        return self.rate
+
+
+class Histogram:
+    """Counts observations into fixed buckets, like a Prometheus histogram."""
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | str | None:
+        """The upper bound of the bucket holding the `q` quantile; None if empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return "+Inf"
+
+    def to_dict(self) -> dict[str, Any]:
+        cumulative = itertools.accumulate(self.counts)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            # Observations at or under each upper bound, as Prometheus counts them.
+            "buckets": dict(zip([*map(str, self.bounds), "+Inf"], cumulative)),
+        }
+
+
+def format_rate(rate: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if rate < 1024:
+            return f"{rate:.1f} {unit}/s"
+        rate /= 1024
+    return f"{rate:.1f} GiB/s"
+
+
+def progress_line(stats: dict[str, Any]) -> str:
+    done, pieces = stats["pieces_done"], stats["pieces"]
+    percent = 100 * done / max(pieces, 1)
+    down, up = format_rate(stats["download_rate"]), format_rate(stats["upload_rate"])
+    line = (
+        f"📊 {stats['name']}: {done}/{pieces} pieces ({percent:.1f}%),"
+        f" ⬇️ {down} ⬆️ {up}, {stats['peers']} peers"
+    )
+    rate, left = stats["download_rate"], stats.get("left")
+    if rate and left:
+        line += f", {left / rate:.0f}s left"
+    return line
+
+
+class StatsReporter:
+    """Prints a progress line per download, and keeps STATS_FILE up to date."""
+
+    def __init__(
+        self,
+        snapshots: Snapshots,
+        interval: float | None = STATS_INTERVAL,
+        path: str | None = STATS_FILE,
+    ) -> None:
+        self.snapshots = snapshots
+        self.interval = interval
+        self.path = path
+
+    async def run(self) -> None:
+        if not self.interval:
+            return
+        failure = None
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.report()
+                failure = None
+            except OSError as e:
+                if repr(e) != failure:  # Once per problem, not every interval.
+                    print(f"Couldn't write the stats: {e!r}")
+                failure = repr(e)
+
+    def report(self) -> None:
+        snapshots = list(self.snapshots())
+        for stats in snapshots:
+            print(progress_line(stats))
+        if self.path:
+            # Written aside and renamed, so readers never see half a file.
+            partial = self.path + ".part"
+            with open(partial, "w") as file:
+                json.dump({"time": time.time(), "downloads": snapshots}, file, indent=2)
+            os.replace(partial, self.path)
+
+
+def render_prometheus(snapshots: Iterable[dict[str, Any]]) -> str:
+    """The stats in Prometheus' text exposition format."""
+    families: dict[str, tuple[str, str, list[str]]] = {}
+
+    def add(
+        name: str, kind: str, help: str, labels: dict[str, str], value: Any
+    ) -> None:
+        label_text = ",".join(f'{key}="{text}"' for key, text in labels.items())
+        families.setdefault(name, (kind, help, []))[2].append(
+            f"{name}{{{label_text}}} {value}"
+        )
+
+    def sample(
+        name: str, kind: str, help: str, labels: dict[str, str], value: Any
+    ) -> None:
+        if value is not None:
+            add(
+                f"{name}_total" if kind == "counter" else name,
+                kind,
+                help,
+                labels,
+                value,
+            )
+
+    def histogram(
+        name: str, help: str, labels: dict[str, str], histogram: dict
+    ) -> None:
+        families.setdefault(name, ("histogram", help, []))
+        for bound, count in histogram["buckets"].items():
+            add(f"{name}_bucket", "", "", {**labels, "le": bound}, count)
+        add(f"{name}_sum", "", "", labels, histogram["sum"])
+        add(f"{name}_count", "", "", labels, histogram["count"])
+
+    for stats in snapshots:
+        labels = {"info_hash": stats["info_hash"]}
+        for key, kind, help in (
+            ("pieces", "gauge", "Pieces in the torrent."),
+            ("pieces_done", "gauge", "Pieces downloaded and verified."),
+            ("downloaded", "counter", "Verified bytes downloaded."),
+            ("uploaded", "counter", "Bytes uploaded."),
+            ("left", "gauge", "Bytes still to download."),
+            (
+                "disk_cache_bytes",
+                "gauge",
+                "Verified bytes waiting to be written to disk.",
+            ),
+            ("peers", "gauge", "Connected peers."),
+            ("download_rate", "gauge", "Download rate in bytes per second."),
+            ("upload_rate", "gauge", "Upload rate in bytes per second."),
+            ("hash_failures", "counter", "Pieces that failed the hash check."),
+        ):
+            sample(f"bittorrent_{key}", kind, help, labels, stats.get(key))
+        for key, help in (
+            ("verify_seconds", "Time to hash-check a piece."),
+            ("disk_write_seconds", "Time to write a run of adjacent pieces out."),
+            (
+                "disk_sync_seconds",
+                "Time to fsync the files written since the last sync.",
+            ),
+            ("piece_seconds", "Time from assigning a piece to storing it."),
+        ):
+            histogram(f"bittorrent_{key}", help, labels, stats[key])
+
+        for peer in stats["peer_stats"]:
+            peer_labels = {**labels, "peer": peer["peer"]}
+            for key, kind, help in (
+                (
+                    "download_rate",
+                    "gauge",
+                    "Download rate from the peer in bytes per second.",
+                ),
+                (
+                    "upload_rate",
+                    "gauge",
+                    "Upload rate to the peer in bytes per second.",
+                ),
+                ("downloaded", "counter", "Bytes received from the peer."),
+                ("uploaded", "counter", "Bytes sent to the peer."),
+                ("rtt", "gauge", "Smoothed seconds from REQUEST to PIECE."),
+                ("requests", "gauge", "Our block requests in flight to the peer."),
+                (
+                    "request_window",
+                    "gauge",
+                    "How many requests the peer may have in flight.",
+                ),
+                ("upload_queue", "gauge", "The peer's requests waiting on us."),
+                ("choked_seconds", "counter", "Seconds the peer has kept us choked."),
+            ):
+                sample(f"bittorrent_peer_{key}", kind, help, peer_labels, peer.get(key))
+
+    lines = []
+    for name, (kind, help, samples) in families.items():
+        if kind:  # Histogram series are listed under their family's header.
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text) and /stats (JSON) on localhost."""
+
+    def __init__(self, snapshots: Snapshots, port: int | None = METRICS_PORT) -> None:
+        self.snapshots = snapshots
+        self.port = port
+        self.server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        if self.port is None:
+            return
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+        print(f"📈 Serving metrics on http://127.0.0.1:{self.port}/metrics.")
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1].split(b"?")[0]
+            if path == b"/metrics":
+                status, kind = "200 OK", "text/plain; version=0.0.4"
+                body = render_prometheus(self.snapshots()).encode()
+            elif path == b"/stats":
+                status, kind = "200 OK", "application/json"
+                body = json.dumps(list(self.snapshots()), indent=2).encode()
+            else:
+                status, kind, body = (
+                    "404 Not Found",
+                    "text/plain",
+                    b"Try /metrics or /stats.\n",
+                )
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {kind}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            IndexError,
+            OSError,
+        ):
+            pass  # Not HTTP, or the client left.
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
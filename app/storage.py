@@ -0,0 +1,452 @@
+"""
+Writes verified pieces to their offsets in preallocated output files.
+
+A torrent's data is the concatenation of its files, so a piece can start in
+one file and end in the next. `Storage` keeps the start offset of every file
+and splits each write into per-file segments, one pwritev on that file's
+handle per segment.
+
+Downloads don't write pieces themselves: they hand them to a
+`WriteBackCache`, which joins adjacent pieces into large sequential writes
+on a pool of disk threads and fsyncs in batches. Pieces we upload are
+served from `PieceCache`, or straight from the write cache while they are
+still on their way to disk.
+"""
+
+import asyncio
+import contextlib
+import functools
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import Executor
+from typing import Callable, Iterator, Sequence
+
+from app.settings import (
+    DISK_CACHE_SIZE,
+    DISK_FLUSH_DELAY,
+    DISK_SYNC_INTERVAL,
+    DISK_SYNC_SIZE,
+    DISK_WRITE_SIZE,
+    FALLOCATE,
+    MAX_OPEN_FILES,
+    READ_CACHE_SIZE,
+)
+from app.stats import Histogram
+
+IOV_MAX = 1024  # Buffers one pwritev may take, on Linux and macOS alike.
+
+Buffer = bytes | bytearray | memoryview
+
+
+def split_buffers(
+    buffers: Sequence[Buffer], n: int
+) -> tuple[list[Buffer], list[Buffer]]:
+    """Splits a list of buffers after its first `n` bytes, without copying."""
+    head: list[Buffer] = []
+    for i, buffer in enumerate(buffers):
+        if n < len(buffer):
+            if n:
+                head.append(buffer[:n])
+            return head, [buffer[n:], *buffers[i + 1 :]]
+        head.append(buffer)
+        n -= len(buffer)
+    return head, []
+
+
+class Storage:
+    """
+    The output files, sized up front so pieces can land in any order. They
+    stay sparse until written unless `fallocate` reserves their blocks.
+
+    At most `max_open_files` handles are kept open, least recently used
+    first out, so torrents with thousands of small files neither run out of
+    descriptors nor reopen a file for every piece. `lock` only guards the
+    handle table: reads and writes run on several threads at once, and a
+    handle in use is never closed under them.
+    """
+
+    def __init__(
+        self,
+        files: list[tuple[str, int]],
+        piece_length: int,
+        max_open_files: int = MAX_OPEN_FILES,
+        fallocate: bool = FALLOCATE,
+    ) -> None:
+        self.files = files
+        self.piece_length = piece_length
+        self.max_open_files = max_open_files
+        self.fallocate = fallocate
+        self.offsets = []
+        offset = 0
+        for _, length in files:
+            self.offsets.append(offset)
+            offset += length
+        self.length = offset
+        self.handles: OrderedDict[int, int] = OrderedDict()
+        self.in_use: Counter[int] = Counter()  # Threads using each file's handle.
+        self.dirty: set[int] = set()  # Files written to since the last `sync`.
+        # Pieces are read and written from executor threads.
+        self.lock = threading.Lock()
+
+    def exists(self) -> bool:
+        """True if any of the files is already on disk, e.g. from an earlier run."""
+        return any(os.path.exists(path) for path, _ in self.files)
+
+    def preallocate(self) -> None:
+        """Creates the files at their full size; call before reading or writing."""
+        for file_index, (path, length) in enumerate(self.files):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self.lock:
+                fd = self._handle(file_index)
+                if os.fstat(fd).st_size != length:
+                    # Sparse until written, so this is instant even for huge files.
+                    os.ftruncate(fd, length)
+                if self.fallocate and length and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(fd, 0, length)
+                    except OSError:
+                        pass  # Out of space or unsupported; stay sparse.
+
+    def _handle(self, file_index: int) -> int:
+        """An open descriptor for a file; call with `lock` held."""
+        fd = self.handles.get(file_index)
+        if fd is not None:
+            self.handles.move_to_end(file_index)
+            return fd
+
+        if len(self.handles) >= self.max_open_files:
+            # Over the limit for a moment if every handle is busy.
+            idle = next((i for i in self.handles if not self.in_use[i]), None)
+            if idle is not None:
+                self._close(idle)
+        fd = os.open(self.files[file_index][0], os.O_RDWR | os.O_CREAT, 0o644)
+        self.handles[file_index] = fd
+        return fd
+
+    def _close(self, file_index: int) -> None:
+        """
+        Closes a file's handle; call with `lock` held.
+
+        A dirty file stays in `dirty`: the next `sync` reopens it, and fsync
+        on any descriptor flushes the file, so eviction never waits on disk.
+        """
+        os.close(self.handles.pop(file_index))
+
+    @contextlib.contextmanager
+    def _open(self, file_index: int) -> Iterator[int]:
+        """A file's descriptor, kept open until the block exits."""
+        with self.lock:
+            fd = self._handle(file_index)
+            self.in_use[file_index] += 1
+        try:
+            yield fd
+        finally:
+            with self.lock:
+                self.in_use[file_index] -= 1
+
+    def segments(self, offset: int, length: int) -> Iterator[tuple[int, int, int, int]]:
+        """
+        Splits a byte range of the torrent into per-file pieces.
+
+        Yields `(file_index, file_offset, start, end)`, where `start:end` is
+        the matching slice of the range itself.
+        """
+        file_index = bisect_right(self.offsets, offset) - 1
+        start = 0
+        while start < length:
+            file_offset = offset + start - self.offsets[file_index]
+            end = min(length, start + self.files[file_index][1] - file_offset)
+            if end > start:
+                yield file_index, file_offset, start, end
+            start = end
+            file_index += 1
+
+    def write(self, offset: int, buffers: Sequence[Buffer]) -> None:
+        """Writes `buffers` back to back, starting at byte `offset` of the torrent."""
+        rest = [memoryview(buffer) for buffer in buffers]
+        length = sum(len(buffer) for buffer in rest)
+        for file_index, file_offset, start, end in self.segments(offset, length):
+            segment, rest = split_buffers(rest, end - start)
+            with self._open(file_index) as fd:
+                while segment:
+                    written = os.pwritev(fd, segment[:IOV_MAX], file_offset)
+                    file_offset += written
+                    _, segment = split_buffers(segment, written)
+            with self.lock:
+                # Only once written, so a `sync` that misses this write leaves it dirty.
+                self.dirty.add(file_index)
+
+    def write_piece(self, piece_index: int, data: Buffer) -> None:
+        self.write(piece_index * self.piece_length, [data])
+
+    def read_piece(self, piece_index: int, piece_length: int) -> bytes:
+        chunks = []
+        for file_index, file_offset, start, end in self.segments(
+            piece_index * self.piece_length, piece_length
+        ):
+            with self._open(file_index) as fd:
+                chunks.append(os.pread(fd, end - start, file_offset))
+        return b"".join(chunks)
+
+    def sync(self) -> None:
+        """Flushes every file written to since the last sync to stable storage."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for file_index in sorted(dirty):
+            with self._open(file_index) as fd:
+                os.fsync(fd)
+
+    def close(self) -> None:
+        with self.lock:
+            while self.handles:
+                self._close(next(iter(self.handles)))
+
+    def __enter__(self) -> "Storage":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class WriteBackCache:
+    """
+    Verified pieces waiting to be written, at most `max_bytes` of them.
+
+    `put` only queues a piece; a background task writes them out. It lets
+    pieces gather for DISK_FLUSH_DELAY (or until the cache is half full),
+    then writes each run of adjacent pieces, up to DISK_WRITE_SIZE, with a
+    single pwritev, several runs at once on `executor`. Written files are
+    fsynced together every DISK_SYNC_INTERVAL or DISK_SYNC_SIZE bytes, and
+    only then are the pieces passed to `on_durable`, so whatever records
+    progress never claims a piece a crash could still lose.
+
+    While the cache is full `put` waits, and `full` tells the download to
+    stop handing out new pieces; `on_drained` is called once there is room.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        executor: Executor | None = None,
+        max_bytes: int = DISK_CACHE_SIZE,
+        write_time: Histogram | None = None,
+        sync_time: Histogram | None = None,
+    ) -> None:
+        self.storage = storage
+        self.executor = executor
+        self.max_bytes = max_bytes
+        self.write_time = write_time or Histogram()
+        self.sync_time = sync_time or Histogram()
+        self.dirty: dict[int, Buffer] = {}  # Waiting to be written.
+        self.writing: dict[int, Buffer] = {}  # Being written.
+        self.unsynced: list[int] = []  # Written, not yet fsynced.
+        self.size = 0  # Bytes in `dirty` and `writing`.
+        self.dirty_bytes = 0
+        self.unsynced_bytes = 0
+        self.dirty_since = 0.0
+        self.synced_at = time.monotonic()
+        self.writes: set[asyncio.Future] = set()
+        self.sync_lock = asyncio.Lock()
+        self.error: BaseException | None = None
+        self.closing = False
+        self.added = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.on_durable: Callable[[list[int]], None] | None = None
+        self.on_drained: Callable[[], None] | None = None
+        self.flusher = asyncio.create_task(self.run())
+
+    @property
+    def full(self) -> bool:
+        return self.size >= self.max_bytes
+
+    def get(self, piece_index: int) -> Buffer | None:
+        """A piece that hasn't reached the disk yet, or None."""
+        piece = self.dirty.get(piece_index)
+        return piece if piece is not None else self.writing.get(piece_index)
+
+    async def put(self, piece_index: int, data: Buffer) -> None:
+        """Queues a piece for writing, first waiting for room if the cache is full."""
+        while self.full and self.error is None:
+            await self.drained.wait()
+        if self.error is not None:
+            raise self.error
+        if not self.dirty:
+            self.dirty_since = time.monotonic()
+        self.dirty[piece_index] = data
+        self.size += len(data)
+        self.dirty_bytes += len(data)
+        self.added.set()
+        self.added = asyncio.Event()
+
+    async def run(self) -> None:
+        """Writes and syncs whatever is due, sleeping until something next is."""
+        while not self.closing and self.error is None:
+            added = self.added
+            now = time.monotonic()
+            write_at = self.dirty_since + DISK_FLUSH_DELAY if self.dirty else None
+            sync_at = self.synced_at + DISK_SYNC_INTERVAL if self.unsynced else None
+            if write_at is not None and (
+                now >= write_at or self.dirty_bytes >= self.max_bytes // 2
+            ):
+                await self.write_dirty()
+            elif sync_at is not None and (
+                now >= sync_at or self.unsynced_bytes >= DISK_SYNC_SIZE
+            ):
+                await self.sync()
+            else:
+                deadlines = [at for at in (write_at, sync_at) if at is not None]
+                timeout = min(deadlines) - now if deadlines else None
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(added.wait(), timeout)
+
+    def runs(self) -> list[list[int]]:
+        """Moves the dirty pieces to `writing`, grouped into runs to write in one go."""
+        runs: list[list[int]] = []
+        run_bytes = 0
+        for piece_index in sorted(self.dirty):
+            data = self.dirty.pop(piece_index)
+            self.writing[piece_index] = data
+            adjacent = runs and runs[-1][-1] == piece_index - 1
+            if adjacent and run_bytes + len(data) <= DISK_WRITE_SIZE:
+                runs[-1].append(piece_index)
+                run_bytes += len(data)
+            else:
+                runs.append([piece_index])
+                run_bytes = len(data)
+        self.dirty_bytes = 0
+        return runs
+
+    async def write_dirty(self) -> None:
+        loop = asyncio.get_running_loop()
+        for run in self.runs():
+            future = loop.run_in_executor(
+                self.executor,
+                self.storage.write,
+                run[0] * self.storage.piece_length,
+                [self.writing[piece_index] for piece_index in run],
+            )
+            self.writes.add(future)
+            future.add_done_callback(
+                functools.partial(self.written, run, time.monotonic())
+            )
+        # `wait` rather than `gather`: being cancelled here mustn't cancel the writes.
+        if self.writes:
+            await asyncio.wait(list(self.writes))
+
+    def written(self, run: list[int], started: float, future: asyncio.Future) -> None:
+        self.writes.discard(future)
+        error = future.exception()
+        if error is not None:
+            self.error = self.error or error
+            self.wake_writers()  # So they see the error instead of waiting for room.
+            return
+        self.write_time.observe(time.monotonic() - started)
+        was_full = self.full
+        for piece_index in run:
+            length = len(self.writing.pop(piece_index))
+            self.size -= length
+            self.unsynced_bytes += length
+        self.unsynced.extend(run)
+        if was_full and not self.full:
+            self.wake_writers()
+
+    def wake_writers(self) -> None:
+        self.drained.set()
+        self.drained = asyncio.Event()
+        if self.on_drained:
+            self.on_drained()
+
+    async def sync(self) -> None:
+        """Fsyncs everything written so far and reports those pieces as durable."""
+        async with self.sync_lock:
+            pieces, self.unsynced = self.unsynced, []
+            self.unsynced_bytes = 0
+            self.synced_at = started = time.monotonic()
+            if not pieces:
+                return
+            await asyncio.shield(
+                asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.storage.sync
+                )
+            )
+            self.sync_time.observe(time.monotonic() - started)
+            if self.on_durable:
+                self.on_durable(pieces)
+
+    async def flush(self) -> None:
+        """Writes and fsyncs every piece put so far; raises if any write failed."""
+        await self.write_dirty()
+        if self.error is None:
+            await self.sync()
+        if self.error is not None:
+            raise self.error
+
+    async def close(self) -> None:
+        self.closing = True
+        self.added.set()
+        await asyncio.gather(self.flusher, return_exceptions=True)
+        await self.flush()
+
+
+class PieceCache:
+    """
+    Recently uploaded pieces, least recently used out once over `max_bytes`.
+
+    Peers tend to ask for the same fresh pieces, so whole pieces are read
+    once, off the event loop, and every block request for them after that
+    is a slice of memory. Concurrent misses on one piece share a single read.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        get_piece_length: Callable[[int], int],
+        max_bytes: int = READ_CACHE_SIZE,
+        write_cache: WriteBackCache | None = None,
+    ) -> None:
+        self.storage = storage
+        self.get_piece_length = get_piece_length
+        self.max_bytes = max_bytes
+        self.write_cache = write_cache  # Pieces not on disk yet are served from here.
+        self.size = 0
+        self.pieces: OrderedDict[int, bytes] = OrderedDict()
+        self.loading: dict[int, asyncio.Future[bytes]] = {}
+
+    async def get(self, piece_index: int) -> Buffer:
+        if self.write_cache is not None:
+            pending = self.write_cache.get(piece_index)
+            if pending is not None:
+                return pending
+        piece = self.pieces.get(piece_index)
+        if piece is not None:
+            self.pieces.move_to_end(piece_index)
+            return piece
+
+        loading = self.loading.get(piece_index)
+        if loading is None:
+            loading = asyncio.get_running_loop().run_in_executor(
+                None,
+                self.storage.read_piece,
+                piece_index,
+                self.get_piece_length(piece_index),
+            )
+            self.loading[piece_index] = loading
+            loading.add_done_callback(lambda future: self._loaded(piece_index, future))
+        # Shielded so one requester going away doesn't cancel the read for the rest.
+        return await asyncio.shield(loading)
+
+    def _loaded(self, piece_index: int, future: asyncio.Future[bytes]) -> None:
+        del self.loading[piece_index]
+        if future.cancelled() or future.exception():
+            return
+        piece = future.result()
+        self.pieces[piece_index] = piece
+        self.size += len(piece)
+        while self.size > self.max_bytes and self.pieces:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
@@ -0,0 +1,98 @@
+"""
+Streams a torrent's content in order to stdout or a pipe, without touching disk.
+
+Example call:
+python app/main.py download --stream - sample.torrent | ingest
+
+Only pieces within STREAM_BUFFER_SIZE of the playhead (the next piece to be
+written) are handed to peers, lowest index first. Pieces that complete out of
+order wait in memory until the playhead reaches them. A slow reader holds the
+playhead back, and with it what gets requested, so memory stays bounded.
+"""
+
+import asyncio
+import contextlib
+import sys
+import time
+from typing import BinaryIO, Iterable
+
+from app.downloader import Download, run_with_server
+from app.models import Torrent
+from app.network import PieceBuffer
+from app.settings import STREAM_BUFFER_SIZE
+
+
+class StreamDownload(Download):
+    """One torrent being written, in order, to a binary file object."""
+
+    def __init__(
+        self, torrent: Torrent, output: BinaryIO, max_buffer: int = STREAM_BUFFER_SIZE
+    ) -> None:
+        super().__init__(torrent, getattr(output, "name", "-"))
+        self.output = output
+        self.window_pieces = max(1, max_buffer // torrent.piece_length)
+        self.playhead = 0
+        self.ready: dict[int, bytearray] = {}  # Verified pieces past the playhead.
+        self.arrived = asyncio.Event()
+
+    def open(self) -> None:
+        # Nothing is kept once written, so there is nothing to upload either.
+        self.scheduler.set_window(0, self.window_pieces)
+        self.writer = asyncio.create_task(self.write_out())
+
+    async def restore(self) -> None:
+        pass  # Every run starts from the first byte.
+
+    async def store(self, piece: PieceBuffer) -> None:
+        self.ready[piece.index] = piece.data
+        self.arrived.set()
+        self.arrived = asyncio.Event()
+
+    def endgame_candidates(self) -> Iterable[PieceBuffer]:
+        # The window is all assigned most of the time; only a stall at the
+        # playhead is worth fetching a piece twice for.
+        piece = self.buffers.get(self.playhead)
+        return [piece] if piece else []
+
+    async def write_out(self) -> None:
+        """Writes pieces as the playhead reaches them, moving the window along."""
+        loop = asyncio.get_running_loop()
+        try:
+            while self.playhead < len(self.torrent.pieces):
+                while self.playhead not in self.ready:
+                    await self.arrived.wait()
+                # Blocks in a thread, so a full pipe stalls the playhead, not the loop.
+                started = time.monotonic()
+                await loop.run_in_executor(None, self.write, self.ready[self.playhead])
+                self.disk_write_time.observe(time.monotonic() - started)
+                del self.ready[self.playhead]
+                self.playhead += 1
+                self.scheduler.set_window(
+                    self.playhead, self.playhead + self.window_pieces
+                )
+        except OSError as e:
+            if not self.failed.done():
+                self.failed.set_exception(e)
+
+    def write(self, data: bytearray) -> None:
+        self.output.write(data)
+        self.output.flush()
+
+    async def close(self, finished: bool) -> None:
+        if finished:
+            await self.writer  # Flush the tail.
+        else:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+
+
+async def stream_torrent(torrent: Torrent, output_path: str) -> None:
+    """Streams the torrent to `output_path`, "-" for stdout; progress goes to stderr."""
+    with contextlib.ExitStack() as stack:
+        if output_path == "-":
+            output = sys.stdout.buffer
+        else:
+            output = stack.enter_context(open(output_path, "wb"))
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        print(f"Total number of pieces: {len(torrent.pieces)}")
+        await run_with_server(StreamDownload(torrent, output))
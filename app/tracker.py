@@ -0,0 +1,173 @@
+"""
+Announces to the torrent's trackers, and the DHT, without blocking the event loop.
+
+Every HTTP tracker the torrent lists is asked at once, each request on a
+worker thread via `requests`, so a slow or dead tracker never stalls peer
+sockets or the other trackers. Their peer lists are merged. With a DHT node,
+a `get_peers` lookup runs alongside. It also announces us on the DHT, but
+only when a `PeerServer` is listening for the peers that sends our way. When
+the trackers come back with peers, the lookup finishes in the background and
+hands its peers to `on_peers`. When there are no trackers, or none of them
+had peers, the announce waits for the lookup.
+
+Peers are cached on the torrent for as long as the trackers' `interval` says,
+and `run` keeps re-announcing in the background so we learn about new peers
+as the swarm churns.
+"""
+
+import asyncio
+import time
+from typing import Callable
+
+import requests
+
+from app.dht import DHTNode
+from app.models import Peer, Torrent
+from app.server import PeerServer
+from app.settings import (
+    DEFAULT_ANNOUNCE_INTERVAL,
+    FINAL_ANNOUNCE_TIMEOUT,
+    TRACKER_TIMEOUT,
+)
+
+
+class TrackerClient:
+    def __init__(
+        self,
+        torrent: Torrent,
+        dht: DHTNode | None = None,
+        server: PeerServer | None = None,
+    ) -> None:
+        self.torrent = torrent
+        self.dht = dht
+        self.server = server  # Where peers we announce to the DHT can reach us.
+        # We only speak HTTP(S) to trackers; udp:// ones (BEP 15) are skipped.
+        self.urls = [
+            url for url in torrent.trackers if url.startswith(("http://", "https://"))
+        ]
+        self.uploaded = 0
+        self.downloaded = 0
+        self.left: int | None = None  # Defaults to the torrent length.
+        self.on_peers: Callable[[list[Peer]], None] | None = None
+        self.started = False
+        # DHT lookups still running in the background.
+        self.lookups: set[asyncio.Task] = set()
+
+    async def announce(
+        self, event: str | None = None, timeout: float = TRACKER_TIMEOUT
+    ) -> list[Peer]:
+        if event is None and not self.started:
+            event = "started"
+        params = self.torrent.announce_params(
+            uploaded=self.uploaded,
+            downloaded=self.downloaded,
+            left=self.left,
+            event=event,
+        )
+        lookup = None
+        if self.dht is not None and event not in ("stopped", "completed"):
+            # Only claim a port on the DHT when something is listening on it.
+            listening = self.server is not None and self.server.server is not None
+            lookup = asyncio.create_task(
+                self.dht.get_peers(
+                    bytes.fromhex(self.torrent.info_hash),
+                    self.server.port if listening else None,
+                )
+            )
+        try:
+            results = await asyncio.gather(
+                *(self.announce_to(url, params, timeout) for url in self.urls),
+                return_exceptions=True,
+            )
+        except BaseException:
+            if lookup is not None:
+                lookup.cancel()
+            raise
+
+        peers: list[Peer] = []
+        intervals = []
+        errors = []
+        for url, result in zip(self.urls, results):
+            if isinstance(result, BaseException):
+                errors.append(result)
+                if len(self.urls) > 1:
+                    print(f"Tracker {url} failed: {result!r}")
+            else:
+                peers += result[0]
+                intervals.append(result[1])
+        if intervals:
+            self.started = True
+
+        if lookup is not None and peers:
+            self.lookups.add(lookup)
+            lookup.add_done_callback(self.on_lookup_done)
+        elif lookup is not None:
+            peers = await lookup
+        elif errors and not intervals:
+            raise errors[0]
+        elif not self.urls:
+            raise ConnectionError("No HTTP trackers to announce to, and no DHT.")
+
+        return self.torrent.set_peers(
+            Peer.unique(peers), min(intervals, default=DEFAULT_ANNOUNCE_INTERVAL)
+        )
+
+    async def announce_to(
+        self, url: str, params: dict, timeout: float
+    ) -> tuple[list[Peer], int]:
+        response = await asyncio.to_thread(
+            requests.get, url, params=params, timeout=timeout
+        )
+        response.raise_for_status()
+        return Torrent.parse_announce(response.content)
+
+    def on_lookup_done(self, lookup: asyncio.Task) -> None:
+        """Adds peers from a DHT lookup that outlived its announce."""
+        self.lookups.discard(lookup)
+        if lookup.cancelled() or lookup.exception() is not None:
+            return
+        known = set(self.torrent.peers or [])
+        new_peers = [peer for peer in lookup.result() if peer not in known]
+        if new_peers:
+            self.torrent.peers = [*(self.torrent.peers or []), *new_peers]
+            if self.on_peers:
+                self.on_peers(new_peers)
+
+    async def get_peers(self) -> list[Peer]:
+        """Returns the cached peer list, announcing only once it has expired."""
+        if (
+            self.torrent.peers is not None
+            and time.monotonic() < self.torrent.peers_expire_at
+        ):
+            return self.torrent.peers
+        return await self.announce()
+
+    async def run(self) -> None:
+        """Re-announces every interval, passing newly seen peers to `on_peers`."""
+        while True:
+            await asyncio.sleep(max(self.torrent.peers_expire_at - time.monotonic(), 0))
+            known = set(self.torrent.peers or [])
+            try:
+                peers = await self.announce()
+            except (requests.RequestException, ConnectionError, ValueError) as e:
+                print(f"Re-announce failed, retrying later: {e!r}")
+                self.torrent.peers_expire_at = (
+                    time.monotonic() + self.torrent.announce_interval
+                )
+                continue
+
+            new_peers = [peer for peer in peers if peer not in known]
+            if new_peers and self.on_peers:
+                self.on_peers(new_peers)
+
+    async def stop(self, event: str = "stopped") -> None:
+        """Tells the trackers we are done; failures here don't hold up exit."""
+        for lookup in list(self.lookups):
+            lookup.cancel()
+        await asyncio.gather(*self.lookups, return_exceptions=True)
+        if not self.started:
+            return
+        try:
+            await self.announce(event, timeout=FINAL_ANNOUNCE_TIMEOUT)
+        except (requests.RequestException, ConnectionError, ValueError) as e:
+            print(f"Could not send {event!r} announce: {e!r}")
@@ -0,0 +1,46 @@
+"""
+Checks downloaded pieces against the SHA-1 hashes from the torrent.
+
+Hashing runs on an executor so the event loop keeps servicing sockets.
+hashlib releases the GIL for large buffers, so threads already scale across
+cores; a process pool is available for interpreters where that is not true.
+"""
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha1
+
+from app.models import PieceHashes
+from app.settings import HASH_EXECUTOR, HASH_WORKERS
+
+
+def sha1_digest(data: bytes) -> bytes:
+    return sha1(data).digest()
+
+
+def make_executor(
+    kind: str = HASH_EXECUTOR, workers: int | None = HASH_WORKERS
+) -> Executor:
+    match kind:
+        case "thread":
+            return ThreadPoolExecutor(workers, thread_name_prefix="hash")
+        case "process":
+            return ProcessPoolExecutor(workers)
+        case _:
+            raise ValueError(
+                f"Unknown hash executor {kind!r}, use 'thread' or 'process'."
+            )
+
+
+class PieceVerifier:
+    def __init__(self, pieces: PieceHashes, executor: Executor | None = None) -> None:
+        self.pieces = pieces
+        self.executor = executor or make_executor()
+
+    async def verify(self, piece_index: int, data: bytes | bytearray) -> bool:
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(self.executor, sha1_digest, data)
+        return digest == self.pieces[piece_index]
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,116 @@
+"""
+Compares app.bencode against bencodepy on large, multi-file .torrent files.
+
+Run from the repository root:
+python -m benchmarks.bench_bencode
+
+Each case is timed best-of-N on a synthetic torrent:
+- decode: the whole file into Python values.
+- info hash: what loading a torrent costs before any piece is touched. Before
+  app.bencode, that was decode, re-encode `info`, then SHA-1. Now it is a lazy
+  decode and one SHA-1 over the original `info` bytes.
+- load: Torrent.from_file's work, i.e. the info hash plus the file list and
+  piece hashes.
+"""
+
+import hashlib
+import os
+import sys
+import time
+from typing import Callable
+
+import bencodepy  # type: ignore
+
+from app import bencode
+
+REPEAT = 5
+
+
+def make_torrent(number_of_files: int, number_of_pieces: int) -> bytes:
+    files = [
+        {b"length": 1_000_000 + i, b"path": [b"dir%d" % (i % 100), b"file-%d.bin" % i]}
+        for i in range(number_of_files)
+    ]
+    info = {
+        b"files": files,
+        b"name": b"benchmark",
+        b"piece length": 262_144,
+        b"pieces": os.urandom(20 * number_of_pieces),
+    }
+    return bencodepy.encode(
+        {
+            b"announce": b"http://tracker.example/announce",
+            b"created by": b"bench",
+            b"info": info,
+        }
+    )
+
+
+def best_of(function: Callable[[], object]) -> float:
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bencodepy_info_hash(data: bytes) -> bytes:
+    return hashlib.sha1(bencodepy.encode(bencodepy.decode(data)[b"info"])).digest()
+
+
+def bencode_info_hash(data: bytes) -> bytes:
+    return hashlib.sha1(bencode.decode(data, lazy=True).raw(b"info")).digest()
+
+
+def bencodepy_load(data: bytes) -> int:
+    torrent = bencodepy.decode(data)
+    info = torrent[b"info"]
+    hashlib.sha1(bencodepy.encode(info)).digest()
+    pieces = [
+        info[b"pieces"][i : i + 20].hex() for i in range(0, len(info[b"pieces"]), 20)
+    ]
+    return len(pieces) + sum(len(file[b"path"]) for file in info[b"files"])
+
+
+def bencode_load(data: bytes) -> int:
+    torrent = bencode.decode(data, lazy=True)
+    hashlib.sha1(torrent.raw(b"info")).digest()
+    info = torrent[b"info"]
+    pieces = memoryview(info[b"pieces"])
+    return len(pieces) // 20 + sum(len(file[b"path"]) for file in info[b"files"])
+
+
+def main() -> None:
+    cases = [(1_000, 10_000), (10_000, 100_000), (50_000, 400_000)]
+    if len(sys.argv) > 1:
+        cases = cases[: int(sys.argv[1])]
+
+    print(
+        f"{'torrent':>28} {'case':>10} {'bencodepy':>11}"
+        f" {'app.bencode':>12} {'speedup':>8}"
+    )
+    for number_of_files, number_of_pieces in cases:
+        data = make_torrent(number_of_files, number_of_pieces)
+        assert bencode.decode(data) == bencodepy.decode(data)
+        assert bencode_info_hash(data) == bencodepy_info_hash(data)
+        label = f"{number_of_files} files, {len(data) / 2**20:.1f} MiB"
+
+        for case, old, new in (
+            ("decode", lambda: bencodepy.decode(data), lambda: bencode.decode(data)),
+            (
+                "info hash",
+                lambda: bencodepy_info_hash(data),
+                lambda: bencode_info_hash(data),
+            ),
+            ("load", lambda: bencodepy_load(data), lambda: bencode_load(data)),
+        ):
+            old_time, new_time = best_of(old), best_of(new)
+            print(
+                f"{label:>28} {case:>10} {old_time * 1000:>9.1f}ms"
+                f" {new_time * 1000:>10.1f}ms {old_time / new_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Runs a DHT of app.dht nodes on loopback and reports how lookups went, as JSON.
+
+Run from the repository root:
+python -m benchmarks.bench_dht              # 30 nodes
+python -m benchmarks.bench_dht --nodes 100 --output results.json
+
+Every node bootstraps off the first one, nothing leaves the machine. Then one
+node announces a torrent and another looks it up. Per run it reports:
+- bootstrap: seconds until every node had filled its routing table.
+- table_sizes: the smallest, median and largest routing table.
+- announce, lookup: seconds for the announcing get_peers and the one after it.
+- found: whether the lookup returned the announced peer.
+Alongside, it checks what the node must refuse:
+- forged_reply_ignored: a reply with the right transaction ID from the wrong
+  address doesn't answer a query to a node that stays silent.
+- announced_capped: a flood of announces stays within MAX_ANNOUNCED_TORRENTS
+  and MAX_ANNOUNCED_PEERS.
+- port_contact_added: a node reached only through add_contact, as from a
+  PORT message, ends up in the routing table.
+It exits 1 if any of these fail.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import socket
+import statistics
+import sys
+import time
+
+from app import bencode
+from app.dht import MAX_ANNOUNCED_PEERS, MAX_ANNOUNCED_TORRENTS, DHTNode
+from app.models import Peer
+
+HOST = "127.0.0.1"
+
+ANNOUNCE_PORT = 5555
+
+
+def make_node(bootstrap: DHTNode | None = None) -> DHTNode:
+    return DHTNode(
+        port=0,
+        bootstrap_nodes=[(HOST, bootstrap.port)] if bootstrap else [],
+        state_file=None,
+        host=HOST,
+    )
+
+
+async def start_nodes(count: int) -> list[DHTNode]:
+    first = make_node()
+    await first.start()
+    nodes = [first]
+    for _ in range(count - 1):
+        node = make_node(first)
+        await node.start()
+        nodes.append(node)
+    await asyncio.gather(*(node.bootstrapping for node in nodes if node.bootstrapping))
+    return nodes
+
+
+async def forged_reply_ignored(node: DHTNode) -> bool:
+    """Whether a ping to a silent address times out despite a forged reply."""
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    forger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        silent.bind((HOST, 0))
+        forger.bind((HOST, 0))
+        query = asyncio.create_task(node.query(silent.getsockname(), "ping", {}))
+        while not node.pending:
+            await asyncio.sleep(0)
+        (transaction,) = node.pending
+        forged = {"t": transaction, "y": "r", "r": {"id": b"\xff" * 20}}
+        forger.sendto(bencode.encode(forged), (HOST, node.port))
+        try:
+            await query
+        except asyncio.TimeoutError:
+            return True
+        return False
+    finally:
+        silent.close()
+        forger.close()
+
+
+def announced_capped(node: DHTNode) -> bool:
+    for i in range(MAX_ANNOUNCED_TORRENTS + 10):
+        node.store_peer(hashlib.sha1(b"%d" % i).digest(), Peer(HOST, ANNOUNCE_PORT))
+    info_hash = hashlib.sha1(b"crowded").digest()
+    for port in range(1, MAX_ANNOUNCED_PEERS + 11):
+        node.store_peer(info_hash, Peer(HOST, port))
+    return (
+        len(node.announced) <= MAX_ANNOUNCED_TORRENTS
+        and len(node.announced_peers(info_hash)) == MAX_ANNOUNCED_PEERS
+    )
+
+
+async def port_contact_added() -> bool:
+    """Whether a node with an empty table adds a contact that answers its ping."""
+    # Apart from the others, whose full buckets could rightly turn it away.
+    node, stranger = make_node(), make_node()
+    await node.start()
+    await stranger.start()
+    try:
+        node.add_contact((HOST, stranger.port))
+        await asyncio.gather(*node.pings, return_exceptions=True)
+        return any(known.id == stranger.id for known in node.table)
+    finally:
+        await node.close()
+        await stranger.close()
+
+
+async def run(count: int) -> dict:
+    started = time.monotonic()
+    nodes = await start_nodes(count)
+    try:
+        bootstrapped = time.monotonic()
+        sizes = sorted(len(node.table) for node in nodes)
+        info_hash = hashlib.sha1(b"bench_dht").digest()
+
+        await nodes[count // 4].get_peers(info_hash, announce_port=ANNOUNCE_PORT)
+        announced = time.monotonic()
+        peers = await nodes[-1].get_peers(info_hash)
+        looked_up = time.monotonic()
+
+        return {
+            "nodes": count,
+            "bootstrap": round(bootstrapped - started, 3),
+            "table_sizes": [sizes[0], statistics.median_low(sizes), sizes[-1]],
+            "announce": round(announced - bootstrapped, 3),
+            "lookup": round(looked_up - announced, 3),
+            "found": Peer(HOST, ANNOUNCE_PORT) in peers,
+            "forged_reply_ignored": await forged_reply_ignored(nodes[1]),
+            "announced_capped": announced_capped(nodes[0]),
+            "port_contact_added": await port_contact_added(),
+        }
+    finally:
+        for node in nodes:
+            await node.close()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nodes", type=int, default=30)
+    parser.add_argument("--output", help="write the JSON here as well as to stdout")
+    args = parser.parse_args()
+    if args.nodes < 3:
+        parser.error("--nodes must be at least 3")
+
+    # The nodes' start-up lines would land in the middle of the JSON otherwise.
+    with contextlib.redirect_stdout(sys.stderr):
+        result = await run(args.nodes)
+
+    report = json.dumps({"python": sys.version.split()[0], "result": result}, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    checks = ("found", "forged_reply_ignored", "announced_capped", "port_contact_added")
+    if not all(result[check] for check in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,272 @@
+"""
+Downloads synthetic torrents from a local swarm and reports how it went, as JSON.
+
+Run from the repository root:
+python -m benchmarks.bench_swarm                  # every scenario
+python -m benchmarks.bench_swarm baseline magnet  # just these
+python -m benchmarks.bench_swarm --size 256 --latency 0.05 --output results.json
+
+Each scenario starts a tracker and seeders from benchmarks.swarm, then runs
+`python -m app.main download` (or `magnet_download`) as a child process. So
+what gets measured is the real CLI, start-up and all. Per run it reports:
+- mb_per_s: torrent size over wall time, start to exit.
+- time_to_first_piece: seconds until the seeders had sent one full piece.
+- tail: seconds from the seeders sending 95% of the pieces to the client exiting.
+  Endgame and the final writes and verification all land here.
+- peak_rss_mb: the client's maximum resident set size (VmHWM), sampled
+  while it runs. wait4()'s ru_maxrss would also count what the child
+  inherited from this process before exec.
+The seeders time blocks from their side, so a block sent by two seeders in
+endgame counts at the first one.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from functools import partial
+
+from benchmarks.swarm import Seeder, make_torrent, pieces_sent_at, start_swarm
+
+MiB = 2**20
+
+TAIL_FRACTION = 0.95
+
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+@dataclass
+class Scenario:
+    name: str
+    size: int = 64 * MiB
+    files: int = 1  # More than one makes a multi-file torrent of equal parts.
+    piece_length: int = 256 * 1024
+    seeders: int = 4
+    latency: float = 0.0
+    bandwidth: float | None = None  # Per seeder, in bytes per second.
+    choke_every: int = 0
+    choke_duration: float = 0.1  # Seconds each choke lasts.
+    fast_seeders: int = 0  # Unshaped seeders alongside the shaped ones.
+    magnet: bool = False
+    timeout: float = 300.0
+    seeder_options: dict = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.seeder_options = {
+            "latency": self.latency,
+            "bandwidth": self.bandwidth,
+            "choke_every": self.choke_every,
+            "choke_duration": self.choke_duration,
+        }
+
+
+SCENARIOS = [
+    Scenario("baseline"),
+    Scenario("multi_file", files=40),
+    Scenario("latency", latency=0.05),
+    Scenario("bandwidth", size=32 * MiB, bandwidth=4 * MiB),
+    Scenario("choking", choke_every=64),
+    Scenario(
+        "slow_seeder_mix", size=32 * MiB, seeders=3, bandwidth=MiB, fast_seeders=1
+    ),
+    Scenario("magnet", magnet=True),
+]
+
+
+def file_sizes(scenario: Scenario) -> list[int]:
+    part, rest = divmod(scenario.size, scenario.files)
+    return [part + (1 if i < rest else 0) for i in range(scenario.files)]
+
+
+def peak_rss(pid: int) -> int:
+    """The process's resident set high-water mark in KiB, or 0 once it has gone."""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def wait_for_exit(process: subprocess.Popen) -> tuple[int, float, int]:
+    """Waits for the client, returning its exit code, exit time and peak RSS in KiB."""
+    peak = 0
+    while process.poll() is None:
+        peak = max(peak, peak_rss(process.pid))
+        time.sleep(RSS_SAMPLE_INTERVAL)
+    return process.returncode, time.monotonic(), peak
+
+
+async def run(scenario: Scenario, workdir: str) -> dict:
+    tracker, seeders, torrent = await start_swarm(
+        partial(make_torrent, file_sizes(scenario), scenario.piece_length),
+        scenario.seeders,
+        **scenario.seeder_options,
+    )
+    for _ in range(scenario.fast_seeders):
+        seeder = Seeder(torrent)
+        await seeder.start()
+        seeders.append(seeder)
+        tracker.peers.append(("127.0.0.1", seeder.port))
+
+    output = os.path.join(workdir, scenario.name)
+    if scenario.magnet:
+        command = ["magnet_download", "-o", output, torrent.magnet_link]
+    else:
+        torrent_path = os.path.join(workdir, f"{scenario.name}.torrent")
+        with open(torrent_path, "wb") as file:
+            file.write(torrent.metainfo)
+        command = ["download", "-o", output, torrent_path]
+
+    # Nothing but the local swarm: no metadata cache hits and no public DHT.
+    environment = dict(
+        os.environ, XDG_CACHE_HOME=os.path.join(workdir, "cache"), BITTORRENT_DHT="0"
+    )
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.main", *command],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=environment,
+    )
+    try:
+        returncode, finished, rss = await asyncio.wait_for(
+            asyncio.to_thread(wait_for_exit, process), scenario.timeout
+        )
+    except asyncio.TimeoutError:
+        process.kill()
+        await asyncio.to_thread(process.wait)
+        returncode, finished, rss = None, time.monotonic(), 0
+    finally:
+        for seeder in seeders:
+            await seeder.close()
+        await tracker.close()
+
+    sent_at = pieces_sent_at(seeders)
+    elapsed = finished - started
+    result = {
+        "scenario": scenario.name,
+        "size": scenario.size,
+        "files": scenario.files,
+        "piece_length": scenario.piece_length,
+        "seeders": scenario.seeders,
+        "latency": scenario.latency,
+        "bandwidth": scenario.bandwidth,
+        "choke_every": scenario.choke_every,
+        "fast_seeders": scenario.fast_seeders,
+        "magnet": scenario.magnet,
+        "ok": returncode == 0 and verify(output, torrent.data, scenario.files > 1),
+        "exit_code": returncode,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(scenario.size / MiB / elapsed, 2),
+        "time_to_first_piece": round(sent_at[0] - started, 3) if sent_at else None,
+        "tail": None,
+        "peak_rss_mb": round(rss / 1024, 1),
+        "bytes_served": sum(seeder.served for seeder in seeders),
+        "announces": len(tracker.announces),
+    }
+    if len(sent_at) == torrent.number_of_pieces:
+        tail_start = sent_at[int(len(sent_at) * TAIL_FRACTION) - 1]
+        result["tail"] = round(finished - tail_start, 3)
+    return result
+
+
+def verify(output: str, data: bytes, multi_file: bool) -> bool:
+    """Whether the client wrote exactly the torrent's data."""
+    if not multi_file:
+        paths = [output]
+    else:
+        root = os.path.join(output, "bench")
+        paths = sorted(
+            (
+                os.path.join(directory, name)
+                for directory, _, names in os.walk(root)
+                for name in names
+            ),
+            key=lambda path: int(os.path.basename(path)[4:-4]),
+        )
+    written = bytearray()
+    for path in paths:
+        with open(path, "rb") as file:
+            written += file.read()
+    return written == data
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "scenarios", nargs="*", help="names to run; default is all of them"
+    )
+    parser.add_argument(
+        "--size", type=int, help="torrent size in MiB, for a custom run"
+    )
+    parser.add_argument("--files", type=int, default=1)
+    parser.add_argument("--piece-length", type=int, default=256, help="in KiB")
+    parser.add_argument("--seeders", type=int, default=4)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument("--bandwidth", type=float, help="MiB/s per seeder")
+    parser.add_argument(
+        "--choke-every", type=int, default=0, help="blocks between chokes"
+    )
+    parser.add_argument(
+        "--choke-duration", type=float, default=0.1, help="seconds per choke"
+    )
+    parser.add_argument("--magnet", action="store_true")
+    parser.add_argument("--output", help="write the JSON here as well as to stdout")
+    args = parser.parse_args()
+
+    if args.size is not None:
+        scenarios = [
+            Scenario(
+                "custom",
+                size=args.size * MiB,
+                files=args.files,
+                piece_length=args.piece_length * 1024,
+                seeders=args.seeders,
+                latency=args.latency,
+                bandwidth=args.bandwidth * MiB if args.bandwidth else None,
+                choke_every=args.choke_every,
+                choke_duration=args.choke_duration,
+                magnet=args.magnet,
+            )
+        ]
+    else:
+        names = set(args.scenarios)
+        unknown = names - {scenario.name for scenario in SCENARIOS}
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        scenarios = [s for s in SCENARIOS if not names or s.name in names]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_swarm-") as workdir:
+        for scenario in scenarios:
+            result = await run(scenario, workdir)
+            print(
+                f"{scenario.name:>16}: {result['mb_per_s']:>7} MB/s"
+                f" first piece {result['time_to_first_piece']}s,"
+                f" tail {result['tail']}s,"
+                f" {result['peak_rss_mb']} MB RSS{'' if result['ok'] else ' FAILED'}",
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    report = json.dumps(
+        {"python": sys.version.split()[0], "results": results}, indent=2
+    )
+    print(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,314 @@
+"""
+A stand-in swarm on loopback: an HTTP tracker and seeders that shape their uploads.
+
+Seeders answer each REQUEST after `latency` seconds, pipelined like a real
+link, and pace what they send to `bandwidth` bytes per second. With
+`choke_every`, a seeder chokes the client every that many blocks for
+`choke_duration` seconds, dropping the requests it had queued, as real
+peers do. A CANCEL takes its request out of the queue if it hasn't been
+answered yet. Seeders also serve the info dict over ut_metadata, so magnet
+links work.
+
+Seeders also note when they first sent each block. `pieces_sent_at` merges
+those notes across the swarm. That gives the benchmark time-to-first-piece
+and tail timings without parsing the client's output.
+"""
+
+import asyncio
+import hashlib
+import math
+import struct
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from urllib.parse import parse_qs, urlparse
+
+from app import bencode
+
+BLOCK_LENGTH = 16 * 1024
+
+
+@dataclass
+class SyntheticTorrent:
+    metainfo: bytes  # The .torrent file.
+    info_hash: bytes
+    raw_info: bytes
+    data: bytes  # Every file's content, concatenated.
+    piece_length: int
+
+    @property
+    def number_of_pieces(self) -> int:
+        return math.ceil(len(self.data) / self.piece_length)
+
+    @property
+    def magnet_link(self) -> str:
+        tracker = bencode.decode(self.metainfo)[b"announce"].decode()
+        return f"magnet:?xt=urn:btih:{self.info_hash.hex()}&dn=bench&tr={tracker}"
+
+
+def make_torrent(
+    file_sizes: list[int], piece_length: int, announce: str, seed: int = 0
+) -> SyntheticTorrent:
+    """A torrent over pseudo-random data; one size is a single-file torrent."""
+    data = hashlib.shake_256(seed.to_bytes(8, "big")).digest(sum(file_sizes))
+    info: dict = {b"name": b"bench", b"piece length": piece_length}
+    if len(file_sizes) == 1:
+        info[b"length"] = file_sizes[0]
+    else:
+        info[b"files"] = [
+            {b"length": size, b"path": [b"dir%d" % (i % 10), b"file%d.bin" % i]}
+            for i, size in enumerate(file_sizes)
+        ]
+    info[b"pieces"] = b"".join(
+        hashlib.sha1(data[offset : offset + piece_length]).digest()
+        for offset in range(0, len(data), piece_length)
+    )
+    raw_info = bencode.encode(info)
+    metainfo = bencode.encode({b"announce": announce.encode(), b"info": info})
+    return SyntheticTorrent(
+        metainfo, hashlib.sha1(raw_info).digest(), raw_info, data, piece_length
+    )
+
+
+class Tracker:
+    """Answers every announce with the same compact peer list."""
+
+    def __init__(self) -> None:
+        self.peers: list[tuple[str, int]] = []
+        self.announces: list[dict[str, str]] = []
+        self.server: asyncio.Server | None = None
+        self.port = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/announce"
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ")[1].decode()
+            query = parse_qs(urlparse(path).query)
+            self.announces.append({key: values[0] for key, values in query.items()})
+            peers = b"".join(
+                bytes(map(int, ip.split("."))) + struct.pack(">H", port)
+                for ip, port in self.peers
+            )
+            body = bencode.encode({b"interval": 1800, b"peers": peers})
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                % len(body)
+                + body
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+@dataclass
+class Seeder:
+    torrent: SyntheticTorrent
+    latency: float = 0.0  # Seconds before each REQUEST is answered.
+    bandwidth: float | None = None  # Bytes per second; None is unlimited.
+    choke_every: int = 0  # Blocks between chokes; 0 never chokes.
+    choke_duration: float = 0.1
+    served: int = 0
+    # When each block first went out, by (piece index, begin).
+    block_sent_at: dict[tuple[int, int], float] = field(default_factory=dict)
+    _next_send: float = 0.0
+    server: asyncio.Server | None = None
+    port: int = 0
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        queue: deque[tuple[float, int, int, int]] = deque()
+        state = {"choked": True, "peer_ut_metadata": 0, "queued": asyncio.Event()}
+        sender = asyncio.create_task(self.send_blocks(writer, queue, state))
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.torrent.info_hash:
+                return
+            reserved = bytearray(8)
+            reserved[5] |= 0x10  # BEP 10 extensions, for ut_metadata.
+            writer.write(
+                b"\x13BitTorrent protocol"
+                + reserved
+                + self.torrent.info_hash
+                + b"-BN0001-000000000000"
+            )
+            bits = bytearray(math.ceil(self.torrent.number_of_pieces / 8))
+            for piece_index in range(self.torrent.number_of_pieces):
+                bits[piece_index // 8] |= 0x80 >> (piece_index % 8)
+            writer.write(struct.pack(">IB", len(bits) + 1, 5) + bits)
+            if handshake[25] & 0x10:
+                extended = bencode.encode(
+                    {
+                        b"m": {b"ut_metadata": 3},
+                        b"metadata_size": len(self.torrent.raw_info),
+                    }
+                )
+                writer.write(struct.pack(">IBB", len(extended) + 2, 20, 0) + extended)
+
+            while True:
+                (length,) = struct.unpack(">I", await reader.readexactly(4))
+                if not length:
+                    continue
+                message = await reader.readexactly(length)
+                if message[0] == 2 and state["choked"]:  # INTERESTED
+                    state["choked"] = False
+                    writer.write(b"\x00\x00\x00\x01\x01")
+                elif message[0] == 6 and not state["choked"]:  # REQUEST
+                    piece_index, begin, block_length = struct.unpack(
+                        ">III", message[1:13]
+                    )
+                    queue.append(
+                        (
+                            time.monotonic() + self.latency,
+                            piece_index,
+                            begin,
+                            block_length,
+                        )
+                    )
+                    state["queued"].set()
+                elif message[0] == 8:  # CANCEL
+                    request = struct.unpack(">III", message[1:13])
+                    for queued in queue:
+                        if queued[1:] == request:
+                            queue.remove(queued)
+                            break
+                elif message[0] == 20:
+                    self.handle_metadata(writer, message, state)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    def handle_metadata(
+        self, writer: asyncio.StreamWriter, message: bytes, state: dict
+    ) -> None:
+        request = bencode.decode(message[2:])
+        if message[1] == 0:
+            state["peer_ut_metadata"] = request.get(b"m", {}).get(b"ut_metadata", 0)
+            return
+        piece = request[b"piece"]
+        chunk = self.torrent.raw_info[piece * BLOCK_LENGTH : (piece + 1) * BLOCK_LENGTH]
+        header = bencode.encode(
+            {b"msg_type": 1, b"piece": piece, b"total_size": len(self.torrent.raw_info)}
+        )
+        writer.write(
+            struct.pack(
+                ">IBB", len(header) + len(chunk) + 2, 20, state["peer_ut_metadata"]
+            )
+            + header
+            + chunk
+        )
+
+    async def send_blocks(
+        self,
+        writer: asyncio.StreamWriter,
+        queue: deque[tuple[float, int, int, int]],
+        state: dict,
+    ) -> None:
+        """Answers queued REQUESTs after their latency, at the seeder's bandwidth."""
+        torrent = self.torrent
+        sent = 0
+        while True:
+            if not queue:
+                state["queued"].clear()
+                await state["queued"].wait()
+                continue
+            queued = queue[0]
+            due, piece_index, begin, block_length = queued
+            await asyncio.sleep(max(due - time.monotonic(), 0))
+            if not queue or queue[0] is not queued:
+                continue  # Cancelled, or dropped by a choke, while we waited.
+            queue.popleft()
+            if self.bandwidth:
+                now = time.monotonic()
+                self._next_send = (
+                    max(self._next_send, now) + block_length / self.bandwidth
+                )
+                await asyncio.sleep(self._next_send - now)
+
+            offset = piece_index * torrent.piece_length + begin
+            block = torrent.data[offset : offset + block_length]
+            writer.write(
+                struct.pack(">IBII", 9 + len(block), 7, piece_index, begin) + block
+            )
+            self.served += len(block)
+            self.block_sent_at.setdefault((piece_index, begin), time.monotonic())
+            await writer.drain()
+
+            sent += 1
+            if self.choke_every and sent % self.choke_every == 0:
+                state["choked"] = True
+                queue.clear()  # Choking drops whatever the client had asked for.
+                writer.write(b"\x00\x00\x00\x01\x00")
+                await asyncio.sleep(self.choke_duration)
+                state["choked"] = False
+                writer.write(b"\x00\x00\x00\x01\x01")
+
+
+def pieces_sent_at(seeders: list[Seeder]) -> list[float]:
+    """When each piece had been sent in full, by any mix of seeders, in time order."""
+    torrent = seeders[0].torrent
+    first_sent: dict[tuple[int, int], float] = {}
+    for seeder in seeders:
+        for block, sent_at in seeder.block_sent_at.items():
+            first_sent[block] = min(sent_at, first_sent.get(block, sent_at))
+
+    completed = []
+    for piece_index in range(torrent.number_of_pieces):
+        piece_length = min(
+            torrent.piece_length, len(torrent.data) - piece_index * torrent.piece_length
+        )
+        blocks = [
+            (piece_index, begin) for begin in range(0, piece_length, BLOCK_LENGTH)
+        ]
+        if all(block in first_sent for block in blocks):
+            completed.append(max(first_sent[block] for block in blocks))
+    return sorted(completed)
+
+
+async def start_swarm(
+    torrent_factory, seeders: int, **seeder_options
+) -> tuple[Tracker, list[Seeder], SyntheticTorrent]:
+    """Starts a tracker, builds the torrent announcing to it, and starts its seeders."""
+    tracker = Tracker()
+    await tracker.start()
+    torrent = torrent_factory(tracker.url)
+    started = []
+    for _ in range(seeders):
+        seeder = Seeder(torrent, **seeder_options)
+        await seeder.start()
+        started.append(seeder)
+    tracker.peers = [("127.0.0.1", seeder.port) for seeder in started]
+    return tracker, started, torrent